@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The caption readers live with the captioning code in data_generation/common
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "data_generation"
+    )
+)
+
+from common.caption_columns import load_captions, sorted_items  # noqa: E402, F401
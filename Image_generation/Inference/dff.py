@@ -1,17 +1,191 @@
-import torch
-from diffusers import FluxPipeline
-
-pipe = FluxPipeline.from_pretrained("FLUX.1-dev", torch_dtype=torch.bfloat16)
-pipe.enable_model_cpu_offload()  # save some VRAM by offloading the model to CPU. Remove this if you have enough GPU power
-
-prompt = "A cat holding a sign that says hello world"
-image = pipe(
-    prompt,
-    height=1024,
-    width=1024,
-    guidance_scale=3.5,
-    num_inference_steps=50,
-    max_sequence_length=512,
-    generator=torch.Generator("cpu").manual_seed(0),
-).images[0]
-image.save("flux-dev.png")
+import os
+import time
+from tqdm import tqdm
+
+from caption_source import load_captions, sorted_items
+from generation_manifest import (
+    GenerationManifest,
+    mirrored_output_paths,
+    plan_generation,
+    save_output,
+)
+from image_writer import ImageWriter
+from prompt_cache import PromptEmbeddingCache, encoder_id, group_prompts
+
+# FLUX.1 [dev] model
+model_id = "FLUX.1-dev"
+
+# Parameters
+n_steps = 50
+height = 1024
+width = 1024
+guidance_scale = 3.5
+max_sequence_length = 512
+
+
+def load_pipeline(model_id=model_id, device="cuda"):
+    """
+    Load the FLUX pipeline with model CPU offload.
+    :param model_id: Hugging Face model ID or local folder.
+    :param device: Device the offloaded modules run on.
+    :return: The pipeline.
+    """
+    # Imported on first load only; see sd_2.load_pipeline
+    import torch
+    from diffusers import FluxPipeline
+
+    pipe = FluxPipeline.from_pretrained(model_id, torch_dtype=torch.bfloat16)
+    # save some VRAM by offloading the model to CPU. Remove this if you have enough GPU power
+    pipe.enable_model_cpu_offload(device=device)
+    return pipe
+
+
+def encode_prompt(pipe, prompt, cache: PromptEmbeddingCache):
+    """
+    :param prompt: Normalized prompt.
+    :param cache: Prompt embedding cache.
+    :return: Embedding arguments for the pipeline (T5 and pooled CLIP embeddings).
+    """
+    import torch
+
+    device = pipe._execution_device
+    with torch.inference_mode():
+        prompt_embeds, pooled_prompt_embeds = cache.get_or_encode(
+            [prompt],
+            lambda prompts: pipe.encode_prompt(
+                prompts, None, device, max_sequence_length=max_sequence_length
+            )[:2],
+            device,
+        )[0]
+    return {
+        "prompt_embeds": prompt_embeds[None],
+        "pooled_prompt_embeds": pooled_prompt_embeds[None],
+    }
+
+
+def generate_image(pipe, prompt_kwargs, seed=0):
+    """
+    :param prompt_kwargs: Prompt arguments of the pipeline, e.g. {"prompt": ...} or encode_prompt().
+    :param seed: Seed of the image, or None for a random one.
+    """
+    import torch
+
+    return pipe(
+        **prompt_kwargs,
+        height=height,
+        width=width,
+        guidance_scale=guidance_scale,
+        num_inference_steps=n_steps,
+        max_sequence_length=max_sequence_length,
+        generator=None if seed is None else torch.Generator("cpu").manual_seed(seed),
+    ).images[0]
+
+
+def generate_images_from_json(
+    json_path,
+    output_folder,
+    pipe=None,
+    seed=0,
+    embedding_cache=None,
+    manifest_path=None,
+    writer=None,
+):
+    """
+    Generate one image per caption.
+    Seeds, duplicate captions, the output layout, the manifest and background saving
+    work as in sd_2.generate_images_from_json.
+    :param json_path: output.json with {"captions": {image_path: caption}}, or a
+                      columnar caption store folder.
+    :param output_folder: Folder to save the generated images to.
+    :param pipe: Loaded pipeline, defaults to load_pipeline().
+    :param seed: Base seed of the run, or None for random images.
+    :param embedding_cache: PromptEmbeddingCache to reuse across runs, e.g. with a disk store.
+    :param manifest_path: Generation manifest, defaults to manifest.jsonl in output_folder.
+    :param writer: ImageWriter encoding and saving images in the background while the next
+                   image is generated, defaults to one that keeps each input's format.
+    :return: Dictionary with the number of images, seconds taken, images per minute,
+             skipped images, duplicate captions, embedding cache hits and estimated
+             seconds saved.
+    """
+    # output.json, or a memory-mapped columnar caption store
+    captions = load_captions(json_path)
+
+    # Sort image paths (a columnar store is already sorted)
+    items = list(sorted_items(captions))
+    sorted_image_paths = [img_path for img_path, _ in items]
+    groups = group_prompts(items)
+    own_writer = writer is None
+    writer = writer or ImageWriter()
+    output_paths = {
+        img_path: writer.output_path(output_path)
+        for img_path, output_path in mirrored_output_paths(
+            sorted_image_paths, output_folder
+        ).items()
+    }
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    pipe = pipe or load_pipeline()
+    cache = embedding_cache or PromptEmbeddingCache(encoder_id(pipe))
+    hits_before, saved_before = cache.hits, cache.time_saved()
+    settings = {
+        "model": pipe.name_or_path,
+        "steps": n_steps,
+        "guidance_scale": guidance_scale,
+        "size": [width, height],
+        "max_sequence_length": max_sequence_length,
+    }
+
+    start_time = time.perf_counter()
+    # The writer is flushed (or closed) before the manifest, so every written image is recorded
+    with GenerationManifest(
+        manifest_path or os.path.join(output_folder, "manifest.jsonl")
+    ) as manifest, (writer if own_writer else writer.scope()):
+        jobs, skipped = plan_generation(groups, output_paths, manifest, seed, settings)
+        for prompt, item_seed, img_path in tqdm(jobs, desc="Generating images"):
+            image = generate_image(pipe, encode_prompt(pipe, prompt, cache), item_seed)
+
+            # Save the generated image
+            save_output(
+                writer,
+                image,
+                prompt,
+                item_seed,
+                img_path,
+                output_paths,
+                manifest,
+                settings,
+            )
+
+        writer.flush()
+
+    seconds = time.perf_counter() - start_time
+    written = len(items) - skipped
+    images_per_min = written / seconds * 60 if seconds > 0 else 0.0
+    duplicates = len(jobs) - len({prompt for prompt, _, _ in jobs})
+    cache_hits = cache.hits - hits_before
+    seconds_saved = cache.time_saved() - saved_before
+    print(
+        f"Generated {len(jobs)} images for {len(items)} captions in {seconds:.1f}s "
+        f"({images_per_min:.1f} images/min): {skipped} already complete, "
+        f"{duplicates} with a duplicate caption, "
+        f"{cache_hits} prompt embedding cache hits, ~{seconds_saved:.1f}s saved."
+    )
+    return {
+        "images": len(items),
+        "seconds": seconds,
+        "images_per_min": images_per_min,
+        "generated": len(jobs),
+        "skipped": skipped,
+        "duplicates": duplicates,
+        "embedding_cache_hits": cache_hits,
+        "seconds_saved": seconds_saved,
+    }
+
+
+if __name__ == "__main__":
+    pipe = load_pipeline()
+    image = generate_image(
+        pipe, {"prompt": "A cat holding a sign that says hello world"}
+    )
+    image.save("flux-dev.png")
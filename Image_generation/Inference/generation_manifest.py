@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+
+from prompt_cache import normalize_prompt
+
+
+def prompt_hash(prompt: str) -> str:
+    """Hash of the normalized prompt."""
+    return hashlib.blake2b(
+        normalize_prompt(prompt).encode(), digest_size=16
+    ).hexdigest()
+
+
+def item_seed(base_seed, prompt: str, image_path: str):
+    """
+    Derive the seed of one image from the run's base seed, its normalized prompt and its
+    input image path. The seed does not depend on the order or batching of the captions,
+    so any image can be regenerated on its own, and images with identical captions still
+    get different seeds (and images).
+    :param base_seed: Seed of the run, or None for random images.
+    :param image_path: Input image path (caption key) of the image.
+    :return: 63-bit seed, or None.
+    """
+    if base_seed is None:
+        return None
+    digest = hashlib.blake2b(
+        json.dumps([base_seed, normalize_prompt(prompt), image_path]).encode(),
+        digest_size=8,
+    ).digest()
+    return int.from_bytes(digest, "big") & (2**63 - 1)
+
+
+def mirrored_output_paths(image_paths, output_folder: str) -> dict:
+    """
+    Map every input image to an output path that mirrors its location relative to the
+    common folder of all inputs, so images with the same file name in different folders
+    do not overwrite each other.
+    :param image_paths: Input image paths (caption keys).
+    :param output_folder: Folder the outputs are written under.
+    :return: Dictionary {image_path: output_path}.
+    """
+    if not image_paths:
+        return {}
+    absolute = {path: os.path.abspath(path) for path in image_paths}
+    root = os.path.commonpath([os.path.dirname(path) for path in absolute.values()])
+    return {
+        path: os.path.join(output_folder, os.path.relpath(absolute[path], root))
+        for path in image_paths
+    }
+
+
+def make_record(image_path, output_path, prompt, seed, settings: dict) -> dict:
+    """
+    Describe one generated image.
+    :param settings: Generation settings that change the image, e.g. model and steps.
+    """
+    return {
+        "image_path": image_path,
+        "output_path": output_path,
+        "prompt_hash": prompt_hash(prompt),
+        "seed": seed,
+        **settings,
+    }
+
+
+class GenerationManifest:
+    """
+    Append-only JSONL record of generated images (prompt hash, seed, model, steps, output
+    path, file size), keyed by output path. An image is complete when its record matches
+    the current prompt and settings and the file on disk still has the recorded size, so
+    an interrupted run resumes where it stopped and changed captions are regenerated.
+    """
+
+    def __init__(self, path: str, flush_every: int = 32):
+        """
+        Open (or create) the manifest and load the records already in it.
+        :param path: Path to the JSONL file.
+        :param flush_every: Number of buffered records that triggers a write to disk.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.records = {}
+        self._buffer = []
+        # Images are recorded from the writer threads
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        # Cut off a partially written last line so new records start on a clean line
+        valid_end = data.rfind(b"\n") + 1
+        if valid_end < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+
+        for line in data[:valid_end].splitlines():
+            if line.strip():
+                record = json.loads(line)
+                self.records[record["output_path"]] = record
+
+    def is_complete(self, record: dict) -> bool:
+        """Return True if the image described by `record` exists and is intact."""
+        existing = self.records.get(record["output_path"])
+        if existing is None or any(existing.get(k) != v for k, v in record.items()):
+            return False
+        try:
+            return os.path.getsize(record["output_path"]) == existing["bytes"]
+        except OSError:
+            return False
+
+    def add(self, record: dict):
+        """Record an image once its file is fully written."""
+        record = {**record, "bytes": os.path.getsize(record["output_path"])}
+        with self._lock:
+            self.records[record["output_path"]] = record
+            self._buffer.append(record)
+            if len(self._buffer) >= self.flush_every:
+                self._flush()
+
+    def flush(self):
+        """Append the buffered records to the file and sync them to disk."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        lines = "".join(json.dumps(record) + "\n" for record in self._buffer)
+        with open(self.path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def plan_generation(groups, output_paths, manifest, base_seed, settings):
+    """
+    Decide what is left to generate: every image whose output is not complete.
+    Images of a duplicate caption group stay next to each other, so their prompt
+    embeddings are encoded once and then found in the embedding cache.
+    :param groups: List of (normalized prompt, [image_path, ...]), see group_prompts.
+    :param output_paths: Dictionary {image_path: output_path}.
+    :param manifest: GenerationManifest of the output folder.
+    :param base_seed: Seed of the run, or None for random images.
+    :param settings: Generation settings recorded with every image.
+    :return: Tuple (jobs, skipped) with jobs a list of (prompt, seed, image_path).
+    """
+    jobs, skipped = [], 0
+    for prompt, img_paths in groups:
+        for path in img_paths:
+            seed = item_seed(base_seed, prompt, path)
+            record = make_record(path, output_paths[path], prompt, seed, settings)
+            if manifest.is_complete(record):
+                skipped += 1
+            else:
+                jobs.append((prompt, seed, path))
+    return jobs, skipped
+
+
+def _write_output(
+    writer, image, prompt, seed, img_path, output_paths, manifest, settings
+):
+    writer.save(image, output_paths[img_path])
+    manifest.add(make_record(img_path, output_paths[img_path], prompt, seed, settings))
+
+
+def save_output(
+    writer, image, prompt, seed, img_path, output_paths, manifest, settings
+):
+    """
+    Hand a generated image to the writer, which saves it and records it in the manifest
+    once written.
+    :param writer: ImageWriter doing the encoding, in the background unless it has no workers.
+    """
+    writer.submit(
+        _write_output,
+        writer,
+        image,
+        prompt,
+        seed,
+        img_path,
+        output_paths,
+        manifest,
+        settings,
+    )
@@ -0,0 +1,183 @@
+import contextlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from PIL import Image
+
+# Image format -> file extension
+EXTENSIONS = {"png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+
+
+def _writable_format(extension: str):
+    """Pillow format name Pillow can write for a file extension, or None."""
+    image_format = Image.registered_extensions().get(extension.lower())
+    return image_format if image_format in Image.SAVE else None
+
+
+class ImageWriter:
+    """
+    Background stage that encodes and writes generated images while the next batch is
+    denoised. Images are handed to a thread pool (Pillow releases the GIL while
+    encoding) behind a bounded number of pending writes, so a slow disk or encoder
+    slows generation down instead of filling memory with decoded images.
+    """
+
+    def __init__(
+        self,
+        image_format: str = None,
+        num_workers: int = 2,
+        max_pending: int = 8,
+        png_compress_level: int = 6,
+        jpeg_quality: int = 95,
+        webp_quality: int = 90,
+        webp_lossless: bool = False,
+    ):
+        """
+        :param image_format: png, webp or jpeg; None keeps the format of each output path's
+                             extension (the input image's).
+        :param num_workers: Encoding threads; 0 writes synchronously in the caller.
+        :param max_pending: Images submitted but not written yet before submit blocks.
+        :param png_compress_level: zlib level 0-9 (lower is faster and larger).
+        :param jpeg_quality: JPEG quality 1-95.
+        :param webp_quality: WebP quality 0-100.
+        :param webp_lossless: Write lossless WebP.
+        """
+        if image_format is not None and image_format not in EXTENSIONS:
+            raise ValueError(
+                f"Unknown image format {image_format}, expected one of {list(EXTENSIONS)}"
+            )
+        self.image_format = image_format
+        self.num_workers = num_workers
+        self.png_compress_level = png_compress_level
+        self.jpeg_quality = jpeg_quality
+        self.webp_quality = webp_quality
+        self.webp_lossless = webp_lossless
+
+        self._executor = (
+            ThreadPoolExecutor(num_workers, thread_name_prefix="image-writer")
+            if num_workers > 0
+            else None
+        )
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._futures = set()
+        self._lock = threading.Lock()
+
+    def output_path(self, path: str) -> str:
+        """
+        Give an output path the extension of the configured format. Without one, a path
+        whose extension Pillow cannot write (or that has none) gets .png.
+        """
+        base, extension = os.path.splitext(path)
+        if self.image_format is not None:
+            return base + EXTENSIONS[self.image_format]
+        if _writable_format(extension) is None:
+            return base + EXTENSIONS["png"]
+        return path
+
+    def save_options(self, path: str) -> dict:
+        extension = os.path.splitext(path)[1].lower()
+        image_format = self.image_format or {
+            ".png": "png",
+            ".webp": "webp",
+            ".jpg": "jpeg",
+            ".jpeg": "jpeg",
+        }.get(extension)
+        if image_format == "png":
+            return {"format": "PNG", "compress_level": self.png_compress_level}
+        if image_format == "jpeg":
+            return {"format": "JPEG", "quality": self.jpeg_quality}
+        if image_format == "webp":
+            return {
+                "format": "WEBP",
+                "quality": self.webp_quality,
+                "lossless": self.webp_lossless,
+            }
+        # Other formats (BMP, TIFF, ...) with Pillow's defaults; the format must be
+        # explicit, as the temporary file's extension does not name it. Paths with an
+        # unknown or no extension are written as PNG (output_path renames them)
+        image_format = _writable_format(extension)
+        if image_format is None:
+            return {"format": "PNG", "compress_level": self.png_compress_level}
+        return {"format": image_format}
+
+    def save(self, image, path: str):
+        """Encode and write one image (in the calling thread)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Write to a temporary file first so a crash never leaves a truncated image
+        tmp_path = f"{path}.tmp"
+        image.save(tmp_path, **self.save_options(path))
+        os.replace(tmp_path, path)
+
+    def submit(self, fn, *args):
+        """
+        Run `fn(*args)` (typically a save followed by bookkeeping) on a writer thread.
+        Blocks while `max_pending` writes are already waiting. A write error is raised by
+        the next submit or flush, once.
+        """
+        if self._executor is None:
+            fn(*args)
+            return
+
+        self._raise_failed()
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self._slots.release()
+        if future.exception() is None:
+            with self._lock:
+                self._futures.discard(future)
+
+    def _raise_failed(self):
+        with self._lock:
+            failed = [f for f in self._futures if f.done() and f.exception()]
+            self._futures.difference_update(failed)
+        if failed:
+            raise failed[0].exception()
+
+    def flush(self, raise_errors: bool = True):
+        """
+        Wait until every submitted image is written; raise the first write error.
+        :param raise_errors: False to drop the write errors, e.g. when another error is
+                             already being raised.
+        """
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures)
+        with self._lock:
+            self._futures.difference_update(futures)
+        errors = [future.exception() for future in futures if future.exception()]
+        if errors and raise_errors:
+            raise errors[0]
+
+    @contextlib.contextmanager
+    def scope(self):
+        """
+        One run of a writer that outlives it (e.g. one generation job of a runner): on
+        exit every image submitted is written, and its write errors are raised here
+        instead of by the next run.
+        """
+        try:
+            yield self
+        except BaseException:
+            self.flush(raise_errors=False)
+            raise
+        self.flush()
+
+    def close(self, raise_errors: bool = True):
+        try:
+            self.flush(raise_errors)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # A write error must not hide the error that ended the block
+        self.close(raise_errors=exc_type is None)
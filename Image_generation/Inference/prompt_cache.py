@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse runs of whitespace and strip the ends, so trivially different captions match."""
+    return " ".join(prompt.split())
+
+
+def encoder_id(pipe) -> str:
+    """Identify the text encoders of a pipeline by its class, model and dtype."""
+    return f"{type(pipe).__name__}:{pipe.name_or_path}:{pipe.dtype}"
+
+
+def group_prompts(items):
+    """
+    Normalize the captions and group the ones that are identical after normalize_prompt.
+    :param items: List of (image_path, prompt).
+    :return: List of (normalized prompt, [image_path, ...]) in first-seen order.
+    """
+    groups = OrderedDict()
+    for img_path, prompt in items:
+        groups.setdefault(normalize_prompt(prompt), []).append(img_path)
+    return list(groups.items())
+
+
+class PromptEmbeddingCache:
+    """
+    Cache of per-prompt text encoder outputs, keyed by the normalized prompt and the
+    encoder identity. Recently used embeddings are kept in memory (on the pipeline's
+    device) up to `max_entries`; with a `cache_dir` every embedding is also stored on
+    disk, so later runs skip the text encoders as well.
+    """
+
+    def __init__(self, encoder_id: str, max_entries: int = 256, cache_dir: str = None):
+        """
+        :param encoder_id: Identity of the text encoders (see encoder_id), part of every key.
+        :param max_entries: Number of prompts kept in memory.
+        :param cache_dir: Optional folder for the on-disk store.
+        """
+        self.encoder_id = encoder_id
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.encode_seconds = 0.0
+
+    def make_key(self, prompt: str) -> str:
+        data = json.dumps({"encoder": self.encoder_id, "prompt": prompt})
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pt")
+
+    def _get(self, key: str, device):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir and os.path.exists(self._path(key)):
+            import torch
+
+            value = tuple(t.to(device) for t in torch.load(self._path(key)))
+            self._remember(key, value)
+            return value
+        return None
+
+    def _remember(self, key: str, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _store(self, key: str, value):
+        self._remember(key, value)
+        if self.cache_dir:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            import torch
+
+            torch.save(tuple(t.cpu() for t in value), tmp_path)
+            os.replace(tmp_path, path)
+
+    def get_or_encode(self, prompts, encode_fn, device=None):
+        """
+        Return the embeddings of each prompt, encoding only the ones not in the cache.
+        :param prompts: List of normalized prompts.
+        :param encode_fn: Function mapping a list of prompts to a tuple of batched tensors
+                          (first dimension = prompt), called once with all the misses.
+        :param device: Device the disk-cached embeddings are moved to.
+        :return: List with one tuple of per-prompt tensors for each prompt.
+        """
+        keys = [self.make_key(prompt) for prompt in prompts]
+        found = {key: self._get(key, device) for key in set(keys)}
+        missing = [key for key, value in found.items() if value is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            missing_prompts = [prompts[keys.index(key)] for key in missing]
+            start_time = time.perf_counter()
+            batched = encode_fn(missing_prompts)
+            self.encode_seconds += time.perf_counter() - start_time
+            for i, key in enumerate(missing):
+                # Clone so a cached prompt does not keep its whole batch alive
+                found[key] = tuple(t[i].clone() for t in batched)
+                self._store(key, found[key])
+
+        return [found[key] for key in keys]
+
+    def time_saved(self) -> float:
+        """Estimated text encoder time saved: hits times the mean encode time per prompt."""
+        if not self.misses:
+            return 0.0
+        return self.hits * self.encode_seconds / self.misses
+
+    def stats(self) -> dict:
+        return {
+            "embedding_cache_hits": self.hits,
+            "embedding_cache_misses": self.misses,
+            "embedding_seconds_saved": self.time_saved(),
+        }
+
+
+def stack_embeddings(embeddings):
+    """Stack a list of per-prompt tensor tuples back into batched tensors."""
+    import torch
+
+    return tuple(torch.stack(tensors) for tensors in zip(*embeddings))
@@ -0,0 +1,294 @@
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import toml
+
+# The model registry is shared with the captioning code in data_generation/common
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "data_generation"
+    )
+)
+
+from common.model_registry import shared_registry  # noqa: E402
+from image_writer import ImageWriter  # noqa: E402
+from prompt_cache import PromptEmbeddingCache, encoder_id  # noqa: E402
+
+# Backend name -> (module, pipeline loader, keyword the loaded pipeline is passed as,
+#                  whether generation takes a prompt embedding cache and an image writer)
+BACKENDS = {
+    "sd2": ("sd_2", "load_pipeline", "pipe", True),
+    "sdxl": ("sd_xl", "load_pipelines", "pipelines", True),
+    "flux": ("dff", "load_pipeline", "pipe", True),
+}
+
+
+class GenerationRunner:
+    """
+    Long-lived text-to-image worker. Backend modules are imported and their pipelines
+    loaded on first use, then kept in the process-wide model registry, so generating
+    from many caption files pays each load only once. Under a memory budget the least
+    recently used pipelines (or captioning models of other jobs in the process) are
+    unloaded to make room, and loaded again when needed.
+    Startup (importing torch/diffusers and the backend), pipeline loading and generation
+    are timed separately.
+    """
+
+    def __init__(
+        self,
+        device: str = "cuda",
+        embedding_cache_dir: str = None,
+        embedding_cache_size: int = 256,
+        output_options: dict = None,
+        memory_budgets_mb: dict = None,
+        memory_estimates_mb: dict = None,
+    ):
+        """
+        :param device: Device the pipelines are loaded on.
+        :param embedding_cache_dir: Optional folder storing prompt embeddings across runs.
+        :param embedding_cache_size: Prompt embeddings kept in memory per pipeline.
+        :param output_options: ImageWriter arguments (format, compression, workers).
+        :param memory_budgets_mb: {device type: MB} the loaded models must fit in,
+                                  e.g. {"cuda": 22000, "cpu": 48000}.
+        :param memory_estimates_mb: {backend: MB} expected size of a pipeline, so room is
+                                    made before its first load.
+        """
+        self.device = device
+        self.embedding_cache_dir = embedding_cache_dir
+        self.embedding_cache_size = embedding_cache_size
+        self.models = shared_registry(memory_budgets_mb)
+        self.memory_estimates_mb = memory_estimates_mb or {}
+        self.embedding_caches = {}
+        self.writer = ImageWriter(**(output_options or {}))
+        self.startup_seconds = 0.0
+        self.load_seconds = 0.0
+        self.generation_seconds = 0.0
+        self.images = 0
+        self.embedding_cache_hits = 0
+        self.seconds_saved = 0.0
+
+    def backend(self, name: str):
+        """Import (once) and return the module implementing a backend."""
+        if name not in BACKENDS:
+            raise ValueError(
+                f"Unknown backend {name}, expected one of {list(BACKENDS)}"
+            )
+        module_name = BACKENDS[name][0]
+        start_time = time.perf_counter()
+        module = importlib.import_module(module_name)
+        # Backend modules defer torch and diffusers to their loaders; count them as startup
+        importlib.import_module("torch")
+        importlib.import_module("diffusers")
+        self.startup_seconds += time.perf_counter() - start_time
+        return module
+
+    def pipeline_key(self, name: str, **model_options) -> str:
+        """
+        Register a backend's pipeline with the model registry (without loading it).
+        :param name: Backend name (sd2, sdxl, flux).
+        :param model_options: Loader arguments, e.g. model_id; part of the key.
+        :return: The registry key of the pipeline.
+        """
+        key = f"{name}:{json.dumps(model_options, sort_keys=True)}:{self.device}"
+        if key not in self.models:
+            module = self.backend(name)
+            loader = getattr(module, BACKENDS[name][1])
+
+            def load():
+                start_time = time.perf_counter()
+                pipe = loader(device=self.device, **model_options)
+                self.load_seconds += time.perf_counter() - start_time
+                return pipe
+
+            self.models.register(
+                key,
+                load,
+                device=self.device,
+                estimate_mb=self.memory_estimates_mb.get(name),
+            )
+        return key
+
+    def pipeline(self, name: str, **model_options):
+        """
+        Return the loaded pipeline of a backend, loading it if it is not loaded.
+        :param name: Backend name (sd2, sdxl, flux).
+        :param model_options: Loader arguments, e.g. model_id; part of the cache key.
+        """
+        return self.models.get(self.pipeline_key(name, **model_options))
+
+    def embedding_cache(self, pipe) -> PromptEmbeddingCache:
+        """
+        Return the prompt embedding cache of a loaded pipeline, shared by all its runs.
+        :param pipe: The pipeline, or the (base, refiner) tuple of SDXL whose base encodes.
+        """
+        if isinstance(pipe, tuple):
+            pipe = pipe[0]
+        # Keyed by the encoder class, model and dtype, so a changed dtype or pipeline
+        # class does not reuse embeddings of the old one
+        key = encoder_id(pipe)
+        if key not in self.embedding_caches:
+            self.embedding_caches[key] = PromptEmbeddingCache(
+                key,
+                max_entries=self.embedding_cache_size,
+                cache_dir=self.embedding_cache_dir,
+            )
+        return self.embedding_caches[key]
+
+    def generate_images_from_json(
+        self, json_path, output_folder, backend="sdxl", model_options=None, **options
+    ):
+        """
+        Generate one image per caption of a caption file with the given backend.
+        :param json_path: output.json with {"captions": {image_path: caption}}.
+        :param output_folder: Folder to save the generated images to.
+        :param backend: Backend name (sd2, sdxl, flux).
+        :param model_options: Loader arguments, e.g. model_id.
+        :param options: Extra arguments of the backend's generate_images_from_json.
+        :return: The backend's run statistics.
+        """
+        model_options = model_options or {}
+        key = self.pipeline_key(backend, **model_options)
+        module = self.backend(backend)
+        # The pipeline cannot be evicted while it generates, and is not referenced after
+        with self.models.pinned(key):
+            pipe = self.models.get(key)
+            if BACKENDS[backend][3]:
+                options.setdefault("embedding_cache", self.embedding_cache(pipe))
+                options.setdefault("writer", self.writer)
+            stats = module.generate_images_from_json(
+                json_path,
+                output_folder,
+                **{BACKENDS[backend][2]: pipe},
+                **options,
+            )
+        self.generation_seconds += stats["seconds"]
+        self.images += stats["images"]
+        self.embedding_cache_hits += stats.get("embedding_cache_hits", 0)
+        self.seconds_saved += stats.get("seconds_saved", 0.0)
+        return stats
+
+    def close(self):
+        """Wait for the images still being written."""
+        self.writer.close()
+
+    def summary(self) -> dict:
+        return {
+            "startup_seconds": self.startup_seconds,
+            "load_seconds": self.load_seconds,
+            "generation_seconds": self.generation_seconds,
+            "images": self.images,
+            "seconds_per_image": (
+                self.generation_seconds / self.images if self.images else 0.0
+            ),
+            "embedding_cache_hits": self.embedding_cache_hits,
+            "seconds_saved": self.seconds_saved,
+            "model_evictions": self.models.evictions,
+        }
+
+
+# Process-wide runner, so pipelines loaded by one call are reused by the next
+_runner = None
+
+
+def get_runner(device: str = "cuda", **runner_options) -> GenerationRunner:
+    """Return the process-wide runner, creating it on first use or when the device changes."""
+    global _runner
+    if _runner is None or _runner.device != device:
+        _runner = GenerationRunner(device, **runner_options)
+    elif runner_options.get("memory_budgets_mb"):
+        # A later config's budgets apply to the registry the runner already shares
+        shared_registry(runner_options["memory_budgets_mb"])
+    return _runner
+
+
+def generate_images_from_json(
+    json_path, output_folder, backend="sdxl", device="cuda", **options
+):
+    """
+    Generate images from a caption file with the process-wide runner.
+    See GenerationRunner.generate_images_from_json.
+    """
+    return get_runner(device).generate_images_from_json(
+        json_path, output_folder, backend, **options
+    )
+
+
+def default_output_folder(output_root: str, json_path: str) -> str:
+    """
+    Mirror the last two folders of a caption file under output_root, e.g.
+    .../desiboys_captions/llama3.2-vision/output.json -> output_root/desiboys_captions/llama3.2-vision
+    """
+    model_folder = os.path.dirname(os.path.abspath(json_path))
+    dataset_folder = os.path.dirname(model_folder)
+    return os.path.join(
+        output_root, os.path.basename(dataset_folder), os.path.basename(model_folder)
+    )
+
+
+def run_from_config(config_path: str, backend: str = None, json_paths=None):
+    """
+    Generate images for every caption file of a config with the process-wide runner.
+    :param config_path: TOML config file.
+    :param backend: Backend overriding the config's.
+    :param json_paths: Caption files overriding the config's list.
+    """
+    process_start = time.perf_counter()
+    config = toml.load(config_path)
+    settings = config["Generation"]
+    backend = backend or settings["backend"]
+    json_paths = json_paths or settings["json_paths"]
+    output_root = settings.get("output_root", os.path.join("generated_output", backend))
+    model_options = config.get("Model", {}).get(backend, {})
+    options = config.get("Options", {}).get(backend, {})
+
+    memory = config.get("Memory", {})
+    runner = get_runner(
+        settings.get("device", "cuda"),
+        embedding_cache_dir=settings.get("embedding_cache_dir"),
+        embedding_cache_size=settings.get("embedding_cache_size", 256),
+        output_options=config.get("Output"),
+        memory_budgets_mb=memory.get("budgets_mb"),
+        memory_estimates_mb=memory.get("estimates_mb"),
+    )
+    for json_path in json_paths:
+        output_folder = default_output_folder(output_root, json_path)
+        stats = runner.generate_images_from_json(
+            json_path, output_folder, backend, model_options, **options
+        )
+        print(
+            f"{json_path}: {stats['images']} images in {stats['seconds']:.1f}s -> {output_folder}"
+        )
+
+    runner.close()
+    summary = runner.summary()
+    print(
+        f"Startup {summary['startup_seconds']:.1f}s, "
+        f"load {summary['load_seconds']:.1f}s, "
+        f"generation {summary['generation_seconds']:.1f}s for {summary['images']} images "
+        f"({summary['seconds_per_image']:.2f}s per image), "
+        f"{summary['embedding_cache_hits']} prompt embedding cache hits, "
+        f"~{summary['seconds_saved']:.1f}s saved by caching and deduplication, "
+        f"{summary['model_evictions']} models evicted, "
+        f"total {time.perf_counter() - process_start:.1f}s."
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate images from one or more caption files."
+    )
+    parser.add_argument("--config", default="config.toml", help="TOML config file.")
+    parser.add_argument("--backend", help="Override the backend (sd2, sdxl, flux).")
+    parser.add_argument(
+        "json_paths", nargs="*", help="Caption files, instead of the config's list."
+    )
+    args = parser.parse_args()
+    run_from_config(args.config, args.backend, args.json_paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,173 @@
-import json
 import os
-import torch
-from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler
+import time
 from tqdm import tqdm
 
-# Load Stable Diffusion 2 model
-model_id = "stabilityai/stable-diffusion-2"
-scheduler = EulerDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
-pipe = StableDiffusionPipeline.from_pretrained(
-    model_id, scheduler=scheduler, torch_dtype=torch.float16
+from caption_source import load_captions, sorted_items
+from generation_manifest import (
+    GenerationManifest,
+    mirrored_output_paths,
+    plan_generation,
+    save_output,
 )
-pipe = pipe.to("cuda")
+from image_writer import ImageWriter
+from prompt_cache import PromptEmbeddingCache, encoder_id, group_prompts
+
+# Stable Diffusion 2 model
+model_id = "stabilityai/stable-diffusion-2"
 
 # Parameters
 n_steps = 50
 
 
-def generate_images_from_json(json_path, output_folder):
-    with open(json_path, "r") as file:
-        data = json.load(file)
+def load_pipeline(model_id=model_id, device="cuda"):
+    """
+    Load the Stable Diffusion 2 pipeline with an Euler scheduler.
+    :param model_id: Hugging Face model ID or local folder.
+    :param device: Device to move the pipeline to.
+    :return: The pipeline.
+    """
+    # torch and diffusers take seconds to import: only load them once a pipeline is needed
+    import torch
+    from diffusers import EulerDiscreteScheduler, StableDiffusionPipeline
+
+    scheduler = EulerDiscreteScheduler.from_pretrained(model_id, subfolder="scheduler")
+    pipe = StableDiffusionPipeline.from_pretrained(
+        model_id, scheduler=scheduler, torch_dtype=torch.float16
+    )
+    return pipe.to(device)
+
 
-    captions = data["captions"]
+def encode_prompt(pipe, prompt, cache: PromptEmbeddingCache, negative):
+    """
+    :param prompt: Normalized prompt.
+    :param cache: Prompt embedding cache.
+    :param negative: Negative (empty prompt) embeddings, the same for every prompt.
+    :return: Embedding arguments for the pipeline.
+    """
+    import torch
 
-    # Sort image paths
-    sorted_image_paths = sorted(captions.keys())
+    device = pipe._execution_device
+    with torch.inference_mode():
+        (prompt_embeds,) = cache.get_or_encode(
+            [prompt],
+            lambda prompts: pipe.encode_prompt(prompts, device, 1, False)[:1],
+            device,
+        )[0]
+    return {
+        "prompt_embeds": prompt_embeds[None],
+        "negative_prompt_embeds": negative,
+    }
+
+
+def generate_images_from_json(
+    json_path,
+    output_folder,
+    pipe=None,
+    seed=0,
+    embedding_cache=None,
+    manifest_path=None,
+    writer=None,
+):
+    """
+    Generate one image per caption.
+    Every image gets a seed derived from `seed`, its caption and its path, so captions
+    that are identical after normalization still give different images; only their
+    prompt embeddings are shared. Outputs mirror the input folders under output_folder
+    and are recorded in a manifest; a rerun skips complete images.
+    :param json_path: output.json with {"captions": {image_path: caption}}, or a
+                      columnar caption store folder.
+    :param output_folder: Folder to save the generated images to.
+    :param pipe: Loaded pipeline, defaults to load_pipeline().
+    :param seed: Base seed of the run, or None for random images.
+    :param embedding_cache: PromptEmbeddingCache to reuse across runs, e.g. with a disk store.
+    :param manifest_path: Generation manifest, defaults to manifest.jsonl in output_folder.
+    :param writer: ImageWriter encoding and saving images in the background while the next
+                   image is generated, defaults to one that keeps each input's format.
+    :return: Dictionary with the number of images, seconds taken, images per minute,
+             skipped images, duplicate captions, embedding cache hits and estimated
+             seconds saved.
+    """
+    # output.json, or a memory-mapped columnar caption store
+    captions = load_captions(json_path)
+
+    # Sort image paths (a columnar store is already sorted)
+    items = list(sorted_items(captions))
+    sorted_image_paths = [img_path for img_path, _ in items]
+    groups = group_prompts(items)
+    own_writer = writer is None
+    writer = writer or ImageWriter()
+    output_paths = {
+        img_path: writer.output_path(output_path)
+        for img_path, output_path in mirrored_output_paths(
+            sorted_image_paths, output_folder
+        ).items()
+    }
+
+    import torch
 
     os.makedirs(output_folder, exist_ok=True)
 
-    for img_path in tqdm(sorted_image_paths, desc="Generating images"):
-        prompt = captions[img_path]
+    pipe = pipe or load_pipeline()
+    cache = embedding_cache or PromptEmbeddingCache(encoder_id(pipe))
+    hits_before, saved_before = cache.hits, cache.time_saved()
+    with torch.inference_mode():
+        _, negative = pipe.encode_prompt([""], pipe._execution_device, 1, True)
+    settings = {"model": pipe.name_or_path, "steps": n_steps}
+
+    start_time = time.perf_counter()
+    # The writer is flushed (or closed) before the manifest, so every written image is recorded
+    with GenerationManifest(
+        manifest_path or os.path.join(output_folder, "manifest.jsonl")
+    ) as manifest, (writer if own_writer else writer.scope()):
+        jobs, skipped = plan_generation(groups, output_paths, manifest, seed, settings)
+        for prompt, item_seed, img_path in tqdm(jobs, desc="Generating images"):
+            # Generate image
+            image = pipe(
+                **encode_prompt(pipe, prompt, cache, negative),
+                num_inference_steps=n_steps,
+                generator=(
+                    None
+                    if item_seed is None
+                    else torch.Generator("cpu").manual_seed(item_seed)
+                ),
+            ).images[0]
 
-        # Generate image
-        image = pipe(prompt=prompt, num_inference_steps=n_steps).images[0]
+            # Save the generated image
+            save_output(
+                writer,
+                image,
+                prompt,
+                item_seed,
+                img_path,
+                output_paths,
+                manifest,
+                settings,
+            )
 
-        # Prepare output path
-        image_filename = os.path.basename(img_path)
-        output_path = os.path.join(output_folder, image_filename)
+        writer.flush()
 
-        # Save the generated image
-        image.save(output_path)
+    seconds = time.perf_counter() - start_time
+    written = len(items) - skipped
+    images_per_min = written / seconds * 60 if seconds > 0 else 0.0
+    duplicates = len(jobs) - len({prompt for prompt, _, _ in jobs})
+    cache_hits = cache.hits - hits_before
+    seconds_saved = cache.time_saved() - saved_before
+    print(
+        f"Generated {len(jobs)} images for {len(items)} captions in {seconds:.1f}s "
+        f"({images_per_min:.1f} images/min): {skipped} already complete, "
+        f"{duplicates} with a duplicate caption, "
+        f"{cache_hits} prompt embedding cache hits, ~{seconds_saved:.1f}s saved."
+    )
+    return {
+        "images": len(items),
+        "seconds": seconds,
+        "images_per_min": images_per_min,
+        "generated": len(jobs),
+        "skipped": skipped,
+        "duplicates": duplicates,
+        "embedding_cache_hits": cache_hits,
+        "seconds_saved": seconds_saved,
+    }
 
 
 if __name__ == "__main__":
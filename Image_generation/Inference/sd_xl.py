@@ -1,68 +1,387 @@
-import json
+import contextlib
 import os
-import torch
-from diffusers import DiffusionPipeline
+import queue
+import threading
+import time
 from tqdm import tqdm
 from PIL import Image
 
-# Load Stable Diffusion XL base and refiner
-base = DiffusionPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-base-1.0",
-    torch_dtype=torch.float16,
-    variant="fp16",
-    use_safetensors=True,
-).to("cuda")
-
-refiner = DiffusionPipeline.from_pretrained(
-    "stabilityai/stable-diffusion-xl-refiner-1.0",
-    text_encoder_2=base.text_encoder_2,
-    vae=base.vae,
-    torch_dtype=torch.float16,
-    variant="fp16",
-    use_safetensors=True,
-).to("cuda")
+from caption_source import load_captions, sorted_items
+from generation_manifest import (
+    GenerationManifest,
+    mirrored_output_paths,
+    plan_generation,
+    save_output,
+)
+from image_writer import ImageWriter
+from prompt_cache import (
+    PromptEmbeddingCache,
+    encoder_id,
+    group_prompts,
+    stack_embeddings,
+)
 
 # Parameters
 n_steps = 40
 high_noise_frac = 0.8
 
+# Stable Diffusion XL base and refiner models
+base_model_id = "stabilityai/stable-diffusion-xl-base-1.0"
+refiner_model_id = "stabilityai/stable-diffusion-xl-refiner-1.0"
 
-def generate_images_from_json(json_path, output_folder):
-    with open(json_path, "r") as file:
-        data = json.load(file)
 
-    captions = data["captions"]
+def load_pipelines(
+    base_model_id=base_model_id, refiner_model_id=refiner_model_id, device="cuda"
+):
+    """
+    Load Stable Diffusion XL base and refiner.
+    The refiner shares the base's second text encoder and VAE.
+    :param base_model_id: Hugging Face model ID or local folder of the base.
+    :param refiner_model_id: Hugging Face model ID or local folder of the refiner.
+    :param device: Device to move both pipelines to.
+    :return: Tuple (base, refiner).
+    """
+    # Deferred to load time, so importing this module does not pull in torch
+    import torch
+    from diffusers import DiffusionPipeline
 
-    # Sort image paths
-    sorted_image_paths = sorted(captions.keys())
+    base = DiffusionPipeline.from_pretrained(
+        base_model_id,
+        torch_dtype=torch.float16,
+        variant="fp16",
+        use_safetensors=True,
+    ).to(device)
+
+    refiner = DiffusionPipeline.from_pretrained(
+        refiner_model_id,
+        text_encoder_2=base.text_encoder_2,
+        vae=base.vae,
+        torch_dtype=torch.float16,
+        variant="fp16",
+        use_safetensors=True,
+    ).to(device)
+    return base, refiner
+
+
+class PromptEncoder:
+    """
+    Encode a batch of prompts once for both SDXL stages.
+    The base conditions on [text_encoder hidden states, text_encoder_2 hidden states]
+    concatenated on the last axis, the refiner on the text_encoder_2 part only, and both
+    use the pooled text_encoder_2 output. The refiner's embeddings are therefore a slice
+    of the base's. Prompt embeddings go through a PromptEmbeddingCache; the negative
+    (empty prompt) embeddings of both stages do not depend on the prompt and are encoded
+    only once.
+    """
+
+    def __init__(self, base, refiner, cache: PromptEmbeddingCache = None):
+        """
+        :param base: SDXL base pipeline.
+        :param refiner: SDXL refiner pipeline sharing the base's text_encoder_2.
+        :param cache: Prompt embedding cache, defaults to an in-memory one for this encoder.
+        """
+        self.base = base
+        self.refiner = refiner
+        self.cache = cache or PromptEmbeddingCache(encoder_id(base))
+        self.text_encoder_2_dim = base.text_encoder_2.config.hidden_size
+        self._negatives = None
+
+    def negatives(self, device):
+        """Return the base and refiner negative embeddings, encoding them on first use."""
+        if self._negatives is None:
+            _, base_negative, _, base_negative_pooled = self.base.encode_prompt(
+                prompt="", device=device, do_classifier_free_guidance=True
+            )
+            _, refiner_negative, _, refiner_negative_pooled = (
+                self.refiner.encode_prompt(
+                    prompt="", device=device, do_classifier_free_guidance=True
+                )
+            )
+            self._negatives = (
+                (base_negative, base_negative_pooled),
+                (refiner_negative, refiner_negative_pooled),
+            )
+        return self._negatives
+
+    def _encode_prompts(self, prompts):
+        prompt_embeds, _, pooled_prompt_embeds, _ = self.base.encode_prompt(
+            prompt=prompts,
+            device=self.base._execution_device,
+            do_classifier_free_guidance=False,
+        )
+        return prompt_embeds, pooled_prompt_embeds
+
+    def encode(self, prompts):
+        """
+        :param prompts: List of normalized prompts.
+        :return: Tuple (base_kwargs, refiner_kwargs) of embedding arguments for the pipelines.
+        """
+        import torch
+
+        with torch.inference_mode():
+            return self._encode(prompts)
+
+    def _encode(self, prompts):
+        device = self.base._execution_device
+        prompt_embeds, pooled_prompt_embeds = stack_embeddings(
+            self.cache.get_or_encode(prompts, self._encode_prompts, device)
+        )
+        (base_negative, base_negative_pooled), (
+            refiner_negative,
+            refiner_negative_pooled,
+        ) = self.negatives(device)
+        batch = len(prompts)
+
+        base_kwargs = {
+            "prompt_embeds": prompt_embeds,
+            "negative_prompt_embeds": base_negative.expand(batch, -1, -1),
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": base_negative_pooled.expand(batch, -1),
+        }
+        refiner_kwargs = {
+            "prompt_embeds": prompt_embeds[..., -self.text_encoder_2_dim :],
+            "negative_prompt_embeds": refiner_negative.expand(batch, -1, -1),
+            "pooled_prompt_embeds": pooled_prompt_embeds,
+            "negative_pooled_prompt_embeds": refiner_negative_pooled.expand(batch, -1),
+        }
+        return base_kwargs, refiner_kwargs
+
+
+def _batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start : start + batch_size]
+
+
+def _generators(batch):
+    """One seeded generator per image, so an image does not depend on its batch."""
+    import torch
+
+    if any(seed is None for _, seed, _ in batch):
+        return None
+    return [torch.Generator("cpu").manual_seed(seed) for _, seed, _ in batch]
+
+
+def _base_stage(base, encoder, batches, stream=None):
+    """
+    Run the base on every batch and yield (batch, latents, refiner embedding arguments,
+    ready event). With a CUDA stream, the base's kernels are queued on it, and the event
+    is recorded on it once the batch's latents are computed (None without a stream).
+    """
+    import torch
+
+    for batch in batches:
+        with torch.cuda.stream(stream) if stream else contextlib.nullcontext():
+            base_kwargs, refiner_kwargs = encoder.encode(
+                [prompt for prompt, _, _ in batch]
+            )
+            latents = base(
+                **base_kwargs,
+                num_inference_steps=n_steps,
+                denoising_end=high_noise_frac,
+                output_type="latent",
+                generator=_generators(batch),
+            ).images
+            ready = torch.cuda.Event() if stream else None
+            if ready:
+                ready.record(stream)
+        yield batch, latents, refiner_kwargs, ready
+
+
+def _receive(ready, latents, refiner_kwargs):
+    """
+    Make the refiner's stream wait for latents computed on the base's stream, and keep
+    the caching allocator from reusing their memory before the refiner is done with them.
+    """
+    if ready is None:
+        return
+    import torch
+
+    consumer = torch.cuda.current_stream()
+    consumer.wait_event(ready)
+    for tensor in (latents, *refiner_kwargs.values()):
+        tensor.record_stream(consumer)
+
+
+def _in_background(iterable, maxsize=1):
+    """
+    Consume an iterable in a background thread and yield its items through a bounded queue.
+    Exceptions raised by the iterable are re-raised in the consumer.
+    :param iterable: Items to produce.
+    :param maxsize: Number of produced items that may wait for the consumer.
+    """
+    handoff = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer went away, instead of blocking on a full queue forever
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+        else:
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = handoff.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def generate_images_from_json(
+    json_path,
+    output_folder,
+    batch_size=4,
+    pipelines=None,
+    overlap=True,
+    seed=0,
+    embedding_cache=None,
+    manifest_path=None,
+    writer=None,
+):
+    """
+    Generate one image per caption with the SDXL base and refiner.
+    Prompts are processed in batches. With `overlap`, the base runs in a background
+    thread and hands each batch's latents to the refiner through a one-slot queue, so
+    the refiner works on batch k while the base works on batch k+1. On CUDA the base
+    queues its kernels on a stream of its own (the refiner uses the default stream), so
+    the GPU can run both; the refiner waits for an event recorded after each batch.
+    Every image gets a seed derived from `seed`, its caption and its path, so captions
+    that are identical after normalization still give different images; only their
+    prompt embeddings are shared. Outputs mirror the input folders under output_folder
+    and are recorded in a manifest; a rerun skips complete images.
+    :param json_path: output.json with {"captions": {image_path: caption}}, or a
+                      columnar caption store folder.
+    :param output_folder: Folder to save the generated images to.
+    :param batch_size: Number of prompts generated together by each stage.
+    :param pipelines: Tuple (base, refiner), defaults to load_pipelines().
+    :param overlap: Run the base and the refiner concurrently.
+    :param seed: Base seed of the run, or None for random images.
+    :param embedding_cache: PromptEmbeddingCache to reuse across runs, e.g. with a disk store.
+    :param manifest_path: Generation manifest, defaults to manifest.jsonl in output_folder.
+    :param writer: ImageWriter encoding and saving images in the background while the next
+                   image is generated, defaults to one that keeps each input's format.
+    :return: Dictionary with the number of images, seconds taken, images per minute,
+             skipped images, duplicate captions, embedding cache hits and estimated
+             seconds saved.
+    """
+    # output.json, or a memory-mapped columnar caption store
+    captions = load_captions(json_path)
+
+    # Sort image paths (a columnar store is already sorted)
+    items = list(sorted_items(captions))
+    sorted_image_paths = [img_path for img_path, _ in items]
+    groups = group_prompts(items)
+    own_writer = writer is None
+    writer = writer or ImageWriter()
+    output_paths = {
+        img_path: writer.output_path(output_path)
+        for img_path, output_path in mirrored_output_paths(
+            sorted_image_paths, output_folder
+        ).items()
+    }
 
     os.makedirs(output_folder, exist_ok=True)
 
-    for img_path in tqdm(sorted_image_paths, desc="Generating images"):
-        prompt = captions[img_path]
-
-        # Run base
-        latent_image = base(
-            prompt=prompt,
-            num_inference_steps=n_steps,
-            denoising_end=high_noise_frac,
-            output_type="latent",
-        ).images
-
-        # Run refiner
-        final_image = refiner(
-            prompt=prompt,
-            num_inference_steps=n_steps,
-            denoising_start=high_noise_frac,
-            image=latent_image,
-        ).images[0]
-
-        # Prepare output path
-        image_filename = os.path.basename(img_path)
-        output_path = os.path.join(output_folder, image_filename)
-
-        # Save the final image
-        final_image.save(output_path)
+    base, refiner = pipelines or load_pipelines()
+    encoder = PromptEncoder(base, refiner, embedding_cache)
+    hits_before, saved_before = encoder.cache.hits, encoder.cache.time_saved()
+    settings = {
+        "model": f"{base.name_or_path}+{refiner.name_or_path}",
+        "steps": n_steps,
+        "high_noise_frac": high_noise_frac,
+    }
+
+    start_time = time.perf_counter()
+    # The writer is flushed (or closed) before the manifest, so every written image is recorded
+    with GenerationManifest(
+        manifest_path or os.path.join(output_folder, "manifest.jsonl")
+    ) as manifest, (writer if own_writer else writer.scope()):
+        jobs, skipped = plan_generation(groups, output_paths, manifest, seed, settings)
+        base_stream = None
+        if overlap and base.device.type == "cuda":
+            import torch
+
+            base_stream = torch.cuda.Stream(device=base.device)
+        base_outputs = _base_stage(
+            base, encoder, _batches(jobs, batch_size), base_stream
+        )
+        if overlap:
+            # At most one batch of latents waits for the refiner, which bounds memory
+            base_outputs = _in_background(base_outputs, maxsize=1)
+
+        with tqdm(total=len(jobs), desc="Generating images") as progress:
+            for batch, latents, refiner_kwargs, ready in base_outputs:
+                _receive(ready, latents, refiner_kwargs)
+                # Run refiner
+                final_images = refiner(
+                    **refiner_kwargs,
+                    num_inference_steps=n_steps,
+                    denoising_start=high_noise_frac,
+                    image=latents,
+                    generator=_generators(batch),
+                ).images
+
+                for (prompt, item_seed, img_path), final_image in zip(
+                    batch, final_images
+                ):
+                    # Save the final image
+                    save_output(
+                        writer,
+                        final_image,
+                        prompt,
+                        item_seed,
+                        img_path,
+                        output_paths,
+                        manifest,
+                        settings,
+                    )
+                    progress.update()
+
+        writer.flush()
+
+    seconds = time.perf_counter() - start_time
+    written = len(items) - skipped
+    images_per_min = written / seconds * 60 if seconds > 0 else 0.0
+    duplicates = len(jobs) - len({prompt for prompt, _, _ in jobs})
+    cache_hits = encoder.cache.hits - hits_before
+    seconds_saved = encoder.cache.time_saved() - saved_before
+    print(
+        f"Generated {len(jobs)} images for {len(items)} captions in {seconds:.1f}s "
+        f"({images_per_min:.1f} images/min): {skipped} already complete, "
+        f"{duplicates} with a duplicate caption, "
+        f"{cache_hits} prompt embedding cache hits, ~{seconds_saved:.1f}s saved."
+    )
+    return {
+        "images": len(items),
+        "seconds": seconds,
+        "images_per_min": images_per_min,
+        "generated": len(jobs),
+        "skipped": skipped,
+        "duplicates": duplicates,
+        "embedding_cache_hits": cache_hits,
+        "seconds_saved": seconds_saved,
+    }
 
 
 if __name__ == "__main__":
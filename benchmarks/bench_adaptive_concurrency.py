@@ -0,0 +1,118 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import toml
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "image_annotations_generation",
+    )
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from main import CaptioningPipeline  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+
+
+def run(server, image_dir, output_dir, max_in_flight, adaptive):
+    """
+    Caption every image in image_dir; return the seconds, the server-side latencies of
+    the requests and the tracer's gauges.
+    """
+    name = f"{'adaptive' if adaptive else 'fixed'}_{max_in_flight}"
+    config = {
+        "DatasetInfo": {"dataset_path": image_dir},
+        "ModelInfo": {"modelname": "llava:7b"},
+        "MetaData": {"outputpath": os.path.join(output_dir, name, "output.json")},
+        "Concurrency": {
+            "max_in_flight": max_in_flight,
+            "host": server.url,
+            "adaptive": adaptive,
+        },
+        "Tracing": {
+            "enabled": True,
+            "metrics_path": os.path.join(output_dir, name, "metrics.json"),
+        },
+    }
+    config_path = os.path.join(output_dir, f"config_{name}.toml")
+    with open(config_path, "w") as f:
+        toml.dump(config, f)
+
+    tracer.reset()
+    first = len(server.latencies)
+    pipeline = CaptioningPipeline(config_path)
+    start = time.perf_counter()
+    pipeline.process_images()
+    seconds = time.perf_counter() - start
+    latencies = sorted(server.latencies[first:])
+    return seconds, latencies, tracer.snapshot()["gauges"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare fixed and adaptive request concurrency against a fake Ollama server that degrades under load."
+    )
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument(
+        "--capacity",
+        type=int,
+        default=4,
+        help="Requests in flight the server handles before slowing down.",
+    )
+    parser.add_argument("--degrade", type=float, default=0.5)
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Latencies vary by up to this fraction independent of load (2 = 1x to 3x).",
+    )
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(
+        args.latency, capacity=args.capacity, degrade=args.degrade, jitter=args.jitter
+    )
+    with tempfile.TemporaryDirectory() as tmp, server:
+        image_dir = os.path.join(tmp, "images")
+        os.makedirs(image_dir)
+        for i in range(args.images):
+            with open(os.path.join(image_dir, f"{i:06d}.jpg"), "wb") as f:
+                f.write(os.urandom(1024))
+
+        scenarios = [(level, False) for level in args.levels]
+        scenarios.append((max(args.levels), True))
+        rows = []
+        for level, adaptive in scenarios:
+            seconds, latencies, gauges = run(server, image_dir, tmp, level, adaptive)
+            limit = gauges.get("ollama.limit")
+            rows.append(
+                (
+                    f"adaptive <= {level}" if adaptive else f"fixed {level}",
+                    seconds,
+                    latencies[len(latencies) // 2],
+                    latencies[int(len(latencies) * 0.95)],
+                    f"{limit['value']} (max {limit['max']})" if limit else "-",
+                    gauges["ollama.queue_depth"]["max"] if limit else "-",
+                )
+            )
+
+    print(
+        f"{'concurrency':>15} {'seconds':>8} {'images/s':>9} {'p50 ms':>7} {'p95 ms':>7} "
+        f"{'final limit':>14} {'max queue':>10}"
+    )
+    for label, seconds, p50, p95, limit, queue in rows:
+        print(
+            f"{label:>15} {seconds:>8.2f} {args.images / seconds:>9.1f} {p50 * 1000:>7.0f} "
+            f"{p95 * 1000:>7.0f} {limit:>14} {queue:>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
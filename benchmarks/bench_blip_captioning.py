@@ -0,0 +1,62 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation")
+)
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "image_annotations_generation",
+    )
+)
+
+from blip_caption.blip_caption import ImageCaptioningModel  # noqa: E402
+from tiny_models import make_synthetic_images, make_tiny_blip  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-image and batched BLIP captioning throughput."
+    )
+    parser.add_argument(
+        "--model",
+        default=None,
+        help="BLIP model name or folder (default: a tiny random model built on the fly).",
+    )
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_name = args.model or make_tiny_blip(os.path.join(tmp, "tiny-blip"))
+        image_paths = make_synthetic_images(os.path.join(tmp, "images"), args.images)
+        model = ImageCaptioningModel(model_name, device=args.device)
+        print(f"model={model_name} device={model.device} images={args.images}")
+
+        # Warm up allocator and kernels before timing
+        model.generate_captions_batch(image_paths[:2], batch_size=2)
+
+        start = time.perf_counter()
+        for path in image_paths:
+            model.generate_caption(path)
+        baseline = args.images / (time.perf_counter() - start)
+        print(f"{'path':>22} {'images/s':>10} {'speedup':>10}")
+        print(f"{'generate_caption':>22} {baseline:>10.2f} {1.0:>9.1f}x")
+
+        for batch_size in args.batch_sizes:
+            start = time.perf_counter()
+            model.generate_captions_batch(image_paths, batch_size=batch_size)
+            rate = args.images / (time.perf_counter() - start)
+            label = f"batch_size={batch_size}"
+            print(f"{label:>22} {rate:>10.2f} {rate / baseline:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation")
+)
+
+from common.caption_columns import (  # noqa: E402
+    ColumnarCaptions,
+    common_image_paths,
+    read_output_json,
+    write_columnar_captions,
+)
+
+MODELS = ["blip", "llava", "llama3.2-vision", "llava-llama3", "moondream", "qwen2-vl"]
+
+
+def make_outputs(directory, images, models):
+    """Write one output.json per model, each missing a random tenth of the images."""
+    rng = random.Random(0)
+    paths = [
+        f"/media/data/datasets/movies/video_{i // 1000:05d}/frames/{i % 1000:06d}.jpg"
+        for i in range(images)
+    ]
+    json_paths = []
+    for model in MODELS[:models]:
+        captions = {
+            path: f"A {model} caption of frame {i}: a man in a white shirt stands in a dim room."
+            for i, path in enumerate(paths)
+            if rng.random() > 0.1
+        }
+        os.makedirs(os.path.join(directory, model))
+        json_paths.append(os.path.join(directory, model, "output.json"))
+        with open(json_paths[-1], "w") as f:
+            json.dump({"metadata": {"model_name": model}, "captions": captions}, f)
+    return json_paths, paths
+
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process image. ru_maxrss is carried over from the parent across
+    exec on Linux, so read VmHWM when it is available.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(mode, sources, paths):
+    """Open the captions, intersect the models and look up captions; print a JSON result."""
+    start = time.perf_counter()
+    if mode == "json":
+        captions_by_model = {}
+        for json_path in sources:
+            captions_by_model.update(read_output_json(json_path))
+        columns = list(captions_by_model.values())
+    else:
+        store = ColumnarCaptions(sources[0])
+        columns = [store.column(model) for model in store.model_names]
+    open_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    common = common_image_paths(columns)
+    join_seconds = time.perf_counter() - start
+
+    rng = random.Random(1)
+    lookups = [rng.choice(paths) for _ in range(10000)]
+    start = time.perf_counter()
+    for path in lookups:
+        for column in columns:
+            column.get(path)
+    lookup_seconds = time.perf_counter() - start
+
+    print(
+        json.dumps(
+            {
+                "open_seconds": open_seconds,
+                "join_seconds": join_seconds,
+                "lookup_us": lookup_seconds / len(lookups) / len(columns) * 1e6,
+                "common": len(common),
+                "peak_rss_mb": peak_rss_mb(),
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare loading output.json dicts with a memory-mapped columnar store."
+    )
+    parser.add_argument("--images", type=int, default=200000)
+    parser.add_argument("--models", type=int, default=4)
+    parser.add_argument("--mode", choices=["json", "columnar"], help=argparse.SUPPRESS)
+    parser.add_argument("--sources", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        paths = [
+            f"/media/data/datasets/movies/video_{i // 1000:05d}/frames/{i % 1000:06d}.jpg"
+            for i in range(args.images)
+        ]
+        measure(args.mode, args.sources, paths)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_paths, _ = make_outputs(tmp, args.images, args.models)
+        store_path = os.path.join(tmp, "output.captions")
+        start = time.perf_counter()
+        captions_by_model = {}
+        for json_path in json_paths:
+            captions_by_model.update(read_output_json(json_path))
+        write_columnar_captions(store_path, captions_by_model)
+        del captions_by_model
+        print(
+            f"{args.images} images x {args.models} models, "
+            f"converted in {time.perf_counter() - start:.1f}s"
+        )
+
+        print(
+            f"{'format':>10} {'open s':>8} {'join s':>8} {'lookup us':>10} {'RSS MB':>8}"
+        )
+        for mode, sources in (("json", json_paths), ("columnar", [store_path])):
+            # A fresh process per format, so peak RSS only covers that format
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--mode", mode]
+                + ["--images", str(args.images), "--sources", *sources],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output)
+            print(
+                f"{mode:>10} {result['open_seconds']:>8.2f} {result['join_seconds']:>8.3f} "
+                f"{result['lookup_us']:>10.2f} {result['peak_rss_mb']:>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "multi_image_caption_analysis",
+    )
+)
+
+from caption_similarity import CaptionAgreement  # noqa: E402
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from get_better_prompt import AgreedComparison, CaptionComparator  # noqa: E402
+
+SLOTS = {
+    "adjective": "old young tall smiling angry bearded elegant tired".split(),
+    "subject": "man woman child dancer soldier couple crowd musician".split(),
+    "action": "standing sitting dancing walking talking singing running praying".split(),
+    "place": "temple street garden palace kitchen stage market beach".split(),
+    "object": "lamp flowers sword guitar umbrella table horse fountain".split(),
+    "light": "warm dim golden bright cold soft harsh neon".split(),
+}
+
+# Each model phrases the same content differently
+TEMPLATES = [
+    "A {adjective} {subject} {action} in a {place} near a {object}, {light} light",
+    "The image shows an {adjective} {subject} {action} at the {place} beside a {object} under {light} lighting",
+    "{adjective} {subject}, {action}, {place}, {object}, {light} tones",
+]
+
+
+def make_captions(images: int, agree_share: float, seed: int = 0):
+    """
+    Captions of three models for every image. A share of the images get the same content
+    from every model (one slot may differ), the rest independent content per model.
+    :return: ({model_name: {image_path: caption}}, set of agreeing image paths)
+    """
+    rng = random.Random(seed)
+    captions = {f"model_{m}": {} for m in range(len(TEMPLATES))}
+    agreeing = set()
+    for i in range(images):
+        image_path = f"frames/{i:06d}.jpg"
+        agree = rng.random() < agree_share
+        content = {slot: rng.choice(words) for slot, words in SLOTS.items()}
+        if agree:
+            agreeing.add(image_path)
+        for m, template in enumerate(TEMPLATES):
+            if agree:
+                values = dict(content)
+                if rng.random() < 0.3:
+                    slot = rng.choice(list(SLOTS))
+                    values[slot] = rng.choice(SLOTS[slot])
+            else:
+                values = {slot: rng.choice(words) for slot, words in SLOTS.items()}
+            captions[f"model_{m}"][image_path] = template.format(**values)
+    return captions, agreeing
+
+
+def write_outputs(directory: str, captions: dict) -> list:
+    paths = []
+    for model_name, model_captions in captions.items():
+        os.makedirs(os.path.join(directory, model_name))
+        path = os.path.join(directory, model_name, "output.json")
+        with open(path, "w") as f:
+            json.dump({"captions": model_captions}, f)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the LLM calls the caption agreement prefilter saves in CaptionComparator."
+    )
+    parser.add_argument("--images", type=int, default=400)
+    parser.add_argument("--agree-share", type=float, default=0.6)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.3, 0.4, 0.5, 0.7]
+    )
+    parser.add_argument(
+        "--scoring-images",
+        type=int,
+        default=100000,
+        help="Images for the scoring throughput measurement.",
+    )
+    args = parser.parse_args()
+
+    captions, agreeing = make_captions(args.images, args.agree_share)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp, FakeOllamaServer(args.latency) as server:
+        json_paths = write_outputs(tmp, captions)
+        for threshold in [None] + args.thresholds:
+            comparator = CaptionComparator(
+                "llama3.2",
+                json_paths,
+                max_in_flight=args.max_in_flight,
+                host=server.url,
+                agreement_threshold=threshold,
+            )
+            requests = server.requests
+            start = time.perf_counter()
+            results = comparator.analyze_image_captions()
+            seconds = time.perf_counter() - start
+            skipped = {r.image for r in results if isinstance(r, AgreedComparison)}
+            rows.append(
+                (
+                    threshold,
+                    server.requests - requests,
+                    seconds,
+                    len(skipped & agreeing) / len(skipped) if skipped else 1.0,
+                    len(skipped & agreeing) / len(agreeing),
+                )
+            )
+
+    # Scoring throughput on its own, without the LLM
+    many, _ = make_captions(args.scoring_images, args.agree_share, seed=1)
+    rows_of_captions = [list(c) for c in zip(*(m.values() for m in many.values()))]
+    start = time.perf_counter()
+    scorer = CaptionAgreement().fit(rows_of_captions)
+    scorer.scores(rows_of_captions)
+    scoring_seconds = time.perf_counter() - start
+
+    print(
+        f"{args.images} images x {len(TEMPLATES)} models, "
+        f"{len(agreeing)} with agreeing captions"
+    )
+    print(
+        f"{'threshold':>10} {'LLM calls':>10} {'skipped':>8} {'seconds':>8} "
+        f"{'precision':>10} {'recall':>7}"
+    )
+    for threshold, calls, seconds, precision, recall in rows:
+        label = "off" if threshold is None else f"{threshold:.2f}"
+        print(
+            f"{label:>10} {calls:>10} {1 - calls / args.images:>8.1%} {seconds:>8.2f} "
+            f"{precision:>10.1%} {recall:>7.1%}"
+        )
+    print(
+        f"Scoring {args.scoring_images} images: {scoring_seconds:.2f}s "
+        f"({args.scoring_images / scoring_seconds:,.0f} images/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
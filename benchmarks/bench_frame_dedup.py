@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import toml
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "image_annotations_generation",
+    )
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from main import CaptioningPipeline  # noqa: E402
+from tiny_models import make_synthetic_video_frames  # noqa: E402
+
+
+def run(server, frame_dir, output_dir, dedup):
+    """Caption every frame, with or without deduplication; return (seconds, requests, pipeline)."""
+    config = {
+        "DatasetInfo": {"dataset_path": frame_dir},
+        "ModelInfo": {"modelname": "llava:7b"},
+        "MetaData": {"outputpath": os.path.join(output_dir, "output.json")},
+        "Concurrency": {"max_in_flight": 8, "host": server.url},
+        "Dedup": dedup,
+    }
+    config_path = os.path.join(output_dir, "config.toml")
+    os.makedirs(output_dir)
+    with open(config_path, "w") as f:
+        toml.dump(config, f)
+
+    pipeline = CaptioningPipeline(config_path)
+    requests = server.requests
+    start = time.perf_counter()
+    pipeline.process_images()
+    return time.perf_counter() - start, server.requests - requests, pipeline
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the model calls saved by perceptual-hash frame deduplication."
+    )
+    parser.add_argument("--videos", type=int, default=4)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--mean-run", type=int, default=8, help="Mean frames per shot.")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--thresholds", type=int, nargs="+", default=[0, 4, 8])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOllamaServer(args.latency) as server:
+        frame_dir = os.path.join(tmp, "frames")
+        shots = make_synthetic_video_frames(
+            frame_dir, args.videos, args.frames, args.mean_run
+        )
+        print(f"{len(shots)} frames in {len(set(shots.values()))} shots")
+
+        runs = [("off", {"enabled": False})] + [
+            (str(threshold), {"enabled": True, "threshold": threshold})
+            for threshold in args.thresholds
+        ]
+        print(
+            f"{'threshold':>10} {'seconds':>10} {'requests':>10} {'saved':>8} {'mixed shots':>12}"
+        )
+        for name, dedup in runs:
+            seconds, requests, pipeline = run(
+                server, frame_dir, os.path.join(tmp, f"dedup_{name}"), dedup
+            )
+            with open(pipeline.output_path) as f:
+                captions = json.load(f)["captions"]
+            assert len(captions) == len(shots), "every frame must have a caption"
+
+            # Frames of different shots that were given the same caption source
+            mixed = 0
+            if pipeline.deduplicator:
+                clusters = pipeline.deduplicator.clusters(
+                    sorted(shots), pipeline.get_hashes(sorted(shots))
+                )
+                mixed = sum(
+                    len({shots[path] for path in members}) > 1 for members in clusters
+                )
+            print(
+                f"{name:>10} {seconds:>10.2f} {requests:>10} {pipeline.calls_saved:>8} {mixed:>12}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "Image_generation",
+        "Inference",
+    )
+)
+
+from image_writer import ImageWriter  # noqa: E402
+
+
+def make_image(size: int, seed: int):
+    """A smooth random image, closer to diffusion output than pure noise."""
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (size // 16, size // 16, 3), dtype=np.uint8)
+    return Image.fromarray(small).resize((size, size), Image.BICUBIC)
+
+
+def run(images, writer_options, denoise_seconds, output_folder):
+    """Simulate a generation loop: denoise (sleep, the GPU is busy) then save each image."""
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.perf_counter()
+    with ImageWriter(**writer_options) as writer:
+        for i, image in enumerate(images):
+            time.sleep(denoise_seconds)
+            path = writer.output_path(os.path.join(output_folder, f"{i:06d}.png"))
+            writer.submit(writer.save, image, path)
+    seconds = time.perf_counter() - start
+    size = sum(
+        os.path.getsize(os.path.join(output_folder, name))
+        for name in os.listdir(output_folder)
+    )
+    return len(images) / seconds * 60, size / len(images) / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare synchronous and background image saving in a generation loop."
+    )
+    parser.add_argument("--images", type=int, default=16)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument(
+        "--denoise-ms",
+        type=float,
+        default=500,
+        help="Simulated GPU time per image, during which the CPU is free.",
+    )
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    images = [make_image(args.size, i) for i in range(args.images)]
+    configs = [
+        ("png level 6", {"image_format": "png"}),
+        ("png level 1", {"image_format": "png", "png_compress_level": 1}),
+        ("webp q90", {"image_format": "webp"}),
+        ("jpeg q95", {"image_format": "jpeg"}),
+    ]
+    print(
+        f"images={args.images} size={args.size} denoise={args.denoise_ms:.0f}ms "
+        f"(upper bound {60000 / args.denoise_ms:.1f} images/min)"
+    )
+    print(
+        f"{'format':>12} {'sync/min':>10} {'async/min':>10} {'speedup':>8} {'KiB':>8}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, options in configs:
+            folder = os.path.join(tmp, label.replace(" ", "-"))
+            sync, kib = run(
+                images,
+                {**options, "num_workers": 0},
+                args.denoise_ms / 1000,
+                folder + "-sync",
+            )
+            background, _ = run(
+                images,
+                {**options, "num_workers": args.workers},
+                args.denoise_ms / 1000,
+                folder + "-async",
+            )
+            print(
+                f"{label:>12} {sync:>10.1f} {background:>10.1f} "
+                f"{background / sync:>7.2f}x {kib:>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
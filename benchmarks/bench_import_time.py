@@ -0,0 +1,167 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Heavy libraries that must not be imported by the cases listed against them
+HEAVY = ("torch", "diffusers", "transformers", "ollama")
+CLI_FORBIDDEN = HEAVY + ("numpy", "PIL", "httpx", "pydantic", "scipy", "cv2")
+
+
+def _import(folder, module):
+    """Command importing a module the way its pipeline folder's scripts do."""
+    return [
+        "-c",
+        f"import sys; sys.path.insert(0, {os.path.join(ROOT, *folder)!r}); import {module}",
+    ]
+
+
+def _cli(*args):
+    return [os.path.join(ROOT, "immerso.py"), *args]
+
+
+# (name, python arguments, budget in ms of cumulative import time, forbidden modules)
+CASES = [
+    ("immerso --help", _cli("--help"), 30, CLI_FORBIDDEN),
+    ("immerso caption --help", _cli("caption", "--help"), 30, CLI_FORBIDDEN),
+    ("immerso compare --help", _cli("compare", "--help"), 30, CLI_FORBIDDEN),
+    ("immerso summarize --help", _cli("summarize", "--help"), 30, CLI_FORBIDDEN),
+    ("immerso stream --help", _cli("stream", "--help"), 30, CLI_FORBIDDEN),
+    ("immerso generate --help", _cli("generate", "--help"), 30, CLI_FORBIDDEN),
+    (
+        "import main (caption)",
+        _import(("data_generation", "image_annotations_generation"), "main"),
+        400,
+        HEAVY,
+    ),
+    (
+        "import runner",
+        _import(("Image_generation", "Inference"), "runner"),
+        100,
+        HEAVY,
+    ),
+    (
+        "import sd_xl",
+        _import(("Image_generation", "Inference"), "sd_xl"),
+        300,
+        HEAVY,
+    ),
+    (
+        "import sd_2",
+        _import(("Image_generation", "Inference"), "sd_2"),
+        300,
+        HEAVY,
+    ),
+    (
+        "import dff",
+        _import(("Image_generation", "Inference"), "dff"),
+        300,
+        HEAVY,
+    ),
+]
+
+
+def parse_importtime(stderr: str):
+    """
+    Parse `python -X importtime` output.
+    :return: (total cumulative microseconds of the top-level imports,
+              {module: cumulative microseconds} of every import)
+    """
+    total, modules = 0, {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(cumulative)
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total, modules
+
+
+def measure(arguments, runs: int):
+    """Best of `runs` (import ms, wall ms) and the imported modules of the last run."""
+    best_import, best_wall = float("inf"), float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", *arguments],
+            capture_output=True,
+            text=True,
+            cwd=ROOT,
+        )
+        wall = (time.perf_counter() - start) * 1000
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr[-2000:])
+        total, modules = parse_importtime(process.stderr)
+        best_import = min(best_import, total / 1000)
+        best_wall = min(best_wall, wall)
+    return best_import, best_wall, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the CLI and pipeline modules import within their time budgets."
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Best of this many runs.")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="Multiply every budget, e.g. 2 on a slow machine.",
+    )
+    parser.add_argument("--output", help="Also write the results as JSON here.")
+    args = parser.parse_args()
+
+    # Interpreter startup (site, encodings, .pth files) is the same for every command
+    base_import, base_wall, base_modules = measure(["-c", "pass"], args.runs)
+    print(
+        f"Bare interpreter: {base_import:.1f} ms of imports, {base_wall:.1f} ms wall; "
+        "the times below exclude it"
+    )
+
+    results, failures = [], []
+    print(
+        f"{'case':<28} {'import ms':>10} {'budget':>8} {'wall ms':>8}  slowest imports"
+    )
+    for name, arguments, budget, forbidden in CASES:
+        import_ms, wall_ms, modules = measure(arguments, args.runs)
+        import_ms = max(0.0, import_ms - base_import)
+        wall_ms = max(0.0, wall_ms - base_wall)
+        budget *= args.scale
+        heavy = sorted(module for module in forbidden if module in modules)
+        slowest = sorted(
+            (m for m in modules if "." not in m and m not in base_modules),
+            key=lambda m: -modules[m],
+        )[:3]
+        print(
+            f"{name:<28} {import_ms:>10.1f} {budget:>8.0f} {wall_ms:>8.1f}  "
+            + ", ".join(f"{m} {modules[m] / 1000:.0f}" for m in slowest)
+        )
+        if import_ms > budget:
+            failures.append(f"{name}: {import_ms:.0f} ms > budget {budget:.0f} ms")
+        if heavy:
+            failures.append(f"{name}: imports {', '.join(heavy)}")
+        results.append(
+            {
+                "case": name,
+                "import_ms": import_ms,
+                "wall_ms": wall_ms,
+                "budget_ms": budget,
+                "heavy_imports": heavy,
+            }
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
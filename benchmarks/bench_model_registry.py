@@ -0,0 +1,139 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data_generation")
+)
+
+from common.model_registry import MB, ModelRegistry  # noqa: E402
+
+# Job kind -> (share of the jobs, model size in MB). Sizes are the fp16/fp32 footprints
+# of BLIP base, SDXL base+refiner and SD2 divided by 25.
+JOBS = {
+    "caption (blip)": (0.5, 40),
+    "generate (sdxl)": (0.35, 400),
+    "generate (sd2)": (0.15, 104),
+}
+
+
+def rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def save_model(path: str, size_mb: int):
+    """Write the state dict of a model of size_mb float32 weights."""
+    rows = size_mb * MB // (4 * 1024)
+    torch.save({"weight": torch.randn(rows, 1024)}, path)
+
+
+def loader(path: str):
+    def load():
+        state = torch.load(path)
+        model = torch.nn.Linear(1024, state["weight"].shape[0], bias=False)
+        model.load_state_dict(state)
+        return model
+
+    return load
+
+
+def make_trace(jobs: int, locality: float, seed: int = 0) -> list:
+    """Sequence of job kinds; with probability `locality` a job repeats the previous kind."""
+    rng = random.Random(seed)
+    kinds, weights = list(JOBS), [share for share, _ in JOBS.values()]
+    trace = [rng.choices(kinds, weights)[0]]
+    while len(trace) < jobs:
+        trace.append(
+            trace[-1] if rng.random() < locality else rng.choices(kinds, weights)[0]
+        )
+    return trace
+
+
+def run(paths: dict, trace: list, budget_mb: float = None, unload_after_job=False):
+    registry = ModelRegistry({"cpu": budget_mb} if budget_mb else None)
+    for kind, path in paths.items():
+        registry.register(kind, loader(path), device="cpu")
+    base_rss = rss_mb()
+    peak_tracked, peak_rss = 0, 0.0
+    start = time.perf_counter()
+    for kind in trace:
+        with registry.pinned(kind):
+            model = registry.get(kind)
+            # Stand-in for the job's work
+            model(torch.ones(1, 1024))
+            del model
+            peak_tracked = max(peak_tracked, registry.stats()["used_mb"].get("cpu", 0))
+            peak_rss = max(peak_rss, rss_mb() - base_rss)
+        if unload_after_job:
+            registry.clear()
+    seconds = time.perf_counter() - start
+    stats = registry.stats()
+    loads = sum(model["loads"] for model in stats["models"].values())
+    load_seconds = sum(model["load_seconds"] for model in stats["models"].values())
+    registry.clear()
+    return seconds, loads, load_seconds, peak_tracked, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare model loads and peak memory of a mixed caption/generation job queue in one worker."
+    )
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument(
+        "--locality",
+        type=float,
+        default=0.5,
+        help="Probability that a job uses the same model as the previous one.",
+    )
+    parser.add_argument(
+        "--budget-mb",
+        type=float,
+        default=450,
+        help="RAM budget of the registry (the three models need 544 MB together).",
+    )
+    args = parser.parse_args()
+
+    trace = make_trace(args.jobs, args.locality)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {}
+        for kind, (_, size_mb) in JOBS.items():
+            paths[kind] = os.path.join(tmp, f"{kind.split()[1][1:-1]}.pt")
+            save_model(paths[kind], size_mb)
+        # Warm the page cache, so every policy reads the weights from memory
+        run(paths, list(JOBS))
+
+        for label, budget, unload in [
+            ("keep every model", None, False),
+            ("unload after each job", None, True),
+            (f"LRU, {args.budget_mb:.0f} MB budget", args.budget_mb, False),
+        ]:
+            rows.append((label, *run(paths, trace, budget, unload)))
+
+    print(
+        f"{args.jobs} jobs: "
+        + ", ".join(f"{trace.count(kind)} {kind}" for kind in JOBS)
+        + f", locality {args.locality}"
+    )
+    print(
+        f"{'policy':>26} {'loads':>6} {'load s':>7} {'total s':>8} "
+        f"{'peak tracked MB':>16} {'peak RSS MB':>12}"
+    )
+    for label, seconds, loads, load_seconds, peak_tracked, peak_rss in rows:
+        print(
+            f"{label:>26} {loads:>6} {load_seconds:>7.2f} {seconds:>8.2f} "
+            f"{peak_tracked:>16} {peak_rss:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
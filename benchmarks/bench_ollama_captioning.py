@@ -0,0 +1,70 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import toml
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "image_annotations_generation",
+    )
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from main import CaptioningPipeline  # noqa: E402
+
+
+def run(server, image_dir, output_dir, max_in_flight):
+    """Caption every image in image_dir with the given number of requests in flight."""
+    config = {
+        "DatasetInfo": {"dataset_path": image_dir},
+        "ModelInfo": {"modelname": "llava:7b"},
+        "MetaData": {
+            "outputpath": os.path.join(output_dir, f"inflight_{max_in_flight}.json")
+        },
+        "Concurrency": {"max_in_flight": max_in_flight, "host": server.url},
+    }
+    config_path = os.path.join(output_dir, f"config_{max_in_flight}.toml")
+    with open(config_path, "w") as f:
+        toml.dump(config, f)
+
+    pipeline = CaptioningPipeline(config_path)
+    start = time.perf_counter()
+    pipeline.process_images()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure captioning throughput against a fake Ollama server."
+    )
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOllamaServer(args.latency) as server:
+        image_dir = os.path.join(tmp, "images")
+        os.makedirs(image_dir)
+        for i in range(args.images):
+            with open(os.path.join(image_dir, f"{i:06d}.jpg"), "wb") as f:
+                f.write(os.urandom(1024))
+
+        print(f"{'in flight':>10} {'seconds':>10} {'images/s':>10} {'speedup':>10}")
+        baseline = None
+        for level in args.levels:
+            seconds = run(server, image_dir, tmp, level)
+            rate = args.images / seconds
+            baseline = baseline or rate
+            print(
+                f"{level:>10} {seconds:>10.2f} {rate:>10.1f} {rate / baseline:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+
+import toml
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "image_annotations_generation",
+    )
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from main import CaptioningPipeline  # noqa: E402
+
+
+def run(servers, balance, image_dir, output_dir, max_in_flight):
+    """Caption every image in image_dir with requests spread over the given servers."""
+    name = f"{len(servers)}_{balance}_{id(servers)}"
+    config = {
+        "DatasetInfo": {"dataset_path": image_dir},
+        "ModelInfo": {"modelname": "llava:7b"},
+        "MetaData": {"outputpath": os.path.join(output_dir, name, "output.json")},
+        "Concurrency": {
+            "max_in_flight": max_in_flight,
+            "hosts": [server.url for server in servers],
+            "balance": balance,
+        },
+    }
+    config_path = os.path.join(output_dir, f"config_{name}.toml")
+    with open(config_path, "w") as f:
+        toml.dump(config, f)
+
+    before = [server.requests for server in servers]
+    pipeline = CaptioningPipeline(config_path)
+    start = time.perf_counter()
+    pipeline.process_images()
+    seconds = time.perf_counter() - start
+    return seconds, [server.requests - b for server, b in zip(servers, before)]
+
+
+def check_spread(label, balance, requests, slow: bool, tolerance: float) -> list:
+    """
+    Failures of one scenario: round_robin must split the requests evenly, least_loaded
+    evenly over equal servers and give the slow server fewer than any other.
+    """
+    failures = []
+    fast = requests[:-1] if slow else requests
+    if balance == "round_robin" or not slow:
+        share = sum(requests) / len(requests)
+        # least_loaded only balances load, so its counts may wander a bit more
+        allowed = share * tolerance * (1 if balance == "round_robin" else 2) + 1
+        uneven = [count for count in requests if abs(count - share) > allowed]
+        if uneven:
+            failures.append(
+                f"{label} {balance}: {requests} is not within {allowed:.0f} of {share:.0f} each"
+            )
+    if balance == "least_loaded" and slow and requests[-1] >= min(fast):
+        failures.append(
+            f"{label} {balance}: the slow server got {requests[-1]} requests, "
+            f"not fewer than the others {fast}"
+        )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure captioning throughput with requests spread over several fake Ollama servers."
+    )
+    parser.add_argument("--images", type=int, default=96)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument(
+        "--parallel", type=int, default=2, help="Requests each server answers at once."
+    )
+    parser.add_argument("--servers", type=int, default=3)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed deviation from an even round_robin split, as a fraction.",
+    )
+    args = parser.parse_args()
+
+    # The last server is 4x slower, like a smaller GPU
+    latencies = [args.latency] * (args.servers - 1) + [args.latency * 4]
+    with tempfile.TemporaryDirectory() as tmp, contextlib.ExitStack() as stack:
+        servers = [
+            stack.enter_context(FakeOllamaServer(latency, parallel=args.parallel))
+            for latency in latencies
+        ]
+        image_dir = os.path.join(tmp, "images")
+        os.makedirs(image_dir)
+        for i in range(args.images):
+            with open(os.path.join(image_dir, f"{i:06d}.jpg"), "wb") as f:
+                f.write(os.urandom(1024))
+
+        scenarios = [
+            ("1 server", servers[:1], "least_loaded", False),
+            (f"{args.servers - 1} equal", servers[:-1], "round_robin", False),
+            (f"{args.servers - 1} equal", servers[:-1], "least_loaded", False),
+            (f"{args.servers} (1 slow)", servers, "round_robin", True),
+            (f"{args.servers} (1 slow)", servers, "least_loaded", True),
+        ]
+        rows, failures = [], []
+        for label, pool, balance, slow in scenarios:
+            seconds, requests = run(pool, balance, image_dir, tmp, args.max_in_flight)
+            rows.append((label, balance, seconds, requests))
+            failures += check_spread(label, balance, requests, slow, args.tolerance)
+
+    print(
+        f"{'servers':>12} {'balance':>13} {'seconds':>8} {'images/s':>9}  requests per server"
+    )
+    for label, balance, seconds, requests in rows:
+        print(
+            f"{label:>12} {balance:>13} {seconds:>8.2f} {args.images / seconds:>9.1f}  {requests}"
+        )
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "Image_generation",
+        "Inference",
+    )
+)
+
+import sd_xl  # noqa: E402
+from image_writer import ImageWriter  # noqa: E402
+from tiny_models import WORDS, make_tiny_sdxl  # noqa: E402
+
+
+def write_captions(path: str, count: int):
+    captions = {
+        f"images/{i:06d}.png": " ".join(
+            WORDS[(i * 7 + j) % len(WORDS)] for j in range(6)
+        )
+        for i in range(count)
+    }
+    with open(path, "w") as f:
+        json.dump({"metadata": {}, "captions": captions}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare SDXL base+refiner throughput with and without batching and overlap."
+    )
+    parser.add_argument(
+        "--real",
+        action="store_true",
+        help="Use the real SDXL pipelines (default: tiny random pipelines on CPU).",
+    )
+    parser.add_argument("--images", type=int, default=32)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 8])
+    args = parser.parse_args()
+
+    sd_xl.n_steps = args.steps
+    with tempfile.TemporaryDirectory() as tmp:
+        pipelines = (
+            sd_xl.load_pipelines() if args.real else make_tiny_sdxl(tmp, sample_size=32)
+        )
+        json_path = os.path.join(tmp, "output.json")
+        write_captions(json_path, args.images)
+        output_folder = os.path.join(tmp, "generated")
+
+        # Warm up allocator and kernels before timing
+        write_captions(os.path.join(tmp, "warmup.json"), 2)
+        sd_xl.generate_images_from_json(
+            os.path.join(tmp, "warmup.json"),
+            os.path.join(output_folder, "warmup"),
+            2,
+            pipelines,
+        )
+
+        print(f"images={args.images} steps={args.steps}")
+        print(f"{'path':>34} {'images/min':>12} {'speedup':>10}")
+        baseline = None
+        for batch_size in args.batch_sizes:
+            for overlap in (False, True):
+                label = f"batch_size={batch_size}" + (" overlap" if overlap else "")
+                # A fresh folder per run, otherwise the manifest skips every image
+                stats = sd_xl.generate_images_from_json(
+                    json_path,
+                    os.path.join(output_folder, label.replace(" ", "-")),
+                    batch_size,
+                    pipelines,
+                    overlap,
+                )
+                rate = stats["images_per_min"]
+                baseline = baseline or rate
+                print(f"{label:>34} {rate:>12.1f} {rate / baseline:>9.1f}x")
+
+        # Same as the last run, but saving images in the generation loop
+        batch_size = args.batch_sizes[-1]
+        label = f"batch_size={batch_size} overlap sync-save"
+        with ImageWriter(num_workers=0) as writer:
+            stats = sd_xl.generate_images_from_json(
+                json_path,
+                os.path.join(output_folder, label.replace(" ", "-")),
+                batch_size,
+                pipelines,
+                writer=writer,
+            )
+        rate = stats["images_per_min"]
+        print(f"{label:>34} {rate:>12.1f} {rate / baseline:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
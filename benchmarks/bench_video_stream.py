@@ -0,0 +1,239 @@
+import argparse
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import toml
+from PIL import Image
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(
+    os.path.join(BENCHMARKS, "..", "data_generation", "video_annotation_generation")
+)
+sys.path.append(
+    os.path.join(BENCHMARKS, "..", "data_generation", "image_annotations_generation")
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from main import CaptioningPipeline  # noqa: E402
+from video_caption import FINAL_PROMPT, VideoSummaryGenerator  # noqa: E402
+from video_stream import StreamingVideoSummarizer  # noqa: E402
+
+FPS = 25
+
+
+class CaptioningServer(FakeOllamaServer):
+    """
+    Fake server whose captions differ per frame, so consecutive frames do not merge. They
+    only depend on the image, so both methods get the same captions and prompts.
+    """
+
+    def respond(self, request):
+        images = request["messages"][-1].get("images") or [""]
+        number = zlib.crc32(images[0].encode()) % 1000
+        return (
+            f"Shot {number}: a man in a white shirt stands in a dim room lit by candles, "
+            "looking down at an old letter."
+        )
+
+
+def synthetic_video(frames: int, size=(640, 360), mean_run: int = 8):
+    """
+    Frames of a synthetic video made of static shots, generated in memory one at a time.
+    :return: Generator of (frame index, seconds, RGB PIL image).
+    """
+    rng = np.random.default_rng(0)
+    index = 0
+    while index < frames:
+        coarse = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        scene = np.asarray(
+            Image.fromarray(coarse).resize(size, Image.Resampling.BICUBIC),
+            dtype=np.int16,
+        )
+        for _ in range(min(int(rng.geometric(1 / mean_run)), frames - index)):
+            noisy = scene + rng.normal(0, 3, scene.shape).astype(np.int16)
+            yield index, index / FPS, Image.fromarray(
+                noisy.clip(0, 255).astype(np.uint8)
+            )
+            index += 1
+
+
+def peak_rss_mb() -> float:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def directory_bytes(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(directory)
+        for name in files
+    )
+
+
+def first_result_clock(generator, start):
+    """Record when the first summary request of a generator completes."""
+    chat, first = generator.chat, []
+
+    def timed_chat(prompt):
+        content = chat(prompt)
+        if not first:
+            first.append(time.perf_counter() - start)
+        return content
+
+    generator.chat = timed_chat
+    return first
+
+
+def run_staged(server, tmp, frames, max_in_flight, token_budget):
+    """Extract frames to disk, caption them into output.json, then summarize that."""
+    start = time.perf_counter()
+    frame_dir = os.path.join(tmp, "frames")
+    os.makedirs(frame_dir)
+    for index, _, image in synthetic_video(frames):
+        image.save(os.path.join(frame_dir, f"{index:06d}.jpg"), quality=90)
+    extracted = time.perf_counter() - start
+
+    config = {
+        "DatasetInfo": {"dataset_path": frame_dir},
+        "ModelInfo": {"modelname": "llava:7b"},
+        "MetaData": {"outputpath": os.path.join(tmp, "captions", "output.json")},
+        "Concurrency": {"max_in_flight": max_in_flight, "host": server.url},
+    }
+    config_path = os.path.join(tmp, "config.toml")
+    with open(config_path, "w") as f:
+        toml.dump(config, f)
+    CaptioningPipeline(config_path).process_images()
+    captioned = time.perf_counter() - start
+
+    generator = VideoSummaryGenerator(
+        config["MetaData"]["outputpath"],
+        FINAL_PROMPT,
+        token_budget=token_budget,
+        max_in_flight=max_in_flight,
+        host=server.url,
+    )
+    first = first_result_clock(generator, start)
+    generator.read_json()
+    generator.sort_captions()
+    generator.get_video_summary()
+    return {
+        "seconds": time.perf_counter() - start,
+        "first_summary_seconds": first[0],
+        "stages": f"extract {extracted:.1f}s, caption {captioned - extracted:.1f}s",
+        "disk_mb": directory_bytes(tmp) / 1024**2,
+    }
+
+
+def run_streaming(server, tmp, frames, max_in_flight, token_budget):
+    """Caption frames in memory and summarize windows as they complete."""
+    summarizer = StreamingVideoSummarizer(
+        "llava:7b",
+        token_budget=token_budget,
+        max_in_flight=max_in_flight,
+        host=server.url,
+    )
+    # Frames still referenced by the pipeline, to show memory does not grow with length
+    alive = set()
+    max_alive = 0
+
+    def tracked(frames):
+        nonlocal max_alive
+        for index, seconds, image in frames:
+            alive.add(index)
+            max_alive = max(max_alive, len(alive))
+            yield index, seconds, image
+
+    caption_frames = summarizer.caption_frames
+
+    def release(frames):
+        for index, seconds, caption in caption_frames(frames):
+            alive.discard(index)
+            yield index, seconds, caption
+
+    summarizer.caption_frames = release
+    result = summarizer.summarize_frames(tracked(synthetic_video(frames)))
+    return {
+        "seconds": result["seconds"],
+        "first_summary_seconds": result["first_summary_seconds"],
+        "stages": f"{result['windows']} windows, at most {max_alive} frames in memory",
+        "disk_mb": directory_bytes(tmp) / 1024**2,
+    }
+
+
+def run_one(method, frames, latency, max_in_flight, token_budget):
+    """Run one method in this process and return its measurements."""
+    baseline = peak_rss_mb()
+    run = run_staged if method == "staged" else run_streaming
+    with tempfile.TemporaryDirectory() as tmp, CaptioningServer(latency) as server:
+        result = run(server, tmp, frames, max_in_flight, token_budget)
+        result["requests"] = server.requests
+    result["peak_rss_mb"] = peak_rss_mb() - baseline
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare staged (frames on disk, output.json, summary) and streaming video summarization."
+    )
+    parser.add_argument("--frames", type=int, nargs="+", default=[300, 1200])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--token-budget", type=int, default=2048)
+    parser.add_argument("--single", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        method, frames = args.single
+        result = run_one(
+            method, int(frames), args.latency, args.max_in_flight, args.token_budget
+        )
+        print(json.dumps(result))
+        return
+
+    # Every run gets a fresh process, so its peak RSS is its own
+    rows = []
+    for frames, method in itertools.product(args.frames, ["staged", "streaming"]):
+        process = subprocess.run(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--single",
+                method,
+                str(frames),
+                "--latency",
+                str(args.latency),
+                "--max-in-flight",
+                str(args.max_in_flight),
+                "--token-budget",
+                str(args.token_budget),
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        rows.append((frames, method, json.loads(process.stdout.splitlines()[-1])))
+
+    print(
+        f"{'frames':>7} {'method':>10} {'seconds':>8} {'1st summary s':>14} "
+        f"{'requests':>9} {'peak RSS MB':>12} {'disk MB':>8}  details"
+    )
+    for frames, method, result in rows:
+        print(
+            f"{frames:>7} {method:>10} {result['seconds']:>8.2f} "
+            f"{result['first_summary_seconds']:>14.2f} {result['requests']:>9} "
+            f"{result['peak_rss_mb']:>12.0f} {result['disk_mb']:>8.1f}  {result['stages']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
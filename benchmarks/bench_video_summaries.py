@@ -0,0 +1,75 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "data_generation",
+        "video_annotation_generation",
+    )
+)
+
+from fake_ollama import FakeOllamaServer  # noqa: E402
+from video_caption import VideoSummaryGenerator, find_caption_files  # noqa: E402
+
+
+def make_caption_files(directory, videos, frames):
+    """Write one synthetic output.json per video."""
+    for video in range(videos):
+        video_dir = os.path.join(directory, f"video_{video:05d}")
+        os.makedirs(video_dir)
+        captions = {
+            f"frames/{frame:05d}.jpg": f"Video {video}, frame {frame}: a man in a white shirt stands in a dim room."
+            for frame in range(frames)
+        }
+        with open(os.path.join(video_dir, "output.json"), "w") as f:
+            json.dump({"metadata": {}, "captions": captions}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure batch video summarization throughput against a fake Ollama server."
+    )
+    parser.add_argument("--videos", type=int, default=64)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeOllamaServer(args.latency) as server:
+        make_caption_files(os.path.join(tmp, "captions"), args.videos, args.frames)
+        caption_files = find_caption_files(os.path.join(tmp, "captions"))
+
+        print(f"{'in flight':>10} {'seconds':>10} {'videos/min':>12}")
+        for level in args.levels:
+            output_path = os.path.join(tmp, f"summaries_{level}.jsonl")
+            start = time.perf_counter()
+            VideoSummaryGenerator.summarize_batch(
+                caption_files,
+                "Summarize the video.",
+                output_path,
+                max_in_flight=level,
+                host=server.url,
+            )
+            seconds = time.perf_counter() - start
+            print(f"{level:>10} {seconds:>10.2f} {args.videos / seconds * 60:>12.0f}")
+
+        # Rerun of the last level: every video is up to date
+        start = time.perf_counter()
+        stats = VideoSummaryGenerator.summarize_batch(
+            caption_files,
+            "Summarize the video.",
+            output_path,
+            max_in_flight=args.levels[-1],
+            host=server.url,
+        )
+        print(f"rerun: {stats} in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
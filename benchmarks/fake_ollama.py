@@ -0,0 +1,188 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _example_for_schema(schema):
+    """Build a small value that validates against a (pydantic-generated) JSON schema."""
+    kind = schema.get("type")
+    if kind == "object":
+        if "properties" in schema:
+            return {
+                name: _example_for_schema(prop)
+                for name, prop in schema["properties"].items()
+            }
+        if isinstance(schema.get("additionalProperties"), dict):
+            return {"scene": _example_for_schema(schema["additionalProperties"])}
+        return {}
+    if kind == "array":
+        return [_example_for_schema(schema.get("items", {"type": "string"}))]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    return "fake"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The stdlib default backlog of 5 drops connections when many requests arrive at once
+    request_queue_size = 256
+
+
+class FakeOllamaServer:
+    """
+    A local stand-in for the Ollama HTTP API that answers /api/chat after a fixed delay.
+    Each request is handled on its own thread, like a server with unlimited parallel slots,
+    so the throughput seen by a client only depends on how many requests it keeps in flight.
+    With `parallel` set, only that many requests are answered at once and the others queue,
+    like a real server with OLLAMA_NUM_PARALLEL slots. With `capacity` set, every request
+    beyond that many in flight makes each new request `degrade` times the base latency
+    slower, so throughput falls under overload, like a model swapping in and out of memory.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        invalid_rate: float = 0.0,
+        parallel: int = None,
+        capacity: int = None,
+        degrade: float = 0.5,
+        jitter: float = 0.0,
+    ):
+        """
+        :param latency: Seconds to wait before answering each chat request.
+        :param host: Interface to bind to.
+        :param port: Port to bind to (0 picks a free port).
+        :param invalid_rate: Fraction of structured-output answers returned as broken JSON.
+        :param parallel: Requests answered at once (None = unlimited).
+        :param capacity: Requests in flight the server handles without slowing down
+                         (None = no degradation).
+        :param degrade: Extra latency, as a fraction of `latency`, per request in flight
+                        beyond `capacity`.
+        :param jitter: Each latency is multiplied by a random factor in [1, 1 + jitter],
+                       independent of load, like answers of varying length.
+        """
+        self.latency = latency
+        self.invalid_rate = invalid_rate
+        self._random = random.Random(0)
+        self.requests = 0
+        # Seconds each chat request was held by the server
+        self.latencies = []
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(parallel) if parallel else None
+        self.capacity = capacity
+        self.degrade = degrade
+        self.jitter = jitter
+        self._server = _Server((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def respond(self, request):
+        """Build the assistant message content for a chat request."""
+        schema = request.get("format")
+        if isinstance(schema, dict):
+            with self._lock:
+                invalid = self._random.random() < self.invalid_rate
+            if invalid:
+                return '{"common": {"scene": ["truncated'
+            return json.dumps(_example_for_schema(schema))
+        return f"A fake caption for a {len(request.get('messages', []))} message chat."
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                self._reply(200, "Ollama is running", "text/plain")
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if self.path != "/api/chat":
+                    self._reply(404, json.dumps({"error": "not found"}))
+                    return
+
+                with server._lock:
+                    server.requests += 1
+                    server._in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server._in_flight)
+                    latency = server.latency
+                    if server.capacity is not None:
+                        overload = max(0, server._in_flight - server.capacity)
+                        latency *= 1 + server.degrade * overload
+                    latency *= 1 + server.jitter * server._random.random()
+                start = time.perf_counter()
+                try:
+                    if server._slots:
+                        with server._slots:
+                            time.sleep(latency)
+                    else:
+                        time.sleep(latency)
+                    with server._lock:
+                        server.latencies.append(time.perf_counter() - start)
+                    body = {
+                        "model": request.get("model", ""),
+                        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                        "message": {
+                            "role": "assistant",
+                            "content": server.respond(request),
+                        },
+                        "done": True,
+                        "done_reason": "stop",
+                    }
+                finally:
+                    with server._lock:
+                        server._in_flight -= 1
+                self._reply(200, json.dumps(body))
+
+            def _reply(self, status, text, content_type="application/json"):
+                data = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a fake Ollama server.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    server = FakeOllamaServer(latency=args.latency, port=args.port).start()
+    print(f"Fake Ollama listening on {server.url}")
+    server._thread.join()
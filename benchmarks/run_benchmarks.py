@@ -0,0 +1,424 @@
+import argparse
+import datetime
+import functools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Stage name -> folder its modules are imported from
+STAGE_DIRS = {
+    "caption_ollama": "data_generation/image_annotations_generation",
+    "caption_blip": "data_generation/image_annotations_generation",
+    "compare": "data_generation/multi_image_caption_analysis",
+    "summarize": "data_generation/video_annotation_generation",
+    "generate_sd2": "Image_generation/Inference",
+    "generate_sdxl": "Image_generation/Inference",
+}
+
+
+class CallTimer:
+    """Record the start and end time of every call of a method, across all instances and threads."""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def wrap(self, cls, name: str):
+        original = getattr(cls, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.calls.append((start, time.perf_counter()))
+
+        setattr(cls, name, timed)
+        return self
+
+    def latencies(self):
+        return [end - start for start, end in self.calls]
+
+
+def write_config(path: str, config: dict) -> str:
+    import toml
+
+    with open(path, "w") as f:
+        toml.dump(config, f)
+    return path
+
+
+def stage_caption_ollama(args, tmp):
+    """CaptioningPipeline with an Ollama model against the fake server."""
+    import ollama
+    from fake_ollama import FakeOllamaServer
+    from main import CaptioningPipeline
+    from tiny_models import make_synthetic_images
+
+    timer = CallTimer().wrap(ollama.Client, "chat")
+    image_dir = os.path.join(tmp, "images")
+    make_synthetic_images(image_dir, args.images, (64, 48))
+    with FakeOllamaServer(args.latency) as server:
+        config = {
+            "DatasetInfo": {"dataset_path": image_dir},
+            "ModelInfo": {"modelname": "llava:7b"},
+            "MetaData": {"outputpath": os.path.join(tmp, "captions", "output.json")},
+            "Concurrency": {"max_in_flight": args.max_in_flight, "host": server.url},
+        }
+        pipeline = CaptioningPipeline(
+            write_config(os.path.join(tmp, "config.toml"), config)
+        )
+        start = time.perf_counter()
+        pipeline.process_images()
+        seconds = time.perf_counter() - start
+    return args.images, seconds, timer.latencies(), "request"
+
+
+def stage_caption_blip(args, tmp):
+    """CaptioningPipeline with a tiny random BLIP model on CPU."""
+    from main import CaptioningPipeline  # also makes data_generation/common importable
+    from blip_caption.blip_caption import ImageCaptioningModel
+    from tiny_models import make_synthetic_images, make_tiny_blip
+
+    timer = CallTimer().wrap(ImageCaptioningModel, "generate_captions_from_pixels")
+    image_dir = os.path.join(tmp, "images")
+    make_synthetic_images(image_dir, args.images, (320, 240))
+    model_path = make_tiny_blip(os.path.join(tmp, "tiny-blip"))
+    config = {
+        "DatasetInfo": {"dataset_path": image_dir},
+        "ModelInfo": {
+            "modelname": model_path,
+            "backends": {model_path: "blip"},
+            "batch_size": args.batch_size,
+            "device": "cpu",
+        },
+        "MetaData": {"outputpath": os.path.join(tmp, "captions", "output.json")},
+    }
+    pipeline = CaptioningPipeline(
+        write_config(os.path.join(tmp, "config.toml"), config)
+    )
+    start = time.perf_counter()
+    pipeline.process_images()
+    seconds = time.perf_counter() - start
+    return args.images, seconds, timer.latencies(), "batch"
+
+
+def stage_compare(args, tmp):
+    """CaptionComparator over two models' captions against the fake server."""
+    import ollama
+    from fake_ollama import FakeOllamaServer
+    from get_better_prompt import CaptionComparator
+
+    timer = CallTimer().wrap(ollama.Client, "chat")
+    json_paths = []
+    for model, caption in (("model_a", "a man in a room"), ("model_b", "a person")):
+        os.makedirs(os.path.join(tmp, model))
+        captions = {f"images/{i:06d}.jpg": f"{caption} {i}" for i in range(args.images)}
+        json_paths.append(os.path.join(tmp, model, "output.json"))
+        with open(json_paths[-1], "w") as f:
+            json.dump({"metadata": {}, "captions": captions}, f)
+
+    with FakeOllamaServer(args.latency) as server:
+        comparator = CaptionComparator(
+            "llama3.2", json_paths, max_in_flight=args.max_in_flight, host=server.url
+        )
+        start = time.perf_counter()
+        comparator.analyze_image_captions(os.path.join(tmp, "comparisons.json"))
+        seconds = time.perf_counter() - start
+    return args.images, seconds, timer.latencies(), "request"
+
+
+def stage_summarize(args, tmp):
+    """Batch VideoSummaryGenerator against the fake server."""
+    import ollama
+    from bench_video_summaries import make_caption_files
+    from fake_ollama import FakeOllamaServer
+    from video_caption import VideoSummaryGenerator, find_caption_files
+
+    timer = CallTimer().wrap(ollama.Client, "chat")
+    make_caption_files(os.path.join(tmp, "captions"), args.videos, args.frames)
+    with FakeOllamaServer(args.latency) as server:
+        start = time.perf_counter()
+        VideoSummaryGenerator.summarize_batch(
+            find_caption_files(os.path.join(tmp, "captions")),
+            "Summarize the video.",
+            os.path.join(tmp, "summaries.jsonl"),
+            max_in_flight=args.max_in_flight,
+            host=server.url,
+        )
+        seconds = time.perf_counter() - start
+    return args.videos, seconds, timer.latencies(), "request"
+
+
+def write_prompts(path: str, count: int):
+    from tiny_models import WORDS
+
+    # Distinct captions, so no prompt embedding comes from the cache
+    captions = {
+        f"images/{i:06d}.png": " ".join(
+            [WORDS[(i + j * 5) % len(WORDS)] for j in range(6)] + [str(i)]
+        )
+        for i in range(count)
+    }
+    with open(path, "w") as f:
+        json.dump({"metadata": {}, "captions": captions}, f)
+
+
+def stage_generate_sd2(args, tmp):
+    """sd_2 generation loop with a tiny random pipeline on CPU."""
+    import sd_2
+    from diffusers import StableDiffusionPipeline
+    from tiny_models import make_tiny_sd
+
+    timer = CallTimer().wrap(StableDiffusionPipeline, "__call__")
+    sd_2.n_steps = args.steps
+    pipe = make_tiny_sd(tmp, sample_size=32)
+    write_prompts(os.path.join(tmp, "output.json"), args.prompts)
+    start = time.perf_counter()
+    sd_2.generate_images_from_json(
+        os.path.join(tmp, "output.json"), os.path.join(tmp, "generated"), pipe
+    )
+    seconds = time.perf_counter() - start
+    return args.prompts, seconds, timer.latencies(), "image"
+
+
+def stage_generate_sdxl(args, tmp):
+    """sd_xl batched base + refiner loop with tiny random pipelines on CPU."""
+    import sd_xl
+    from diffusers import StableDiffusionXLImg2ImgPipeline, StableDiffusionXLPipeline
+    from tiny_models import make_tiny_sdxl
+
+    base_timer = CallTimer().wrap(StableDiffusionXLPipeline, "__call__")
+    refiner_timer = CallTimer().wrap(StableDiffusionXLImg2ImgPipeline, "__call__")
+    sd_xl.n_steps = args.steps
+    pipelines = make_tiny_sdxl(tmp, sample_size=32)
+    write_prompts(os.path.join(tmp, "output.json"), args.prompts)
+    start = time.perf_counter()
+    sd_xl.generate_images_from_json(
+        os.path.join(tmp, "output.json"),
+        os.path.join(tmp, "generated"),
+        args.batch_size,
+        pipelines,
+    )
+    seconds = time.perf_counter() - start
+    # A batch takes from the start of its base call to the end of its refiner call
+    latencies = [
+        refiner_end - base_start
+        for (base_start, _), (_, refiner_end) in zip(
+            base_timer.calls, refiner_timer.calls
+        )
+    ]
+    return args.prompts, seconds, latencies, "batch"
+
+
+STAGES = {
+    "caption_ollama": stage_caption_ollama,
+    "caption_blip": stage_caption_blip,
+    "compare": stage_compare,
+    "summarize": stage_summarize,
+    "generate_sd2": stage_generate_sd2,
+    "generate_sdxl": stage_generate_sdxl,
+}
+
+
+def percentile(values, q: float) -> float:
+    import numpy as np
+
+    return float(np.percentile(values, q)) if values else None
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_stage(name: str, args) -> dict:
+    """Run one stage in this process and summarize it."""
+    sys.path.insert(0, os.path.join(REPO_DIR, STAGE_DIRS[name]))
+    with tempfile.TemporaryDirectory() as tmp:
+        items, seconds, latencies, unit = STAGES[name](args, tmp)
+    p50, p95 = percentile(latencies, 50), percentile(latencies, 95)
+    return {
+        "items": items,
+        "seconds": seconds,
+        "throughput_per_s": items / seconds,
+        "latency_unit": unit,
+        "latency_samples": len(latencies),
+        "latency_p50_ms": None if p50 is None else p50 * 1000,
+        "latency_p95_ms": None if p95 is None else p95 * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def stage_command(name: str, args, result_path: str):
+    command = [sys.executable, os.path.abspath(__file__), "--stage", name]
+    command += ["--result-path", result_path]
+    for option in SETTINGS:
+        command += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+    return command
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(args) -> dict:
+    """Run every selected stage in its own process, so peak RSS is per stage."""
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {option: getattr(args, option) for option in SETTINGS},
+        "stages": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.stages:
+            result_path = os.path.join(tmp, f"{name}.json")
+            print(f"Running {name}...", flush=True)
+            process = subprocess.run(
+                stage_command(name, args, result_path),
+                capture_output=True,
+                text=True,
+            )
+            if process.returncode != 0:
+                print(process.stdout + process.stderr, file=sys.stderr)
+                report["stages"][name] = {
+                    "error": process.stderr.strip().splitlines()[-1:]
+                }
+                continue
+            with open(result_path) as f:
+                report["stages"][name] = json.load(f)
+    return report
+
+
+def print_report(report: dict):
+    print(
+        f"{'stage':>16} {'items/s':>10} {'unit':>8} {'p50 ms':>10} {'p95 ms':>10} {'RSS MB':>8}"
+    )
+    for name, stage in report["stages"].items():
+        if "error" in stage:
+            print(f"{name:>16} failed: {stage['error']}")
+            continue
+        print(
+            f"{name:>16} {stage['throughput_per_s']:>10.2f} {stage['latency_unit']:>8} "
+            f"{stage['latency_p50_ms'] or 0:>10.1f} {stage['latency_p95_ms'] or 0:>10.1f} "
+            f"{stage['peak_rss_mb']:>8.0f}"
+        )
+
+
+def compare_reports(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Compare a report with a baseline report.
+    :param tolerance: Allowed relative slowdown, e.g. 0.1 for 10%.
+    :return: List of regression messages (lower throughput or higher p95 latency).
+    """
+    regressions = []
+    for name, stage in report["stages"].items():
+        before = baseline.get("stages", {}).get(name)
+        if not before or "error" in stage or "error" in before:
+            continue
+        throughput = stage["throughput_per_s"] / before["throughput_per_s"] - 1
+        line = f"{name:>16} throughput {throughput:+.1%}"
+        if throughput < -tolerance:
+            regressions.append(f"{name}: throughput {throughput:+.1%}")
+        if stage["latency_p95_ms"] and before["latency_p95_ms"]:
+            p95 = stage["latency_p95_ms"] / before["latency_p95_ms"] - 1
+            line += f", p95 latency {p95:+.1%}"
+            if p95 > tolerance:
+                regressions.append(f"{name}: p95 latency {p95:+.1%}")
+        print(line)
+    return regressions
+
+
+# Options forwarded to every stage process and recorded in the report
+SETTINGS = [
+    "images",
+    "latency",
+    "max_in_flight",
+    "batch_size",
+    "videos",
+    "frames",
+    "prompts",
+    "steps",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the caption -> compare -> summarize -> generate benchmark suite "
+        "against local stand-ins and write a JSON report."
+    )
+    parser.add_argument(
+        "--stages", nargs="+", default=list(STAGES), choices=list(STAGES)
+    )
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument(
+        "--baseline", help="Earlier report to compare against; exits 1 on a regression."
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Allowed relative slowdown before a difference counts as a regression.",
+    )
+    parser.add_argument("--images", type=int, default=64)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="Fake Ollama latency in seconds."
+    )
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--videos", type=int, default=32)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--prompts", type=int, default=16)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--stage", choices=list(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument("--result-path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        # Child process: run a single stage and write its result
+        result = run_stage(args.stage, args)
+        with open(args.result_path, "w") as f:
+            json.dump(result, f)
+        return
+
+    report = run_suite(args)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+    print_report(report)
+    print(f"Report written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        if regressions:
+            print("Regressions: " + "; ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
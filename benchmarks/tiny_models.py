@@ -0,0 +1,327 @@
+import os
+
+# Small vocabulary so the tiny models can be built without downloading a tokenizer
+WORDS = (
+    "a photography of man woman people group room street car dog cat sky tree "
+    "in on with and the at red white black blue light dark standing sitting"
+).split()
+
+
+def make_tiny_blip(directory: str, image_size: int = 64) -> str:
+    """
+    Save a randomly initialised, few-layer BLIP captioning model and processor.
+    :param directory: Folder to write the model to.
+    :param image_size: Input resolution of the vision encoder.
+    :return: The folder, loadable with BlipForConditionalGeneration.from_pretrained.
+    """
+    import torch
+    from transformers import (
+        BertTokenizer,
+        BlipConfig,
+        BlipForConditionalGeneration,
+        BlipImageProcessor,
+        BlipProcessor,
+    )
+
+    os.makedirs(directory, exist_ok=True)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"] + WORDS
+    vocab_file = os.path.join(directory, "vocab.txt")
+    with open(vocab_file, "w") as f:
+        f.write("\n".join(vocab) + "\n")
+
+    tokenizer = BertTokenizer(vocab_file, bos_token="[DEC]", model_max_length=32)
+    image_processor = BlipImageProcessor(
+        size={"height": image_size, "width": image_size}
+    )
+    BlipProcessor(image_processor, tokenizer).save_pretrained(directory)
+
+    config = BlipConfig(
+        vision_config={
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+            "image_size": image_size,
+            "patch_size": 16,
+        },
+        text_config={
+            "vocab_size": len(vocab),
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+            "encoder_hidden_size": 32,
+            "max_position_embeddings": 64,
+            "pad_token_id": vocab.index("[PAD]"),
+            "bos_token_id": vocab.index("[DEC]"),
+            "eos_token_id": vocab.index("[SEP]"),
+            "sep_token_id": vocab.index("[SEP]"),
+        },
+    )
+    torch.manual_seed(0)
+    BlipForConditionalGeneration(config).save_pretrained(directory)
+    return directory
+
+
+def make_synthetic_images(directory: str, count: int, size=(320, 240)) -> list:
+    """
+    Write `count` random-noise JPEG images.
+    :param directory: Folder to write the images to.
+    :param count: Number of images.
+    :param size: (width, height) of every image.
+    :return: Sorted list of image paths.
+    """
+    import numpy as np
+    from PIL import Image
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        path = os.path.join(directory, f"{i:06d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def make_synthetic_video_frames(
+    directory: str, videos: int, frames: int, mean_run: int = 8, size=(320, 240)
+):
+    """
+    Write the JPEG frames of synthetic videos made of static shots: every shot is a random
+    smooth scene shown for a random number of frames with a little sensor noise.
+    :param directory: Folder to write one subfolder of frames per video to.
+    :param videos: Number of videos.
+    :param frames: Frames per video.
+    :param mean_run: Mean number of frames per shot.
+    :param size: (width, height) of every frame.
+    :return: Dictionary of frame path to shot id.
+    """
+    import numpy as np
+    from PIL import Image
+
+    rng = np.random.default_rng(0)
+    shots = {}
+    for video in range(videos):
+        video_dir = os.path.join(directory, f"video_{video:05d}")
+        os.makedirs(video_dir, exist_ok=True)
+        frame = 0
+        while frame < frames:
+            # Upsampled coarse noise gives smooth scenes with large-scale structure
+            coarse = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+            scene = np.asarray(
+                Image.fromarray(coarse).resize(size, Image.Resampling.BICUBIC),
+                dtype=np.int16,
+            )
+            shot = f"{video}:{frame}"
+            for _ in range(min(int(rng.geometric(1 / mean_run)), frames - frame)):
+                noisy = scene + rng.normal(0, 3, scene.shape).astype(np.int16)
+                path = os.path.join(video_dir, f"{frame:05d}.jpg")
+                Image.fromarray(noisy.clip(0, 255).astype(np.uint8)).save(
+                    path, quality=90
+                )
+                shots[path] = shot
+                frame += 1
+    return shots
+
+
+def _write_tiny_clip_tokenizer(directory: str, max_length: int = 77):
+    """Write a character-level CLIP tokenizer (byte alphabet, no merges)."""
+    import json
+
+    from transformers import CLIPTokenizer
+    from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+    os.makedirs(directory, exist_ok=True)
+    alphabet = list(bytes_to_unicode().values())
+    tokens = alphabet + [c + "</w>" for c in alphabet]
+    tokens += ["<|startoftext|>", "<|endoftext|>"]
+    with open(os.path.join(directory, "vocab.json"), "w") as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(os.path.join(directory, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    tokenizer = CLIPTokenizer(
+        os.path.join(directory, "vocab.json"),
+        os.path.join(directory, "merges.txt"),
+        model_max_length=max_length,
+    )
+    tokenizer.save_pretrained(directory)
+    return tokenizer
+
+
+def make_tiny_sdxl(directory: str, sample_size: int = 16):
+    """
+    Build randomly initialised, few-layer SDXL base and refiner pipelines.
+    Like the real refiner, the tiny refiner has no first text encoder, uses aesthetic score
+    conditioning and shares the base's second text encoder and VAE.
+    :param directory: Folder to write the tokenizers to.
+    :param sample_size: Latent resolution; images are 2x larger with the tiny VAE.
+    :return: Tuple (base, refiner).
+    """
+    import torch
+    from diffusers import (
+        AutoencoderKL,
+        EulerDiscreteScheduler,
+        StableDiffusionXLImg2ImgPipeline,
+        StableDiffusionXLPipeline,
+        UNet2DConditionModel,
+    )
+    from transformers import (
+        CLIPTextConfig,
+        CLIPTextModel,
+        CLIPTextModelWithProjection,
+    )
+
+    tokenizer = _write_tiny_clip_tokenizer(os.path.join(directory, "tokenizer"))
+    text_config = dict(
+        vocab_size=tokenizer.vocab_size,
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        max_position_embeddings=tokenizer.model_max_length,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+
+    def unet(cross_attention_dim, time_ids):
+        return UNet2DConditionModel(
+            sample_size=sample_size,
+            in_channels=4,
+            out_channels=4,
+            block_out_channels=(32, 64),
+            layers_per_block=1,
+            down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+            up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+            attention_head_dim=(2, 4),
+            cross_attention_dim=cross_attention_dim,
+            transformer_layers_per_block=(1, 1),
+            addition_embed_type="text_time",
+            addition_time_embed_dim=8,
+            projection_class_embeddings_input_dim=time_ids * 8 + 16,
+            norm_num_groups=8,
+        )
+
+    def scheduler():
+        return EulerDiscreteScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            timestep_spacing="leading",
+            steps_offset=1,
+        )
+
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(CLIPTextConfig(**text_config))
+    text_encoder_2 = CLIPTextModelWithProjection(
+        CLIPTextConfig(**text_config, projection_dim=16)
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(16, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=sample_size * 2,
+    )
+
+    base = StableDiffusionXLPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        text_encoder_2=text_encoder_2,
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet(cross_attention_dim=32, time_ids=6),
+        scheduler=scheduler(),
+    )
+    refiner = StableDiffusionXLImg2ImgPipeline(
+        vae=vae,
+        text_encoder=None,
+        text_encoder_2=text_encoder_2,
+        tokenizer=None,
+        tokenizer_2=tokenizer,
+        unet=unet(cross_attention_dim=16, time_ids=5),
+        scheduler=scheduler(),
+        requires_aesthetics_score=True,
+        force_zeros_for_empty_prompt=False,
+    )
+    for pipe in (base, refiner):
+        pipe.set_progress_bar_config(disable=True)
+    return base, refiner
+
+
+def make_tiny_sd(directory: str, sample_size: int = 16):
+    """
+    Build a randomly initialised, few-layer Stable Diffusion (SD2-style) pipeline.
+    :param directory: Folder to write the tokenizer to.
+    :param sample_size: Latent resolution; images are 2x larger with the tiny VAE.
+    :return: The pipeline.
+    """
+    import torch
+    from diffusers import (
+        AutoencoderKL,
+        EulerDiscreteScheduler,
+        StableDiffusionPipeline,
+        UNet2DConditionModel,
+    )
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    tokenizer = _write_tiny_clip_tokenizer(os.path.join(directory, "tokenizer"))
+    torch.manual_seed(0)
+    text_encoder = CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=tokenizer.vocab_size,
+            hidden_size=16,
+            intermediate_size=32,
+            num_hidden_layers=2,
+            num_attention_heads=2,
+            max_position_embeddings=tokenizer.model_max_length,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+    )
+    unet = UNet2DConditionModel(
+        sample_size=sample_size,
+        in_channels=4,
+        out_channels=4,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        cross_attention_dim=16,
+        norm_num_groups=8,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=(16, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+        up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=sample_size * 2,
+    )
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=EulerDiscreteScheduler(
+            beta_start=0.00085,
+            beta_end=0.012,
+            beta_schedule="scaled_linear",
+            timestep_spacing="leading",
+            steps_offset=1,
+        ),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
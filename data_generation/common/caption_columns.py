@@ -0,0 +1,348 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+from collections.abc import Mapping
+
+import numpy as np
+
+FORMAT = "columnar-captions"
+VERSION = 1
+
+# Ids decoded at once when iterating a column
+CHUNK_SIZE = 4096
+
+
+def _path_hash(data: bytes) -> int:
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def _write_blob(directory: str, name: str, values):
+    """Write encoded strings as one blob plus an int64 offsets array (len + 1 entries)."""
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    with open(os.path.join(directory, f"{name}.bin"), "wb") as f:
+        for i, value in enumerate(values):
+            f.write(value)
+            offsets[i + 1] = offsets[i] + len(value)
+    np.save(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+
+
+def _build_index(hashes: np.ndarray) -> np.ndarray:
+    """
+    Open-addressing hash table (linear probing, at most half full) mapping a path's hash
+    to its id. Built vectorised: every round places, for each free slot, the first id
+    that probes it, and moves the others on to their next slot.
+    """
+    size = 1 << max(1, int(2 * len(hashes)).bit_length())
+    mask = size - 1
+    table = np.full(size, -1, dtype=np.int64)
+    ids = np.arange(len(hashes), dtype=np.int64)
+    slots = (hashes & np.uint64(mask)).astype(np.int64)
+    while len(ids):
+        free = table[slots] == -1
+        candidate_slots, first = np.unique(slots[free], return_index=True)
+        placed = np.flatnonzero(free)[first]
+        table[candidate_slots] = ids[placed]
+        remaining = np.ones(len(ids), dtype=bool)
+        remaining[placed] = False
+        ids = ids[remaining]
+        slots = (slots[remaining] + 1) & mask
+    return table
+
+
+def write_columnar_captions(directory: str, captions_by_model: dict, metadata=None):
+    """
+    Write captions as a columnar store: one sorted table of image paths shared by every
+    model and, per model, the captions of all paths as one UTF-8 blob with offsets.
+    The store replaces `directory` once completely written.
+    :param directory: Folder of the store, e.g. output.captions next to output.json.
+    :param captions_by_model: Dictionary {model_name: {image_path: caption}}.
+    :param metadata: Optional metadata kept with the store (like output.json's).
+    """
+    paths = sorted(set().union(*captions_by_model.values()))
+    encoded_paths = [path.encode() for path in paths]
+
+    tmp_dir = f"{directory}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    _write_blob(tmp_dir, "paths", encoded_paths)
+    hashes = np.array([_path_hash(path) for path in encoded_paths], dtype=np.uint64)
+    np.save(os.path.join(tmp_dir, "paths.index.npy"), _build_index(hashes))
+
+    for i, captions in enumerate(captions_by_model.values()):
+        np.save(
+            os.path.join(tmp_dir, f"model_{i}.present.npy"),
+            np.array([path in captions for path in paths], dtype=bool),
+        )
+        _write_blob(
+            tmp_dir,
+            f"model_{i}",
+            [str(captions.get(path, "")).encode() for path in paths],
+        )
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "format": FORMAT,
+                "version": VERSION,
+                "count": len(paths),
+                "model_names": list(captions_by_model),
+                "metadata": metadata or {},
+            },
+            f,
+            indent=4,
+        )
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_dir, directory)
+
+
+def is_columnar(path: str) -> bool:
+    """Return True if path is a columnar caption store folder."""
+    meta_path = os.path.join(path, "meta.json")
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, "r") as f:
+        return json.load(f).get("format") == FORMAT
+
+
+def _load_array(path: str):
+    """
+    Memory-map a .npy file. Returns the array and a memoryview of it: indexing the view
+    gives Python ints and bools several times faster than indexing the array.
+    """
+    array = np.load(path, mmap_mode="r")
+    return array, memoryview(array) if len(array) else array
+
+
+class _Blob:
+    """Memory-mapped strings addressed by index (see _write_blob)."""
+
+    def __init__(self, directory: str, name: str):
+        self.offsets, self._offsets = _load_array(
+            os.path.join(directory, f"{name}.offsets.npy")
+        )
+        with open(os.path.join(directory, f"{name}.bin"), "rb") as f:
+            # mmap cannot map an empty file
+            self.data = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if os.fstat(f.fileno()).st_size
+                else b""
+            )
+
+    def __getitem__(self, index: int) -> bytes:
+        return self.data[self._offsets[index] : self._offsets[index + 1]]
+
+    def strings(self, ids: np.ndarray) -> list:
+        """Decode the strings of many ids at once."""
+        starts = self.offsets[ids].tolist()
+        ends = self.offsets[ids + 1].tolist()
+        if not starts:
+            return []
+        # One decode of the span they cover; for ASCII text, str and byte offsets agree
+        first, data = starts[0], bytes(self.data[starts[0] : ends[-1]])
+        text = data.decode()
+        if len(text) != len(data):
+            return [data[a - first : b - first].decode() for a, b in zip(starts, ends)]
+        return [text[a - first : b - first] for a, b in zip(starts, ends)]
+
+
+class ColumnarCaptions:
+    """
+    Read-only view of a columnar caption store. Nothing is loaded up front: the path
+    table, hash index and caption columns are memory-mapped, so opening a store of
+    millions of images is instant and only the pages that are read take memory.
+    """
+
+    def __init__(self, directory: str):
+        """
+        :param directory: Folder written by write_columnar_captions.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT or meta.get("version") != VERSION:
+            raise ValueError(f"{directory} is not a columnar caption store")
+        self.model_names = meta["model_names"]
+        self.metadata = meta["metadata"]
+        self.count = meta["count"]
+        self._paths = _Blob(directory, "paths")
+        _, self._index = _load_array(os.path.join(directory, "paths.index.npy"))
+        self._columns = {}
+
+    def __len__(self):
+        return self.count
+
+    def path(self, path_id: int) -> str:
+        return self._paths[path_id].decode()
+
+    def path_id(self, path: str):
+        """Return the id of an image path in O(1), or None if the store does not have it."""
+        key = path.encode()
+        mask = len(self._index) - 1
+        slot = _path_hash(key) & mask
+        while True:
+            path_id = self._index[slot]
+            if path_id == -1:
+                return None
+            if self._paths[path_id] == key:
+                return path_id
+            slot = (slot + 1) & mask
+
+    def column(self, model_name: str = None) -> "CaptionColumn":
+        """
+        Return the captions of one model as a read-only mapping {image_path: caption}.
+        :param model_name: Model in the store, defaults to the first one.
+        """
+        if model_name is None:
+            model_name = self.model_names[0]
+        if model_name not in self._columns:
+            if model_name not in self.model_names:
+                raise KeyError(f"{model_name} is not in {self.directory}")
+            self._columns[model_name] = CaptionColumn(
+                self, model_name, self.model_names.index(model_name)
+            )
+        return self._columns[model_name]
+
+    def common_ids(self, model_names=None) -> np.ndarray:
+        """Ids of the images captioned by every given model (all by default), vectorised."""
+        present = np.ones(self.count, dtype=bool)
+        for model_name in model_names or self.model_names:
+            present &= self.column(model_name).present
+        return np.flatnonzero(present)
+
+    def common_paths(self, model_names=None):
+        """Sorted paths of the images captioned by every given model."""
+        return self._paths.strings(self.common_ids(model_names))
+
+
+class CaptionColumn(Mapping):
+    """Captions of one model in a ColumnarCaptions store, as a lazy read-only mapping."""
+
+    def __init__(self, store: ColumnarCaptions, model_name: str, index: int):
+        self.store = store
+        self.model_name = model_name
+        self.present, self._present = _load_array(
+            os.path.join(store.directory, f"model_{index}.present.npy")
+        )
+        self._texts = _Blob(store.directory, f"model_{index}")
+        self._len = None
+
+    def caption(self, path_id: int):
+        """Return the caption of an image id, or None if this model has none."""
+        if not self._present[path_id]:
+            return None
+        return self._texts[path_id].decode()
+
+    def __getitem__(self, path: str) -> str:
+        path_id = self.store.path_id(path)
+        caption = None if path_id is None else self.caption(path_id)
+        if caption is None:
+            raise KeyError(path)
+        return caption
+
+    def __iter__(self):
+        for path_id in np.flatnonzero(self.present).tolist():
+            yield self.store.path(path_id)
+
+    def __len__(self):
+        if self._len is None:
+            self._len = int(np.count_nonzero(self.present))
+        return self._len
+
+    def items(self):
+        """(image_path, caption) pairs in sorted path order, without hash lookups."""
+        ids = np.flatnonzero(self.present)
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start : start + CHUNK_SIZE]
+            yield from zip(self.store._paths.strings(chunk), self._texts.strings(chunk))
+
+
+def load_captions(path: str, model_name: str = None):
+    """
+    Read the captions of a caption file: an output.json ({"captions": {image_path:
+    caption}}, or a merged multi-model one) or a columnar caption store, which is
+    memory-mapped instead of loaded.
+    :param path: output.json or columnar store folder.
+    :param model_name: Model to read from a store or merged output.json with several,
+                       defaults to the first.
+    :return: Mapping {image_path: caption}.
+    """
+    if os.path.isdir(path):
+        return ColumnarCaptions(path).column(model_name)
+    captions_by_model = read_output_json(path)
+    if model_name is None or len(captions_by_model) == 1:
+        # A single-model output.json is named after its folder, not its model
+        return next(iter(captions_by_model.values()))
+    if model_name not in captions_by_model:
+        raise KeyError(f"{model_name} is not in {path}")
+    return captions_by_model[model_name]
+
+
+def sorted_items(captions):
+    """
+    (image_path, caption) pairs of a caption mapping, sorted by path. A CaptionColumn is
+    read lazily in its stored order instead of being loaded and sorted.
+    """
+    if isinstance(captions, CaptionColumn):
+        return captions.items()
+    return iter(sorted(captions.items()))
+
+
+def common_image_paths(captions_by_model) -> list:
+    """
+    Sorted image paths present in every mapping. Columns of one columnar store are
+    intersected with a vectorised AND of their presence masks; anything else with sets.
+    :param captions_by_model: Iterable of {image_path: caption} mappings.
+    """
+    columns = list(captions_by_model)
+    if (
+        columns
+        and all(isinstance(column, CaptionColumn) for column in columns)
+        and len({id(column.store) for column in columns}) == 1
+    ):
+        return columns[0].store.common_paths([column.model_name for column in columns])
+    return sorted(set.intersection(*[set(column.keys()) for column in columns]))
+
+
+def read_output_json(path: str) -> dict:
+    """
+    Read an output.json as {model_name: {image_path: caption}}: every model of a merged
+    multi-model file, or the single model named by the file's folder.
+    """
+    with open(path, "r") as f:
+        data = json.load(f)
+    model_names = data.get("metadata", {}).get("model_names")
+    if model_names:
+        return {
+            model_name: {
+                image_path: captions[model_name]
+                for image_path, captions in data["captions"].items()
+                if model_name in captions
+            }
+            for model_name in model_names
+        }
+    return {os.path.basename(os.path.dirname(path)): data.get("captions", {})}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Join the captions of one or more output.json files into a columnar store."
+    )
+    parser.add_argument("output_dir", help="Folder of the store, e.g. output.captions.")
+    parser.add_argument("json_paths", nargs="+", help="output.json files to join.")
+    args = parser.parse_args()
+
+    captions_by_model = {}
+    for json_path in args.json_paths:
+        captions_by_model.update(read_output_json(json_path))
+    write_columnar_captions(args.output_dir, captions_by_model)
+    store = ColumnarCaptions(args.output_dir)
+    print(
+        f"Wrote {len(store)} images and {len(store.model_names)} models to {args.output_dir} "
+        f"({len(store.common_ids())} images captioned by every model)."
+    )
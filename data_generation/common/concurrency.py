@@ -0,0 +1,235 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from logzero import logger
+
+from common.tracing import tracer
+
+
+def retry_with_backoff(fn, retries=3, backoff=1.0, max_backoff=30.0, retry_if=None):
+    """
+    Call `fn` and retry it with exponential backoff when it raises.
+    :param fn: Zero-argument callable to run.
+    :param retries: Number of retries after the first attempt.
+    :param backoff: Delay in seconds before the first retry, doubled on every retry.
+    :param max_backoff: Upper bound for a single delay in seconds.
+    :param retry_if: Optional predicate deciding whether an exception is transient.
+                     Exceptions it rejects are raised immediately.
+    :return: The return value of `fn`.
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= retries or (retry_if is not None and not retry_if(e)):
+                raise
+            # Full jitter keeps many workers from retrying in lockstep
+            delay = min(max_backoff, backoff * 2**attempt) * random.uniform(0.5, 1.0)
+            logger.warning(
+                f"Attempt {attempt + 1} failed ({e!r}), retrying in {delay:.2f}s"
+            )
+            tracer.count("retries")
+            time.sleep(delay)
+            attempt += 1
+
+
+def ordered_map(fn, items, max_in_flight=4, max_pending=None):
+    """
+    Apply `fn` to every item on a thread pool and yield the results in input order.
+    At most `max_in_flight` calls run at the same time and at most `max_pending`
+    results are held back waiting for a slower earlier item, so memory stays bounded
+    no matter how long `items` is.
+    :param fn: Callable taking a single item.
+    :param items: Iterable of items, consumed lazily.
+    :param max_in_flight: Number of worker threads.
+    :param max_pending: Number of submitted but not yet yielded items
+                        (defaults to twice `max_in_flight`).
+    :return: Generator of `fn(item)` results.
+    """
+    max_pending = max_pending or 2 * max_in_flight
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Consumer stopped early or a call failed: drop whatever has not started
+            for future in pending:
+                future.cancel()
+
+
+# Requests averaged before the average counts as a baseline
+WARMUP_REQUESTS = 5
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the number of requests in flight, adapted to the observed latency and
+    errors, like TCP congestion control. The latency signal is an exponentially weighted
+    moving average (per output token when the server reports token counts), so requests
+    that are merely long do not look like overload. While it stays within `tolerance`
+    times its lowest value so far (the baseline), each request that completes while the
+    limit is in use raises the limit by 1/limit (about +1 per round trip), or by 1
+    (doubling it every round trip) until the first decrease, as in slow start. A higher
+    average multiplies it by `backoff`, and a transient error (timeout, overload, 5xx) or
+    the end of slow start halves it, at most once per round trip. An average that is
+    still too high a round trip after the limit reached `min_limit` becomes the new
+    baseline, as the server itself got slower. The limit, in-flight count and queue depth
+    are published as gauges.
+    """
+
+    def __init__(
+        self,
+        initial: int = 1,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        tolerance: float = 1.5,
+        backoff: float = 0.75,
+        smoothing: float = 0.05,
+        name: str = "ollama",
+    ):
+        """
+        :param initial: Limit to start with.
+        :param min_limit: Lowest limit.
+        :param max_limit: Highest limit; callers should have at least this many threads.
+        :param tolerance: Average latency, as a multiple of the baseline, above which the
+                          server counts as overloaded.
+        :param backoff: Factor the limit is multiplied by when latency is too high.
+        :param smoothing: Weight of each new latency in the moving average.
+        :param name: Prefix of the published gauges.
+        """
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.name = name
+        self.in_flight = 0
+        self.waiting = 0
+        self.increases = 0
+        self.decreases = 0
+        # Moving average of the latency signal, and its lowest value as the baseline
+        self._samples = 0
+        self._average = 0.0
+        self._baseline = None
+        # Moving average of the request duration in seconds, for the once-per-RTT rule
+        self._round_trip = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a request may be sent and count it as in flight."""
+        with self._condition:
+            self.waiting += 1
+            self._publish()
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.waiting -= 1
+            self.in_flight += 1
+            self._publish()
+
+    def release(
+        self, latency: float = None, overloaded: bool = False, tokens: int = None
+    ):
+        """
+        Count a request as done and adapt the limit.
+        :param latency: Seconds the request took, None when it failed.
+        :param overloaded: True when it failed with a transient error.
+        :param tokens: Tokens the server generated for it, if known; the latency per
+                       token is then the signal, which does not depend on answer length.
+        """
+        with self._condition:
+            busy = self.waiting > 0 or self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                self._decrease(now, 0.5)
+            elif latency is not None:
+                signal = latency / tokens if tokens else latency
+                # Plain mean of the first 1/smoothing requests, so it starts unbiased
+                self._samples += 1
+                weight = max(self.smoothing, 1 / self._samples)
+                self._average += weight * (signal - self._average)
+                self._round_trip += weight * (latency - self._round_trip)
+                if self._samples < WARMUP_REQUESTS:
+                    congested = False
+                elif self._baseline is None or self._average < self._baseline:
+                    self._baseline = self._average
+                    congested = False
+                else:
+                    # In slow start the average lags the doubling limit: a single slow
+                    # request ends it, at the cost of one needless halving at worst
+                    congested = self.tolerance * self._baseline < (
+                        signal if self.decreases == 0 else self._average
+                    )
+                if (
+                    congested
+                    and self.limit <= self.min_limit
+                    and now - self._last_decrease > self._round_trip
+                ):
+                    self._baseline = self._average
+                elif congested:
+                    # Slow start overshoots by up to twice the limit that overloaded it
+                    factor = 0.5 if self.decreases == 0 else self.backoff
+                    self._decrease(now, factor)
+                elif busy and self.limit < self.max_limit:
+                    # Only grow a limit that is actually reached
+                    step = 1 if self.decreases == 0 else 1 / self.limit
+                    self.limit = min(self.max_limit, self.limit + step)
+                    self.increases += 1
+            self._publish()
+            self._condition.notify_all()
+
+    def _decrease(self, now: float, factor: float):
+        # Requests sent before the last decrease still see the old load: skip them
+        if now - self._last_decrease < self._round_trip:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * factor)
+        self.decreases += 1
+
+    def _publish(self):
+        tracer.gauge(f"{self.name}.limit", int(self.limit))
+        tracer.gauge(f"{self.name}.in_flight", self.in_flight)
+        tracer.gauge(f"{self.name}.queue_depth", self.waiting)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "queue_depth": self.waiting,
+                "increases": self.increases,
+                "decreases": self.decreases,
+            }
+
+
+# Process-wide limiter shared by every Ollama-bound stage, see shared_limiter
+_shared_limiter = None
+_shared_limiter_lock = threading.Lock()
+
+
+def shared_limiter(**options) -> AdaptiveLimiter:
+    """
+    Return the process-wide AdaptiveLimiter, creating it with `options` on first use,
+    so stages talking to the same Ollama server(s) adapt one common limit.
+    A later caller's max_limit raises the shared one if it is higher, so a stage with
+    more threads can use them; the other options of later callers are ignored.
+    """
+    global _shared_limiter
+    with _shared_limiter_lock:
+        if _shared_limiter is None:
+            _shared_limiter = AdaptiveLimiter(**options)
+        elif options.get("max_limit", 0) > _shared_limiter.max_limit:
+            with _shared_limiter._condition:
+                _shared_limiter.max_limit = options["max_limit"]
+        return _shared_limiter
@@ -0,0 +1,288 @@
+import gc
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from logzero import logger
+
+from common.tracing import tracer
+
+MB = 1024**2
+
+
+def device_type(device) -> str:
+    """Memory pool a device draws from: "cuda:1" -> "cuda", None -> "cpu"."""
+    return str(device or "cpu").split(":")[0]
+
+
+def _modules(obj, seen, depth=0):
+    """torch modules reachable from a model, a pipeline's components or a wrapper's attributes."""
+    import torch
+
+    if id(obj) in seen or depth > 3:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, torch.nn.Module):
+        yield obj
+    elif isinstance(obj, (tuple, list)):
+        for item in obj:
+            yield from _modules(item, seen, depth + 1)
+    elif isinstance(getattr(obj, "components", None), dict):
+        # diffusers pipelines
+        for component in obj.components.values():
+            yield from _modules(component, seen, depth + 1)
+    elif hasattr(obj, "__dict__"):
+        # Wrappers such as ImageCaptioningModel holding the module as an attribute
+        for value in vars(obj).values():
+            yield from _modules(value, seen, depth + 1)
+
+
+def footprint(model) -> dict:
+    """
+    Bytes of the parameters and buffers of a model, per device type. Works for torch
+    modules, diffusers pipelines, tuples of them and objects holding them; tensors shared
+    between components (e.g. the SDXL refiner's VAE) are counted once.
+    :return: {device type: bytes}, empty for models without torch tensors (e.g. Ollama).
+    """
+    # A model that has torch tensors has imported torch already
+    if "torch" not in sys.modules:
+        return {}
+    sizes, tensors = defaultdict(int), set()
+    for module in _modules(model, set()):
+        for tensor in (*module.parameters(), *module.buffers()):
+            if tensor.device.type == "meta":
+                continue
+            key = (tensor.device, tensor.data_ptr())
+            if key not in tensors:
+                tensors.add(key)
+                sizes[tensor.device.type] += tensor.numel() * tensor.element_size()
+    return dict(sizes)
+
+
+class _Entry:
+    def __init__(self, key, loader, device, estimate_mb):
+        self.key = key
+        self.loader = loader
+        self.device = device_type(device)
+        self.estimate_mb = estimate_mb
+        self.model = None
+        # Measured at the last load, so a reload knows what to make room for
+        self.footprint = {}
+        self.pins = 0
+        self.loads = 0
+        self.load_seconds = 0.0
+
+    def expected(self) -> dict:
+        if self.footprint:
+            return self.footprint
+        if self.estimate_mb:
+            return {self.device: self.estimate_mb * MB}
+        return {}
+
+
+class ModelRegistry:
+    """
+    Loads models on first use and keeps them under a memory budget per device type (RAM
+    for "cpu", VRAM for "cuda"). The footprint of every loaded model is measured from its
+    torch tensors. Before a model is loaded, and again once its real size is known, the
+    least recently used models are unloaded until everything fits; a model that is
+    evicted is loaded again the next time it is asked for. Models in use (see `pinned`) are
+    never evicted. Loads are serialized, so two large models never load at once.
+
+    Callers must not keep references to the models they get, or evicting them frees nothing.
+    """
+
+    def __init__(self, budgets_mb: dict = None):
+        """
+        :param budgets_mb: {device type: MB}, e.g. {"cuda": 22000, "cpu": 48000}.
+                           Device types without a budget are not limited.
+        """
+        self.budgets_mb = dict(budgets_mb or {})
+        self.evictions = 0
+        # Least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def register(self, key: str, loader, device=None, estimate_mb: float = None):
+        """
+        Declare a model without loading it. Registering a key again keeps the loaded model.
+        :param key: Name of the model, unique within the registry.
+        :param loader: Zero-argument callable returning the loaded model.
+        :param device: Device the loader puts the model on.
+        :param estimate_mb: Expected size, used to make room before the first load.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = _Entry(key, loader, device, estimate_mb)
+            else:
+                entry.loader = loader
+                entry.estimate_mb = estimate_mb or entry.estimate_mb
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def get(self, key: str):
+        """Return a registered model, loading it (and evicting others) if needed."""
+        with self._lock:
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            if entry.model is None:
+                self._load(entry)
+            return entry.model
+
+    @contextmanager
+    def pinned(self, *keys):
+        """
+        Keep models from being evicted for the duration of a block, e.g. while a job runs.
+        They are still loaded lazily, by `get`.
+        """
+        with self._lock:
+            for key in keys:
+                self._entries[key].pins += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                for key in keys:
+                    self._entries[key].pins -= 1
+
+    def _load(self, entry: _Entry):
+        self._make_room(entry.expected(), keep=entry)
+        start_time = time.perf_counter()
+        with tracer.span("models.load"):
+            entry.model = entry.loader()
+        seconds = time.perf_counter() - start_time
+        entry.loads += 1
+        entry.load_seconds += seconds
+        entry.footprint = footprint(entry.model)
+        tracer.count("models.loads")
+        logger.info(
+            f"Loaded {entry.key} in {seconds:.1f}s ({self._describe(entry.footprint)})"
+        )
+        # The first load of a model without an estimate only now knows its size
+        self._make_room({}, keep=entry)
+
+    def _make_room(self, needed: dict, keep: _Entry):
+        """Evict least recently used, unpinned models until `needed` bytes fit every budget."""
+        for device, budget_mb in self.budgets_mb.items():
+            budget = budget_mb * MB
+            while self._used(device) + needed.get(device, 0) > budget:
+                victim = next(
+                    (
+                        entry
+                        for entry in self._entries.values()
+                        if entry is not keep
+                        and entry.model is not None
+                        and entry.pins == 0
+                        and entry.footprint.get(device)
+                    ),
+                    None,
+                )
+                if victim is None:
+                    logger.warning(
+                        f"Models need {(self._used(device) + needed.get(device, 0)) / MB:.0f} MB "
+                        f"of {device} memory, over the {budget_mb} MB budget, and none can be evicted"
+                    )
+                    break
+                self.evict(victim.key)
+        self._publish()
+
+    def evict(self, key: str):
+        """Unload a model; it is loaded again the next time it is asked for."""
+        with self._lock:
+            entry = self._entries[key]
+            if entry.model is None:
+                return
+            if entry.pins:
+                raise RuntimeError(f"{key} is in use and cannot be evicted")
+            entry.model = None
+            self.evictions += 1
+            tracer.count("models.evictions")
+            logger.info(f"Evicted {key} ({self._describe(entry.footprint)})")
+            self._free_memory()
+            self._publish()
+
+    def clear(self):
+        """Unload every model that is not in use."""
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.model is not None and not entry.pins:
+                    self.evict(key)
+
+    @staticmethod
+    def _free_memory():
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            # Hand the cached blocks of the unloaded model back to the driver
+            torch.cuda.empty_cache()
+
+    def _used(self, device: str) -> int:
+        return sum(
+            entry.footprint.get(device, 0)
+            for entry in self._entries.values()
+            if entry.model is not None
+        )
+
+    @staticmethod
+    def _describe(sizes: dict) -> str:
+        return (
+            ", ".join(f"{size / MB:.0f} MB {device}" for device, size in sizes.items())
+            or "no local memory"
+        )
+
+    def _publish(self):
+        for device in self.budgets_mb:
+            tracer.gauge(f"models.{device}_mb", round(self._used(device) / MB))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budgets_mb": dict(self.budgets_mb),
+                "used_mb": {
+                    device: round(self._used(device) / MB)
+                    for device in {
+                        device
+                        for entry in self._entries.values()
+                        for device in entry.footprint
+                    }
+                    | set(self.budgets_mb)
+                },
+                "evictions": self.evictions,
+                "models": {
+                    key: {
+                        "loaded": entry.model is not None,
+                        "loads": entry.loads,
+                        "load_seconds": round(entry.load_seconds, 2),
+                        "mb": {
+                            device: round(size / MB)
+                            for device, size in entry.footprint.items()
+                        },
+                    }
+                    for key, entry in self._entries.items()
+                },
+            }
+
+
+# Process-wide registry, so caption and generation jobs in one worker share one budget
+_shared_registry = None
+_shared_registry_lock = threading.Lock()
+
+
+def shared_registry(budgets_mb: dict = None) -> ModelRegistry:
+    """
+    Return the process-wide ModelRegistry, creating it on first use.
+    :param budgets_mb: {device type: MB}; budgets given by a later caller replace the
+                       earlier ones for those device types.
+    """
+    global _shared_registry
+    with _shared_registry_lock:
+        if _shared_registry is None:
+            _shared_registry = ModelRegistry(budgets_mb)
+        elif budgets_mb:
+            with _shared_registry._lock:
+                _shared_registry.budgets_mb.update(budgets_mb)
+        return _shared_registry
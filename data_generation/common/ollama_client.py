@@ -0,0 +1,185 @@
+import base64
+import threading
+import time
+
+import httpx
+import ollama
+
+from common.concurrency import AdaptiveLimiter, shared_limiter
+
+# Strategies for picking the server of the next request
+ROUND_ROBIN = "round_robin"
+LEAST_LOADED = "least_loaded"
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Return True for Ollama errors that are worth retrying (overload, server errors, dropped connections)."""
+    if isinstance(error, ollama.ResponseError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, ConnectionError))
+
+
+def encode_image(data: bytes) -> str:
+    """
+    Base64-encode an image file's content once, in the form the Ollama API expects.
+    Passing the result in a message's "images" skips the client reading and encoding the
+    file again for every request (and every retry).
+    """
+    return base64.b64encode(data).decode()
+
+
+def read_image(image_path: str) -> str:
+    """Read and base64-encode an image file (see encode_image)."""
+    with open(image_path, "rb") as f:
+        return encode_image(f.read())
+
+
+class OllamaClientPool:
+    """
+    Drop-in replacement for ollama.Client that spreads requests over one or more Ollama
+    servers. Every server gets one ollama.Client whose HTTP connections are pooled and kept
+    alive, shared by all threads. A request goes to the next server in turn (round_robin)
+    or to the server with the fewest requests in flight (least_loaded). A server whose
+    connection fails is skipped for `cooldown` seconds while others are available.
+    With a limiter, requests wait for a slot of its adaptive in-flight limit, which covers
+    all servers of the pool, and their latency and transient errors adapt the limit.
+    """
+
+    def __init__(
+        self,
+        hosts=None,
+        timeout: float = None,
+        strategy: str = LEAST_LOADED,
+        max_connections: int = 32,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 10.0,
+        cooldown: float = 5.0,
+        limiter: AdaptiveLimiter = None,
+    ):
+        """
+        :param hosts: Ollama server URL or list of URLs, defaults to $OLLAMA_HOST or the
+                      local server.
+        :param timeout: Per-request timeout in seconds (None waits forever).
+        :param strategy: "least_loaded" or "round_robin".
+        :param max_connections: Connections kept open per server.
+        :param keepalive_expiry: Seconds an idle connection is kept open.
+        :param connect_timeout: Seconds to wait for a connection, so a server that is down
+                                fails fast even when requests may take minutes.
+        :param cooldown: Seconds a server is skipped after a connection failure.
+        :param limiter: Optional AdaptiveLimiter, e.g. shared_limiter() to share one
+                        limit with the other stages of the process.
+        """
+        if strategy not in (ROUND_ROBIN, LEAST_LOADED):
+            raise ValueError(
+                f"Unknown strategy {strategy}, expected {ROUND_ROBIN} or {LEAST_LOADED}"
+            )
+        if hosts is None or isinstance(hosts, str):
+            hosts = [hosts]
+        self.hosts = list(hosts)
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.limiter = limiter
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if timeout is not None:
+            timeout = httpx.Timeout(timeout, connect=min(connect_timeout, timeout))
+        self.clients = [
+            ollama.Client(host=host, timeout=timeout, limits=limits)
+            for host in self.hosts
+        ]
+        self.in_flight = [0] * len(self.clients)
+        self.requests = [0] * len(self.clients)
+        self.failures = [0] * len(self.clients)
+        self._down_until = [0.0] * len(self.clients)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self) -> int:
+        """Pick the server of the next request and count it as in flight."""
+        with self._lock:
+            now = time.monotonic()
+            count = len(self.clients)
+            # Scan from the next server in turn, so ties go round-robin
+            order = [(self._next + offset) % count for offset in range(count)]
+            up = [index for index in order if self._down_until[index] <= now] or order
+            if self.strategy == LEAST_LOADED:
+                index = min(up, key=lambda index: self.in_flight[index])
+            else:
+                index = up[0]
+            self._next = (index + 1) % count
+            self.in_flight[index] += 1
+            self.requests[index] += 1
+            return index
+
+    def chat(self, **kwargs):
+        """Send a chat request (same arguments as ollama.Client.chat) to one of the servers."""
+        if self.limiter:
+            self.limiter.acquire()
+        index = self._acquire()
+        latency, overloaded, tokens = None, False, None
+        start = time.perf_counter()
+        try:
+            response = self.clients[index].chat(**kwargs)
+            latency = time.perf_counter() - start
+            # Streamed responses have no token count until they are consumed
+            tokens = getattr(response, "eval_count", None)
+            return response
+        except Exception as e:
+            overloaded = is_transient_error(e)
+            with self._lock:
+                self.failures[index] += 1
+                if isinstance(e, (httpx.TransportError, ConnectionError)):
+                    self._down_until[index] = time.monotonic() + self.cooldown
+            raise
+        finally:
+            with self._lock:
+                self.in_flight[index] -= 1
+            if self.limiter:
+                self.limiter.release(latency, overloaded, tokens)
+
+    def stats(self):
+        """Requests and failures per server."""
+        with self._lock:
+            return [
+                {
+                    "host": str(client._client.base_url),
+                    "requests": requests,
+                    "failures": failures,
+                }
+                for client, requests, failures in zip(
+                    self.clients, self.requests, self.failures
+                )
+            ]
+
+    def close(self):
+        for client in self.clients:
+            client._client.close()
+
+
+def create_client(options: dict = None) -> OllamaClientPool:
+    """
+    Build an OllamaClientPool from a config section, e.g. [Concurrency]:
+    hosts (or host), request_timeout, balance, max_connections and keepalive_expiry.
+    With adaptive = true the pool uses the process-wide AdaptiveLimiter, starting at
+    min_in_flight and growing up to max_in_flight.
+    """
+    options = options or {}
+    limiter = None
+    if options.get("adaptive"):
+        limiter = shared_limiter(
+            initial=options.get("min_in_flight", 1),
+            min_limit=options.get("min_in_flight", 1),
+            max_limit=options.get("max_in_flight", 4),
+            tolerance=options.get("latency_tolerance", 1.5),
+        )
+    return OllamaClientPool(
+        options.get("hosts") or options.get("host"),
+        timeout=options.get("request_timeout"),
+        strategy=options.get("balance", LEAST_LOADED),
+        max_connections=options.get("max_connections", 32),
+        keepalive_expiry=options.get("keepalive_expiry", 60.0),
+        limiter=limiter,
+    )
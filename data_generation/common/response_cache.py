@@ -0,0 +1,53 @@
+import hashlib
+import json
+import os
+import threading
+
+
+class ResponseCache:
+    """
+    On-disk cache of LLM responses, one small JSON file per key.
+    Keys are hashes of everything that determines the response (prompt, model, schema...),
+    so reruns and partial reruns only pay for requests whose inputs changed.
+    """
+
+    def __init__(self, cache_dir: str):
+        """
+        :param cache_dir: Folder holding the cached responses.
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(**parts) -> str:
+        """Hash the given JSON-serialisable parts into a cache key."""
+        payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Two-level layout keeps directories small for large caches
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str):
+        """Return the cached response for key, or None."""
+        try:
+            with open(self._path(key), "r") as f:
+                value = json.load(f)["response"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value):
+        """Store a response; safe to call from several threads and processes."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"response": value}, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,250 @@
+import bisect
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets, Prometheus style
+BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+# Shared by every span of a disabled tracer, so a disabled span costs one attribute check
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    """Latency histogram over BUCKETS, plus count, sum, min and max."""
+
+    __slots__ = ("bucket_counts", "count", "sum", "min", "max")
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """Return [(upper bound, observations <= bound)], ending with +Inf."""
+        total, result = 0, []
+        for bound, count in zip(BUCKETS + (math.inf,), self.bucket_counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile as the upper bound of the bucket that contains it."""
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_seconds": self.sum,
+            "mean_seconds": self.sum / self.count if self.count else 0.0,
+            "min_seconds": self.min if self.count else 0.0,
+            "max_seconds": self.max,
+            "p50_seconds": self.quantile(0.5),
+            "p95_seconds": self.quantile(0.95),
+            "buckets": {
+                _format_bound(bound): total for bound, total in self.cumulative()
+            },
+        }
+
+
+def _format_bound(bound: float) -> str:
+    return "+Inf" if bound == math.inf else repr(bound)
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "start")
+
+    def __init__(self, tracer, name: str):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.observe(self.name, time.perf_counter() - self.start)
+
+
+class Tracer:
+    """
+    Lightweight per-stage instrumentation: spans time a block of code into a latency
+    histogram per stage name, counters count events and gauges keep the latest value of
+    a level (e.g. a concurrency limit) along with its peak. All are thread-safe, and while
+    the tracer is disabled (the default) they do nothing, so they can stay in hot loops.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def enable(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def span(self, name: str):
+        """
+        Context manager timing its block into the histogram of stage `name`.
+        Exceptions are timed as well and propagate unchanged.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float):
+        """Add a duration measured elsewhere to the histogram of stage `name`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, value: int = 1):
+        """Increase counter `name` by value."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """Set gauge `name` to value, keeping track of its maximum."""
+        if not self.enabled:
+            return
+        with self._lock:
+            gauge = self.gauges.get(name)
+            if gauge is None:
+                self.gauges[name] = {"value": value, "max": value}
+            else:
+                gauge["value"] = value
+                gauge["max"] = max(gauge["max"], value)
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def snapshot(self) -> dict:
+        """
+        Return {"spans": {name: histogram dict}, "counters": {name: value},
+        "gauges": {name: {"value", "max"}}}.
+        """
+        with self._lock:
+            return {
+                "spans": {
+                    name: histogram.to_dict()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+                "gauges": {
+                    name: dict(gauge) for name, gauge in sorted(self.gauges.items())
+                },
+            }
+
+    def to_prometheus(self, prefix: str = "immerso") -> str:
+        """Render the histograms and counters in the Prometheus text exposition format."""
+        lines = [
+            f"# HELP {prefix}_stage_seconds Time spent per pipeline stage.",
+            f"# TYPE {prefix}_stage_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self.histograms.items()):
+                for bound, total in histogram.cumulative():
+                    lines.append(
+                        f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{_format_bound(bound)}"}} {total}'
+                    )
+                lines.append(
+                    f'{prefix}_stage_seconds_sum{{stage="{name}"}} {histogram.sum}'
+                )
+                lines.append(
+                    f'{prefix}_stage_seconds_count{{stage="{name}"}} {histogram.count}'
+                )
+            lines.append(f"# HELP {prefix}_events_total Pipeline event counters.")
+            lines.append(f"# TYPE {prefix}_events_total counter")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+            lines.append(f"# HELP {prefix}_gauge Current level of a pipeline gauge.")
+            lines.append(f"# TYPE {prefix}_gauge gauge")
+            for name, gauge in sorted(self.gauges.items()):
+                lines.append(f'{prefix}_gauge{{name="{name}"}} {gauge["value"]}')
+            lines.append(
+                f"# HELP {prefix}_gauge_max Highest level of a pipeline gauge."
+            )
+            lines.append(f"# TYPE {prefix}_gauge_max gauge")
+            for name, gauge in sorted(self.gauges.items()):
+                lines.append(f'{prefix}_gauge_max{{name="{name}"}} {gauge["max"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: str):
+        """
+        Write the metrics to path: Prometheus text for .prom/.txt files, JSON otherwise.
+        """
+        if os.path.splitext(path)[1] in (".prom", ".txt"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=4)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def summary(self) -> str:
+        """One line per stage, most total time first, for the end-of-run log."""
+        snapshot = self.snapshot()
+        lines = [
+            f"{'stage':<28} {'count':>8} {'total s':>10} {'mean ms':>10} {'p95 ms':>10}"
+        ]
+        for name, stats in sorted(
+            snapshot["spans"].items(), key=lambda item: -item[1]["total_seconds"]
+        ):
+            lines.append(
+                f"{name:<28} {stats['count']:>8} {stats['total_seconds']:>10.2f} "
+                f"{stats['mean_seconds'] * 1000:>10.1f} {stats['p95_seconds'] * 1000:>10.1f}"
+            )
+        for name, value in snapshot["counters"].items():
+            lines.append(f"{name:<28} {value:>8}")
+        for name, gauge in snapshot["gauges"].items():
+            lines.append(f"{name:<28} {gauge['value']:>8} (max {gauge['max']})")
+        return "\n".join(lines)
+
+
+# Process-wide tracer used by every pipeline; enabled by their metrics options
+tracer = Tracer()
@@ -1,16 +1,31 @@
+import os
+import sys
+
+import torch
 from PIL import Image
 from transformers import BlipForConditionalGeneration, BlipProcessor
 
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from common.tracing import tracer  # noqa: E402
+
+# Prompt used for the conditional caption
+CONDITIONAL_PROMPT = "a photography of"
+
 
 class ImageCaptioningModel:
-    def __init__(self, model_name: str, device: str = "cuda"):
+    def __init__(self, model_name: str, device: str = None):
         """
         Initialize the image captioning model and processor.
         :param model_name: The name of the model to use (e.g., "Salesforce/blip-image-captioning-base").
-        :param device: The device to run the model on ("cuda" or "cpu").
+        :param device: The device to run the model on ("cuda" or "cpu"). Defaults to cuda when available.
         """
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
         self.processor = BlipProcessor.from_pretrained(model_name)
         self.model = BlipForConditionalGeneration.from_pretrained(model_name).to(device)
+        self.model.eval()
         self.device = device
 
     def generate_caption(self, image_path: str):
@@ -20,18 +35,27 @@ class ImageCaptioningModel:
         :return: A tuple of (conditional_caption, unconditional_caption).
         """
         # Open the image
-        raw_image = Image.open(image_path).convert("RGB")
+        with tracer.span("blip.read_image"):
+            raw_image = Image.open(image_path).convert("RGB")
 
-        # Conditional captioning
-        text = "a photography of"
-        inputs = self.processor(raw_image, text, return_tensors="pt").to(self.device)
-        out = self.model.generate(**inputs)
-        caption_conditional = self.processor.decode(out[0], skip_special_tokens=True)
+        with tracer.span("blip.generate"):
+            # Conditional captioning
+            text = CONDITIONAL_PROMPT
+            inputs = self.processor(raw_image, text, return_tensors="pt").to(
+                self.device
+            )
+            out = self.model.generate(**inputs)
+            caption_conditional = self.processor.decode(
+                out[0], skip_special_tokens=True
+            )
 
-        # Unconditional captioning
-        inputs = self.processor(raw_image, return_tensors="pt").to(self.device)
-        out = self.model.generate(**inputs)
-        caption_unconditional = self.processor.decode(out[0], skip_special_tokens=True)
+            # Unconditional captioning
+            inputs = self.processor(raw_image, return_tensors="pt").to(self.device)
+            out = self.model.generate(**inputs)
+            caption_unconditional = self.processor.decode(
+                out[0], skip_special_tokens=True
+            )
+        tracer.count("blip.images")
 
         data = {
             "image_path": image_path,
@@ -40,3 +64,113 @@ class ImageCaptioningModel:
         }
 
         return data
+
+    def preprocess(self, image_path: str):
+        """
+        Decode, resize and normalize one image to the processor's input size.
+        Safe to call from several threads, so images can be prepared ahead of the model.
+        :param image_path: The path to the image.
+        :return: Pixel tensor of shape (3, height, width) on the CPU.
+        """
+        with tracer.span("blip.read_image"), Image.open(image_path) as image:
+            image = image.convert("RGB")
+        return self.preprocess_image(image)
+
+    def preprocess_image(self, image):
+        """
+        Resize and normalize an already decoded RGB image (see preprocess).
+        :param image: RGB PIL image.
+        :return: Pixel tensor of shape (3, height, width) on the CPU.
+        """
+        with tracer.span("blip.preprocess"):
+            return self.processor(images=image, return_tensors="pt")["pixel_values"][0]
+
+    def generate_captions_batch(self, image_paths, batch_size: int = 8):
+        """
+        Generate conditional and unconditional captions for many images, batch_size at a time.
+        Each image goes through the vision encoder once and both caption modes reuse its embeddings.
+        :param image_paths: List of image paths.
+        :param batch_size: Number of images preprocessed and decoded together.
+        :return: List of caption dictionaries (same keys as generate_caption), in input order.
+        """
+        results = []
+        for start in range(0, len(image_paths), batch_size):
+            batch_paths = image_paths[start : start + batch_size]
+            pixel_values = [self.preprocess(path) for path in batch_paths]
+            results.extend(
+                self.generate_captions_from_pixels(batch_paths, pixel_values)
+            )
+        return results
+
+    @torch.inference_mode()
+    def generate_captions_from_pixels(self, image_paths, pixel_values):
+        """
+        Caption one batch of images that were already preprocessed (see preprocess).
+        :param image_paths: Paths of the images, used as keys in the result.
+        :param pixel_values: List of pixel tensors of shape (3, height, width).
+        :return: List of caption dictionaries.
+        """
+        pixel_values = torch.stack(pixel_values).to(self.device, self.model.dtype)
+
+        # Single vision-encoder pass shared by both caption modes
+        with tracer.span("blip.vision_encoder"):
+            image_embeds = self.model.vision_model(pixel_values=pixel_values)[0]
+
+        # Conditional: the prompt is the same for every image, so no padding is needed
+        prompt = self.processor.tokenizer(
+            [CONDITIONAL_PROMPT] * len(image_paths), return_tensors="pt"
+        ).to(self.device)
+        captions_conditional = self._decode(
+            image_embeds, prompt.input_ids, prompt.attention_mask
+        )
+
+        # Unconditional: start from the decoder's BOS token only
+        text_config = self.model.config.text_config
+        input_ids = torch.tensor(
+            [[self.model.decoder_input_ids, text_config.eos_token_id]]
+            * len(image_paths),
+            device=self.device,
+        )
+        captions_unconditional = self._decode(image_embeds, input_ids)
+        tracer.count("blip.images", len(image_paths))
+
+        return [
+            {
+                "image_path": image_path,
+                "caption": conditional,
+                "unconditional_caption": unconditional,
+            }
+            for image_path, conditional, unconditional in zip(
+                image_paths, captions_conditional, captions_unconditional
+            )
+        ]
+
+    def _decode(self, image_embeds, input_ids, attention_mask=None):
+        """
+        Run the text decoder on precomputed image embeddings.
+        Mirrors BlipForConditionalGeneration.generate without re-running the vision model.
+        :param image_embeds: Vision encoder output of shape (batch, patches, hidden).
+        :param input_ids: Prompt token ids ending with the [SEP] token.
+        :param attention_mask: Attention mask for input_ids, if any.
+        :return: List of decoded captions.
+        """
+        text_config = self.model.config.text_config
+        image_attention_mask = torch.ones(
+            image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device
+        )
+
+        input_ids = input_ids.clone()
+        input_ids[:, 0] = text_config.bos_token_id
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, :-1]
+
+        with tracer.span("blip.text_decoder"):
+            out = self.model.text_decoder.generate(
+                input_ids=input_ids[:, :-1],
+                eos_token_id=text_config.sep_token_id,
+                pad_token_id=text_config.pad_token_id,
+                attention_mask=attention_mask,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_attention_mask,
+            )
+        return self.processor.batch_decode(out, skip_special_tokens=True)
@@ -0,0 +1,251 @@
+import hashlib
+import json
+import os
+import time
+
+from logzero import logger
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Hash the content of a file.
+    :param path: Path to the file.
+    :param chunk_size: Bytes read at a time.
+    :return: Hex digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def shard_path(path: str, index: int, count: int) -> str:
+    """Return the per-shard variant of an output path, e.g. output.shard-0-of-4.jsonl."""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard-{index}-of-{count}{ext}"
+
+
+def merged_captions(store_paths, model_name: str, hashes: dict = None) -> dict:
+    """
+    Merge the captions of one model from several stores (e.g. one per shard).
+    :param store_paths: Paths to JSONL caption stores.
+    :param model_name: Model whose captions to merge.
+    :param hashes: Optional {image_path: content_hash} of the current images (see
+                   CaptionStore.captions).
+    :return: Dictionary of image paths and captions, sorted by path.
+    """
+    captions = {}
+    for store_path in store_paths:
+        captions.update(CaptionStore(store_path).captions(model_name, hashes))
+    return dict(sorted(captions.items()))
+
+
+def merged_captions_by_image(store_paths, model_names, hashes: dict = None) -> dict:
+    """
+    Merge the captions of several models from several stores (e.g. one per shard).
+    :param store_paths: Paths to JSONL caption stores.
+    :param model_names: Models whose captions to merge.
+    :param hashes: Optional {image_path: content_hash} of the current images (see
+                   CaptionStore.captions).
+    :return: Dictionary of image paths and {model_name: caption}, sorted by path.
+    """
+    captions = {}
+    for store_path in store_paths:
+        for image_path, by_model in (
+            CaptionStore(store_path).captions_by_image(model_names, hashes).items()
+        ):
+            captions.setdefault(image_path, {}).update(by_model)
+    return dict(sorted(captions.items()))
+
+
+class CaptionStore:
+    """
+    Append-only JSONL store of captions, keyed by image path, image content hash and model name.
+    Captions are buffered and appended in batches, so an interrupted run keeps everything
+    flushed so far and a rerun only captions the images that are missing or have changed.
+    """
+
+    def __init__(self, path: str, flush_every: int = 32):
+        """
+        Open (or create) the store and load the records already in it.
+        :param path: Path to the JSONL file.
+        :param flush_every: Number of buffered records that triggers a write to disk.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.records = {}
+        self._buffer = []
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._load()
+
+    @staticmethod
+    def key(image_path: str, content_hash: str, model_name: str):
+        return image_path, content_hash, model_name
+
+    def _load(self):
+        """
+        Read the existing records. A partially written last line (from a crash in the
+        middle of a flush) is cut off so new records are appended after a clean newline.
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            data = f.read()
+        valid_end = data.rfind(b"\n") + 1
+        if valid_end < len(data):
+            logger.warning(
+                f"Dropping a partially written record at the end of {self.path}"
+            )
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+
+        for line in data[:valid_end].splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            self.records[
+                self.key(
+                    record["image_path"], record["content_hash"], record["model_name"]
+                )
+            ] = record
+        logger.info(f"Loaded {len(self.records)} captions from {self.path}")
+
+    def has(self, image_path: str, content_hash: str, model_name: str) -> bool:
+        """Return True if this exact image content was already captioned by the model."""
+        return self.key(image_path, content_hash, model_name) in self.records
+
+    def add(self, image_path: str, content_hash: str, model_name: str, data: dict):
+        """
+        Record a caption, writing it to disk once `flush_every` records are buffered.
+        :param image_path: Path of the captioned image.
+        :param content_hash: Hash of the image content (see file_hash).
+        :param model_name: Model that produced the caption.
+        :param data: Caption dictionary returned by the model, must contain "caption".
+        """
+        record = {
+            **data,
+            "image_path": image_path,
+            "content_hash": content_hash,
+            "model_name": model_name,
+        }
+        self.records[self.key(image_path, content_hash, model_name)] = record
+        self._buffer.append(record)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Append the buffered records to the file and sync them to disk."""
+        if not self._buffer:
+            return
+        lines = "".join(json.dumps(record) + "\n" for record in self._buffer)
+        with open(self.path, "a") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def captions(self, model_name: str, hashes: dict = None) -> dict:
+        """
+        Collect the captions of one model as {image_path: caption}.
+        :param model_name: Model whose captions to return.
+        :param hashes: Optional {image_path: content_hash} of the current images, which
+                       restricts (and orders) the result to those images and picks the
+                       caption of their current content.
+        :return: Dictionary of image paths and captions. Without hashes, when a path was
+                 captioned more than once (its content changed), the latest caption wins.
+        """
+        if hashes is not None:
+            captions = {}
+            for image_path, content_hash in hashes.items():
+                record = self.records.get(
+                    self.key(image_path, content_hash, model_name)
+                )
+                if record is not None:
+                    captions[image_path] = record["caption"]
+            return captions
+
+        captions = {}
+        for (image_path, _, model), record in self.records.items():
+            if model == model_name:
+                captions[image_path] = record["caption"]
+        return captions
+
+    def captions_by_image(self, model_names, hashes: dict = None) -> dict:
+        """
+        Collect the captions of several models as {image_path: {model_name: caption}}.
+        :param model_names: Models whose captions to return.
+        :param hashes: Optional {image_path: content_hash} of the current images (see
+                       captions).
+        :return: Dictionary of image paths and per-model captions.
+        """
+        by_model = {
+            model_name: self.captions(model_name, hashes) for model_name in model_names
+        }
+        if hashes is None:
+            image_paths = sorted({path for c in by_model.values() for path in c})
+        else:
+            image_paths = list(hashes)
+
+        captions = {}
+        for image_path in image_paths:
+            image_captions = {
+                model_name: model_captions[image_path]
+                for model_name, model_captions in by_model.items()
+                if image_path in model_captions
+            }
+            if image_captions:
+                captions[image_path] = image_captions
+        return captions
+
+    def export_json(self, output_path: str, model_name: str, metadata: dict = None):
+        """
+        Write the captions of one model in the {"metadata", "captions"} output.json format.
+        :param output_path: Path of the JSON file to write.
+        :param model_name: Model whose captions to export.
+        :param metadata: Metadata to write, defaults to the model name and caption count.
+        :return: The exported captions.
+        """
+        self.flush()
+        captions = self.captions(model_name)
+        if metadata is None:
+            metadata = {"model_name": model_name, "total_no_of_images": len(captions)}
+
+        # Write to a temporary file first so a crash never leaves a half-written output.json
+        tmp_path = f"{output_path}.tmp"
+        with open(tmp_path, "w") as json_file:
+            json.dump({"metadata": metadata, "captions": captions}, json_file, indent=4)
+        os.replace(tmp_path, output_path)
+        return captions
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Export the captions of one model from a caption store to output.json."
+    )
+    parser.add_argument("store_path", help="Path to the JSONL caption store.")
+    parser.add_argument("model_name", help="Model whose captions to export.")
+    parser.add_argument("output_path", help="Path of the output.json to write.")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    captions = CaptionStore(args.store_path).export_json(
+        args.output_path, args.model_name
+    )
+    print(
+        f"Exported {len(captions)} captions to {args.output_path} in {time.time() - start_time:.2f}s."
+    )
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+
+from logzero import logger
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+MANIFEST_VERSION = 1
+
+
+class ImageManifest:
+    """
+    Cached recursive listing of the images under a dataset folder.
+    For every directory the manifest keeps its mtime, its subdirectories and its images
+    (size, mtime and, once known, content hash). A directory's mtime only changes when
+    entries are added, removed or renamed in it, so later scans reuse the cached listing of
+    unchanged directories and only call os.scandir on the ones that changed. Files rewritten
+    in place keep their directory's mtime, so the images of reused listings are still
+    stat'ed, and lose their hash when their size or mtime changed.
+    """
+
+    def __init__(
+        self, root: str, manifest_path: str, extensions=IMAGE_EXTENSIONS, rescan=False
+    ):
+        """
+        :param root: Dataset folder to scan recursively.
+        :param manifest_path: JSON file the listing is cached in.
+        :param extensions: Image file extensions to keep (case-insensitive).
+        :param rescan: Ignore the cached listing and scan every directory again.
+        """
+        # "data/" and "data" must give the same directory keys
+        self.root = os.path.normpath(root)
+        self.manifest_path = manifest_path
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.dirs = {}
+        self.scanned_dirs = 0
+        self.cached_dirs = 0
+
+        if not rescan:
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_path):
+            return
+        with open(self.manifest_path, "r") as f:
+            data = json.load(f)
+        if (
+            data.get("version") != MANIFEST_VERSION
+            or data.get("root") != self.root
+            or tuple(data.get("extensions", ())) != self.extensions
+        ):
+            logger.info(f"Ignoring outdated manifest {self.manifest_path}")
+            return
+        self.dirs = data["dirs"]
+
+    def save(self):
+        """Write the manifest atomically."""
+        if os.path.dirname(self.manifest_path):
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        data = {
+            "version": MANIFEST_VERSION,
+            "root": self.root,
+            "extensions": list(self.extensions),
+            "dirs": self.dirs,
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _scan_dir(self, directory: str, mtime_ns: int):
+        """List one directory with os.scandir (one stat per image, no per-file listdir+stat)."""
+        subdirs, files = [], {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.name.lower().endswith(self.extensions) and entry.is_file():
+                    stat = entry.stat()
+                    files[entry.name] = [stat.st_size, stat.st_mtime_ns, None]
+        return {"mtime_ns": mtime_ns, "subdirs": sorted(subdirs), "files": files}
+
+    def _restat(self, directory: str, listing: dict):
+        """Update the size and mtime of the images of a cached listing, forgetting stale hashes."""
+        for name, info in list(listing["files"].items()):
+            try:
+                stat = os.stat(os.path.join(directory, name))
+            except FileNotFoundError:
+                del listing["files"][name]
+                continue
+            if [stat.st_size, stat.st_mtime_ns] != info[:2]:
+                listing["files"][name] = [stat.st_size, stat.st_mtime_ns, None]
+
+    def scan(self):
+        """
+        Refresh the listing, rescanning only directories whose mtime changed.
+        :return: Sorted list of image paths.
+        """
+        self.scanned_dirs = self.cached_dirs = 0
+        dirs = {}
+        stack = [self.root]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            cached = self.dirs.get(directory)
+            if cached is not None and cached["mtime_ns"] == mtime_ns:
+                listing = cached
+                self.cached_dirs += 1
+                self._restat(directory, listing)
+            else:
+                listing = self._scan_dir(directory, mtime_ns)
+                self.scanned_dirs += 1
+                if cached is not None:
+                    # Keep the content hashes of images whose size and mtime did not change
+                    for name, info in listing["files"].items():
+                        previous = cached["files"].get(name)
+                        if previous is not None and previous[:2] == info[:2]:
+                            info[2] = previous[2]
+
+            dirs[directory] = listing
+            stack.extend(os.path.join(directory, name) for name in listing["subdirs"])
+
+        # Directories that disappeared are dropped along with their images
+        self.dirs = dirs
+        logger.info(
+            f"Scanned {self.scanned_dirs} directories, reused {self.cached_dirs} from {self.manifest_path}"
+        )
+        return self.image_paths()
+
+    def image_paths(self):
+        """Return the sorted list of image paths in the manifest."""
+        return sorted(
+            os.path.join(directory, name)
+            for directory, listing in self.dirs.items()
+            for name in listing["files"]
+        )
+
+    def adopt_hashes(self, other: "ImageManifest"):
+        """
+        Take the content hashes another manifest of the same dataset (e.g. a shard's)
+        knows for images this one has not hashed yet, if their size and mtime match.
+        """
+        for directory, listing in self.dirs.items():
+            other_files = other.dirs.get(directory, {}).get("files", {})
+            for name, info in listing["files"].items():
+                known = other_files.get(name)
+                if info[2] is None and known is not None and known[:2] == info[:2]:
+                    info[2] = known[2]
+
+    def _file(self, image_path: str):
+        directory, name = os.path.split(os.path.normpath(image_path))
+        return self.dirs[directory]["files"][name]
+
+    def get_hash(self, image_path: str):
+        """Return the cached content hash of an image, or None if it is not known yet."""
+        return self._file(image_path)[2]
+
+    def set_hash(self, image_path: str, content_hash: str):
+        self._file(image_path)[2] = content_hash
+
+
+def parse_shard(shard: str):
+    """
+    Parse a shard specification.
+    :param shard: String of the form "i/N", with 0 <= i < N.
+    :return: Tuple (i, N).
+    """
+    index, count = (int(part) for part in shard.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}: expected i/N with 0 <= i < N")
+    return index, count
+
+
+def shard_of(relative_path: str, count: int) -> int:
+    """
+    Deterministically assign a path to one of `count` shards.
+    The assignment only depends on the path, so it is the same on every machine and does
+    not move existing images between shards when new ones are added.
+    """
+    digest = hashlib.blake2b(relative_path.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def select_shard(image_paths, root: str, index: int, count: int):
+    """
+    Keep the images that belong to shard `index` of `count`.
+    :param image_paths: List of image paths under root.
+    :param root: Dataset folder; shards are computed from paths relative to it.
+    :return: List of image paths in the shard, in input order.
+    """
+    return [
+        path
+        for path in image_paths
+        if shard_of(os.path.relpath(path, root), count) == index
+    ]
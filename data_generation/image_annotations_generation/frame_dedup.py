@@ -0,0 +1,213 @@
+import json
+import os
+import sys
+
+import numpy as np
+from logzero import logger
+from PIL import Image
+
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.concurrency import ordered_map  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+
+# Number of set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def load_thumbnail(image_path: str, hash_size: int = 8) -> np.ndarray:
+    """
+    Decode an image to the small grayscale thumbnail a difference hash is computed from.
+    :param image_path: Path of the image.
+    :param hash_size: Rows of the thumbnail; it has one more column than rows.
+    :return: uint8 array of shape (hash_size, hash_size + 1).
+    """
+    with Image.open(image_path) as image:
+        # Let JPEG decode at a reduced scale; the thumbnail is tiny anyway
+        image.draft("L", (hash_size * 8, hash_size * 8))
+        thumbnail = image.convert("L").resize(
+            (hash_size + 1, hash_size), Image.Resampling.BOX
+        )
+    return np.asarray(thumbnail, dtype=np.uint8)
+
+
+def difference_hashes(thumbnails: np.ndarray) -> np.ndarray:
+    """
+    Compute the difference hash (dHash) of many thumbnails at once: one bit per pair of
+    horizontally adjacent pixels, set when the brightness increases to the right.
+    :param thumbnails: uint8 array of shape (count, hash_size, hash_size + 1).
+    :return: uint8 array of shape (count, hash_size * hash_size / 8), the packed bits.
+    """
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return np.packbits(bits.reshape(len(thumbnails), -1), axis=1)
+
+
+def hamming_distances(hash_: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+    """Number of differing bits between one packed hash and every row of `hashes`."""
+    return POPCOUNT[np.bitwise_xor(hashes, hash_)].sum(axis=1, dtype=np.int32)
+
+
+def cluster_hashes(hashes: np.ndarray, threshold: int):
+    """
+    Greedy leader clustering in input order: a hash joins the nearest cluster whose
+    representative (first member) is within `threshold` bits, otherwise it starts a
+    new cluster. The result only depends on the order of the hashes.
+    :param hashes: Packed hashes, one row per image.
+    :param threshold: Maximum Hamming distance to a cluster's representative.
+    :return: List of clusters, each a list of row indices starting with its representative.
+    """
+    representatives = np.empty_like(hashes)
+    clusters = []
+    for index, hash_ in enumerate(hashes):
+        if clusters:
+            distances = hamming_distances(hash_, representatives[: len(clusters)])
+            nearest = int(distances.argmin())
+            if distances[nearest] <= threshold:
+                clusters[nearest].append(index)
+                continue
+        representatives[len(clusters)] = hash_
+        clusters.append([index])
+    return clusters
+
+
+class FrameDeduplicator:
+    """
+    Group visually near-identical images (e.g. the long static runs of a video's frames) so
+    only one image per group has to be captioned. Images are compared by the Hamming
+    distance of their difference hashes, within each folder (one video per folder).
+    Hashes are cached by image content hash, so reruns only decode new or changed images.
+    """
+
+    def __init__(
+        self,
+        threshold: int = 4,
+        hash_size: int = 8,
+        cache_path: str = None,
+        num_workers: int = 4,
+    ):
+        """
+        :param threshold: Maximum number of differing hash bits (of hash_size**2) for two
+                          images to count as duplicates; 0 only merges identical hashes.
+        :param hash_size: Rows and columns of the hash bit grid.
+        :param cache_path: Optional JSON file caching the hashes by content hash.
+        :param num_workers: Threads decoding images.
+        """
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.cache_path = cache_path
+        self.num_workers = num_workers
+        self.cache = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                data = json.load(f)
+            if data.get("hash_size") == hash_size:
+                self.cache = data["hashes"]
+
+    def save(self):
+        """Write the hash cache atomically."""
+        if not self.cache_path:
+            return
+        if os.path.dirname(self.cache_path):
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"hash_size": self.hash_size, "hashes": self.cache}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def _load(self, image_path: str):
+        try:
+            return load_thumbnail(image_path, self.hash_size)
+        except Exception as e:
+            logger.error(f"Failed to hash {image_path}: {e}")
+            return None
+
+    def hashes(self, image_paths, content_hashes: dict) -> dict:
+        """
+        Return the packed hash of every image, decoding only those not in the cache.
+        :param image_paths: List of image paths.
+        :param content_hashes: Dictionary of image path to content hash (see file_hash).
+        :return: Dictionary of image path to packed hash; unreadable images are left out.
+        """
+        missing = [
+            path for path in image_paths if content_hashes[path] not in self.cache
+        ]
+        if missing:
+            with tracer.span("dedup.hash"):
+                loaded = [
+                    (path, thumbnail)
+                    for path, thumbnail in zip(
+                        missing,
+                        ordered_map(
+                            self._load, missing, max_in_flight=self.num_workers
+                        ),
+                    )
+                    if thumbnail is not None
+                ]
+                if loaded:
+                    packed = difference_hashes(np.stack([t for _, t in loaded]))
+                    for (path, _), hash_ in zip(loaded, packed):
+                        self.cache[content_hashes[path]] = hash_.tobytes().hex()
+            self.save()
+
+        return {
+            path: np.frombuffer(
+                bytes.fromhex(self.cache[content_hashes[path]]), np.uint8
+            )
+            for path in image_paths
+            if content_hashes[path] in self.cache
+        }
+
+    def clusters(self, image_paths, content_hashes: dict):
+        """
+        Group the images of every folder into clusters of near-duplicates.
+        :param image_paths: Sorted list of image paths (frames in playback order).
+        :param content_hashes: Dictionary of image path to content hash.
+        :return: List of clusters (lists of image paths, representative first); images
+                 that could not be hashed are clusters of their own.
+        """
+        hashes = self.hashes(image_paths, content_hashes)
+        by_folder = {}
+        for path in image_paths:
+            by_folder.setdefault(os.path.dirname(path), []).append(path)
+
+        clusters = []
+        with tracer.span("dedup.cluster"):
+            for paths in by_folder.values():
+                hashed = [path for path in paths if path in hashes]
+                clusters.extend([path] for path in paths if path not in hashes)
+                if not hashed:
+                    continue
+                for members in cluster_hashes(
+                    np.stack([hashes[path] for path in hashed]), self.threshold
+                ):
+                    clusters.append([hashed[index] for index in members])
+        return clusters
+
+
+def plan_deduplication(clusters, todo: dict, model_names):
+    """
+    Pick, for every cluster and model, the single image that gets captioned and the images
+    that receive its caption instead. An image already captioned by the model is used as
+    the source when there is one, so nothing in that cluster is captioned again.
+    Removes the copied (image, model) pairs from `todo`.
+    :param clusters: Clusters from FrameDeduplicator.clusters.
+    :param todo: Dictionary of image path to the model names that still need it.
+    :param model_names: Configured models.
+    :return: List of (image_path, model_name, source_image_path) copies.
+    """
+    copies = []
+    for members in clusters:
+        if len(members) == 1:
+            continue
+        for model_name in model_names:
+            needing = [path for path in members if model_name in todo[path]]
+            if not needing:
+                continue
+            done = [path for path in members if model_name not in todo[path]]
+            source = done[0] if done else needing[0]
+            for path in needing:
+                if path != source:
+                    todo[path].remove(model_name)
+                    copies.append((path, model_name, source))
+    return copies
@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+
+from logzero import logger
+
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.concurrency import ordered_map  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+
+
+class PrefetchLoader:
+    """
+    Decode and preprocess images on a worker pool while the model works on earlier ones.
+    At most `prefetch` prepared images are held at any time, and the loader keeps no
+    reference to an image once it has been handed out, so memory stays bounded.
+    """
+
+    def __init__(self, image_paths, load_fn, num_workers: int = 4, prefetch: int = 32):
+        """
+        :param image_paths: List of image paths, loaded in this order.
+        :param load_fn: Callable turning an image path into model input (e.g. a pixel tensor).
+        :param num_workers: Number of loader threads.
+        :param prefetch: Maximum number of loaded images waiting for the model.
+        """
+        self.image_paths = image_paths
+        self.load_fn = load_fn
+        self.num_workers = num_workers
+        self.prefetch = max(prefetch, num_workers)
+
+        # Seconds the consumer spent blocked waiting for the next image
+        self.wait_time = 0.0
+
+    def _load(self, image_path):
+        try:
+            with tracer.span("loader.load"):
+                return image_path, self.load_fn(image_path)
+        except Exception as e:
+            logger.error(f"Failed to load {image_path}: {e}")
+            return image_path, None
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __iter__(self):
+        """Yield (image_path, item) pairs in order; item is None if the image failed to load."""
+        loaded = ordered_map(
+            self._load,
+            self.image_paths,
+            max_in_flight=self.num_workers,
+            max_pending=self.prefetch,
+        )
+        while True:
+            start = time.perf_counter()
+            try:
+                image_path, item = next(loaded)
+            except StopIteration:
+                return
+            finally:
+                wait = time.perf_counter() - start
+                self.wait_time += wait
+                tracer.observe("loader.wait", wait)
+            yield image_path, item
+
+    def batches(self, batch_size: int):
+        """Yield (image_paths, items) lists of up to batch_size successfully loaded images."""
+        paths, items = [], []
+        for image_path, item in self:
+            if item is None:
+                continue
+            paths.append(image_path)
+            items.append(item)
+            if len(paths) == batch_size:
+                yield paths, items
+                paths, items = [], []
+        if paths:
+            yield paths, items
@@ -1,73 +1,510 @@
+import argparse
+import glob
+import io
 import json
 import os
+import re
+import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import toml
 from logzero import logger
+from PIL import Image
 
 from tqdm import tqdm
 
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from caption_store import (  # noqa: E402
+    CaptionStore,
+    file_hash,
+    merged_captions,
+    merged_captions_by_image,
+    shard_path,
+)
+from common.caption_columns import write_columnar_captions  # noqa: E402
+from common.concurrency import ordered_map  # noqa: E402
+from common.model_registry import shared_registry  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+from dataset_discovery import (  # noqa: E402
+    IMAGE_EXTENSIONS,
+    ImageManifest,
+    parse_shard,
+    select_shard,
+)
+from frame_dedup import FrameDeduplicator, plan_deduplication  # noqa: E402
+from image_loader import PrefetchLoader  # noqa: E402
+
 
 class CaptioningPipeline:
-    def __init__(self, config_path: str):
+    def __init__(
+        self, config_path: str, shard: str = None, rescan=False, load_model=True
+    ):
         """
         Initialize the captioning pipeline, loading configuration and model(s).
         :param config_path: Path to the TOML configuration file.
+        :param shard: Optional "i/N" to caption only shard i of N of the dataset.
+        :param rescan: Ignore the cached dataset manifest and list every directory again.
+        :param load_model: Set to False when only merging shard outputs.
         """
         self.config = toml.load(config_path)
         self.dataset_path = self.config["DatasetInfo"]["dataset_path"]
         self.output_path = self.config["MetaData"]["outputpath"]
-        self.model_name = self.config["ModelInfo"]["modelname"]
+        # Several backends (modelnames) can caption each image in a single pass
+        self.model_names = self.config["ModelInfo"].get("modelnames") or [
+            self.config["ModelInfo"]["modelname"]
+        ]
+        self.model_name = self.model_names[0]
+
+        # Captions are appended to this store as they finish, so a rerun resumes
+        self.store_path = self.config["MetaData"].get(
+            "storepath", os.path.splitext(self.output_path)[0] + ".jsonl"
+        )
+        self.flush_every = self.config["MetaData"].get("flush_every", 32)
+        # Optional memory-mapped columnar copy of the output for large joins across models
+        self.columnar_path = self.config["MetaData"].get("columnar_path")
+
+        # Cached recursive listing of the dataset (path, size, mtime, content hash)
+        self.extensions = self.config["DatasetInfo"].get("extensions", IMAGE_EXTENSIONS)
+        self.manifest_path = self.config["DatasetInfo"].get(
+            "manifest_path",
+            os.path.join(os.path.dirname(self.output_path), "manifest.json"),
+        )
+        self.rescan = rescan
+
+        # Per-stage timings and counters, exported after every run when enabled
+        tracing = self.config.get("Tracing", {})
+        if tracing.get("enabled", False):
+            tracer.enable()
+        self.metrics_path = tracing.get(
+            "metrics_path", os.path.splitext(self.output_path)[0] + ".metrics.json"
+        )
+
+        # Each shard writes its own manifest, store and output; merge_shards joins them
+        self.merged_output_path = self.output_path
+        self.merged_columnar_path = self.columnar_path
+        self.shard = parse_shard(shard) if shard else None
+        if self.shard:
+            self.store_path = shard_path(self.store_path, *self.shard)
+            self.output_path = shard_path(self.output_path, *self.shard)
+            self.manifest_path = shard_path(self.manifest_path, *self.shard)
+            self.metrics_path = shard_path(self.metrics_path, *self.shard)
+            if self.columnar_path:
+                self.columnar_path = shard_path(self.columnar_path, *self.shard)
+
+        # Images per forward pass for models that support batching (BLIP)
+        self.batch_size = self.config["ModelInfo"].get("batch_size", 8)
+
+        # Worker threads decoding images ahead of the model, and how many may wait
+        loader = self.config.get("Loader", {})
+        self.num_workers = loader.get("num_workers", 4)
+        self.prefetch = loader.get("prefetch", 32)
+
+        # Near-identical images (e.g. static video frames) are captioned once and share it
+        dedup = self.config.get("Dedup", {})
+        self.deduplicator = None
+        if dedup.get("enabled", False):
+            cache_path = dedup.get(
+                "cache_path",
+                os.path.splitext(self.output_path)[0] + ".frame_hashes.json",
+            )
+            if self.shard and "cache_path" in dedup:
+                cache_path = shard_path(cache_path, *self.shard)
+            self.deduplicator = FrameDeduplicator(
+                threshold=dedup.get("threshold", 4),
+                hash_size=dedup.get("hash_size", 8),
+                cache_path=cache_path,
+                num_workers=self.num_workers,
+            )
+        self.calls_saved = 0
+
+        # Seconds the last run spent waiting for images vs. inside the model
+        self.io_wait_time = 0.0
+        self.compute_time = 0.0
+
+        # Number of caption requests kept in flight (1 = one image at a time)
+        concurrency = self.config.get("Concurrency", {})
+        self.max_in_flight = concurrency.get("max_in_flight", 1)
+        # Ollama client pool shared by every Ollama model, created with the first one
+        self.ollama_client = None
+
+        # Local models (BLIP) are loaded on first use and may be evicted between runs to
+        # stay within the memory budgets shared with other jobs in this process
+        memory = self.config.get("Memory", {})
+        self.model_registry = shared_registry(memory.get("budgets_mb"))
+        self.model_estimates = memory.get("estimates_mb", {})
 
         # generate the outputpath
         logger.info(f"Creating output directory at {self.output_path}")
         os.makedirs(os.path.dirname(self.output_path), exist_ok=True)
 
-        # Initialize the model(s)
-        if self.model_name == "Salesforce/blip-image-captioning-base":
-            from blip_caption.blip_caption import ImageCaptioningModel
+        if not load_model:
+            return
 
-            self.model = ImageCaptioningModel(self.model_name)
+        # Initialize the model(s): Ollama models now, local ones on first use
+        self.remote_models = {}
+        self.local_models = {}
+        for model_name in self.model_names:
+            backend = self.model_backend(model_name)
+            if backend is None:
+                logger.error(f"Model {model_name} not supported.")
+                return
+            if backend == "blip":
+                device = self.config["ModelInfo"].get("device")
+                key = f"blip:{model_name}:{device or 'auto'}"
+                self.model_registry.register(
+                    key,
+                    lambda model_name=model_name: self.create_model(
+                        model_name, concurrency
+                    ),
+                    device=device,
+                    estimate_mb=self.model_estimates.get(model_name),
+                )
+                self.local_models[model_name] = key
+            else:
+                self.remote_models[model_name] = self.create_model(
+                    model_name, concurrency
+                )
 
-        elif (
-            self.model_name == "llava:7b"
-            or self.model_name == "llama3.2-vision"
-            or self.model_name == "llava-llama3"
+    @property
+    def models(self) -> dict:
+        """
+        Captioning model per model name, loading local models that are not loaded.
+        Every read goes through the model registry; process_images resolves the models
+        once per run and passes them on instead.
+        """
+        return {
+            model_name: (
+                self.model_registry.get(self.local_models[model_name])
+                if model_name in self.local_models
+                else self.remote_models[model_name]
+            )
+            for model_name in self.model_names
+        }
+
+    @property
+    def model(self):
+        return self.models[self.model_name]
+
+    def model_backend(self, model_name: str):
+        """
+        :param model_name: Name of the model from the config.
+        :return: "blip", "ollama", or None if the model is not supported.
+        """
+        # Other model names (e.g. a fine-tuned BLIP folder) name their backend in ModelInfo.backends
+        backend = self.config["ModelInfo"].get("backends", {}).get(model_name)
+        if backend == "blip" or model_name == "Salesforce/blip-image-captioning-base":
+            return "blip"
+        if (
+            backend == "ollama"
+            or model_name == "llava:7b"
+            or model_name == "llama3.2-vision"
+            or model_name == "llava-llama3"
         ):
+            return "ollama"
+        return None
+
+    def create_model(self, model_name: str, concurrency: dict):
+        """
+        Create the captioning model for a model name.
+        :param model_name: Name of the model from the config.
+        :param concurrency: The [Concurrency] config section.
+        :return: The ImageCaptioningModel, or None if the model is not supported.
+        """
+        backend = self.model_backend(model_name)
+
+        if backend == "blip":
+            from blip_caption.blip_caption import ImageCaptioningModel
+
+            with tracer.span("caption.load_model"):
+                return ImageCaptioningModel(
+                    model_name, device=self.config["ModelInfo"].get("device")
+                )
+
+        elif backend == "ollama":
+            from common.ollama_client import create_client
             from ollama_caption.ollama_caption import ImageCaptioningModel
 
-            self.model = ImageCaptioningModel(self.model_name)
+            if self.ollama_client is None:
+                self.ollama_client = create_client(concurrency)
+            return ImageCaptioningModel(
+                model_name,
+                client=self.ollama_client,
+                max_retries=concurrency.get("max_retries", 3),
+                retry_backoff=concurrency.get("retry_backoff", 1.0),
+            )
 
         else:
-            logger.error(f"Model {self.model_name} not supported.")
-            return
+            logger.error(f"Model {model_name} not supported.")
+            return None
 
     def get_all_images(self):
         """
-        Get a list of all image file paths from the dataset folder.
-        :return: List of image paths.
+        Get a list of all image file paths under the dataset folder (recursively),
+        restricted to this pipeline's shard if one was given.
+        :return: Sorted list of image paths.
         """
-        image_paths = []
-        for filename in os.listdir(self.dataset_path):
-            if filename.lower().endswith((".png", ".jpg", ".jpeg")):
-                image_paths.append(os.path.join(self.dataset_path, filename))
+        self.manifest = ImageManifest(
+            self.dataset_path,
+            self.manifest_path,
+            extensions=self.extensions,
+            rescan=self.rescan,
+        )
+        with tracer.span("caption.scan"):
+            image_paths = self.manifest.scan()
+            self.manifest.save()
+
+        if self.shard:
+            image_paths = select_shard(image_paths, self.dataset_path, *self.shard)
+            logger.info(
+                f"Shard {self.shard[0]}/{self.shard[1]}: {len(image_paths)} images"
+            )
         return image_paths
 
+    def get_hashes(self, image_paths):
+        """
+        Get the content hash of every image, hashing only the ones the manifest does not know.
+        :param image_paths: List of image paths from get_all_images.
+        :return: Dictionary of image paths and content hashes.
+        """
+        missing = [path for path in image_paths if self.manifest.get_hash(path) is None]
+        if missing:
+            # Hash on a few threads: this is pure I/O and the dataset may be on a slow mount
+            with tracer.span("caption.hash"):
+                for path, content_hash in zip(
+                    missing, ordered_map(file_hash, missing, max_in_flight=8)
+                ):
+                    self.manifest.set_hash(path, content_hash)
+                self.manifest.save()
+        return {path: self.manifest.get_hash(path) for path in image_paths}
+
+    def generate_captions(self, image_paths, model=None):
+        """
+        Caption the images, batched or concurrently when the model supports it.
+        Time spent waiting for images and time spent in the model are added to
+        io_wait_time and compute_time.
+        :param image_paths: List of image paths.
+        :param model: Captioning model to use, self.model if not given.
+        :return: Generator of caption dictionaries, in the order of image_paths.
+        """
+        if model is None:
+            model = self.model
+        if hasattr(model, "preprocess"):
+            # Decode and preprocess upcoming images on worker threads while the model runs
+            loader = PrefetchLoader(
+                image_paths,
+                model.preprocess,
+                num_workers=self.num_workers,
+                prefetch=self.prefetch,
+            )
+            try:
+                for batch_paths, pixel_values in loader.batches(self.batch_size):
+                    start = time.perf_counter()
+                    results = model.generate_captions_from_pixels(
+                        batch_paths, pixel_values
+                    )
+                    self.compute_time += time.perf_counter() - start
+                    # Drop the pixel buffers before waiting on the next batch
+                    del pixel_values
+                    yield from results
+            finally:
+                self.io_wait_time += loader.wait_time
+        elif self.max_in_flight > 1 and hasattr(model, "generate_captions"):
+            yield from self._timed(
+                model.generate_captions(image_paths, max_in_flight=self.max_in_flight)
+            )
+        else:
+            # A failed request gives a None caption here too, instead of ending the run
+            caption = getattr(model, "try_generate_caption", model.generate_caption)
+            yield from self._timed(caption(img_path) for img_path in image_paths)
+
+    def _load_for_models(self, image_path: str, model_names, models):
+        """
+        Read an image once and prepare it for every model that still needs it:
+        the base64-encoded file for remote models and a pixel tensor for each local model.
+        Encoding happens here on the loader threads, once for all remote models.
+        :param image_path: Path of the image.
+        :param model_names: Models that will caption this image.
+        :param models: Captioning model per model name, see generate_captions_multi.
+        :return: Dictionary with "image" and "pixels" ({model_name: tensor}).
+        """
+        with open(image_path, "rb") as f:
+            data = f.read()
+
+        item = {"image": None, "pixels": {}}
+        local = [name for name in model_names if name in self.local_models]
+        if local:
+            with Image.open(io.BytesIO(data)) as image:
+                image = image.convert("RGB")
+                for name in local:
+                    item["pixels"][name] = models[name].preprocess_image(image)
+        if len(local) < len(model_names):
+            from common.ollama_client import encode_image
+
+            item["image"] = encode_image(data)
+        return item
+
+    def generate_captions_multi(self, image_paths, todo, models=None):
+        """
+        Caption the images with every configured model in a single pass.
+        Each image is read and decoded once; remote (Ollama) requests run on a thread pool
+        while local models (BLIP) caption batches on this thread, so both overlap.
+        :param image_paths: List of image paths.
+        :param todo: Dictionary of image path to the model names that still need it.
+        :param models: Captioning model per model name, self.models if not given.
+        :return: Generator of (model_name, caption dictionary) in completion order.
+        """
+        if models is None:
+            models = self.models
+        local = [name for name in self.model_names if name in self.local_models]
+        remote = [name for name in self.model_names if name not in local]
+
+        loader = PrefetchLoader(
+            image_paths,
+            lambda image_path: self._load_for_models(
+                image_path, todo[image_path], models
+            ),
+            num_workers=self.num_workers,
+            prefetch=self.prefetch,
+        )
+        batches = {name: ([], []) for name in local}
+        in_flight = deque()
+        max_in_flight = self.max_in_flight * max(len(remote), 1)
+
+        def run_local(name):
+            batch_paths, pixel_values = batches[name]
+            batches[name] = ([], [])
+            start = time.perf_counter()
+            results = models[name].generate_captions_from_pixels(
+                batch_paths, pixel_values
+            )
+            self.compute_time += time.perf_counter() - start
+            return [(name, data) for data in results]
+
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            try:
+                for image_path, item in loader:
+                    if item is None:
+                        continue
+                    for name in todo[image_path]:
+                        if name in remote:
+                            future = executor.submit(
+                                models[name].try_generate_caption,
+                                image_path,
+                                image=item["image"],
+                            )
+                            in_flight.append((name, future))
+                        else:
+                            batches[name][0].append(image_path)
+                            batches[name][1].append(item["pixels"].pop(name))
+                            if len(batches[name][0]) == self.batch_size:
+                                yield from run_local(name)
+                    del item
+
+                    # Hand out finished remote captions; block only when too many are queued
+                    while in_flight and (
+                        in_flight[0][1].done() or len(in_flight) > 2 * max_in_flight
+                    ):
+                        name, future = in_flight.popleft()
+                        yield name, future.result()
+
+                for name in local:
+                    if batches[name][0]:
+                        yield from run_local(name)
+                while in_flight:
+                    name, future = in_flight.popleft()
+                    yield name, future.result()
+            finally:
+                self.io_wait_time += loader.wait_time
+                for _, future in in_flight:
+                    future.cancel()
+
+    def _timed(self, results):
+        """Yield from results, adding the time spent producing each one to compute_time."""
+        results = iter(results)
+        while True:
+            start = time.perf_counter()
+            try:
+                data = next(results)
+            except StopIteration:
+                return
+            finally:
+                self.compute_time += time.perf_counter() - start
+            yield data
+
     def process_images(self):
         """
         Process all images, generating captions for each and collecting metadata.
+        Images already in the caption store (same path, content and model) are skipped.
         """
         start_time = time.time()
-        captions = {}
-        total_images = 0
+        self.io_wait_time = self.compute_time = 0.0
         image_paths = self.get_all_images()
 
-        for img_path in tqdm(image_paths):
-            total_images += 1
-            caption_conditional = self.model.generate_caption(img_path)["caption"]
-            captions[img_path] = (
-                caption_conditional  # You can change this to unconditional if preferred.
+        # Local models stay loaded for the whole run; they are loaded once there is work to do
+        with CaptionStore(
+            self.store_path, flush_every=self.flush_every
+        ) as store, self.model_registry.pinned(*self.local_models.values()):
+            hashes = self.get_hashes(image_paths)
+            todo = {
+                img_path: [
+                    model_name
+                    for model_name in self.model_names
+                    if not store.has(img_path, hashes[img_path], model_name)
+                ]
+                for img_path in image_paths
+            }
+            copies = []
+            if self.deduplicator:
+                clusters = self.deduplicator.clusters(image_paths, hashes)
+                copies = plan_deduplication(clusters, todo, self.model_names)
+                logger.info(
+                    f"{len(image_paths)} images in {len(clusters)} clusters of near-duplicates"
+                )
+            pending = [img_path for img_path in image_paths if todo[img_path]]
+            total = sum(len(model_names) for model_names in todo.values())
+            logger.info(
+                f"{len(image_paths) - len(pending)} images already captioned, {len(pending)} to go"
             )
+            tracer.count("caption.skipped", len(image_paths) - len(pending))
+
+            # Resolve the models once: they stay pinned, so the loader threads
+            # and the captioning loop need not go through the registry again
+            models = self.models if pending else {}
+            if not pending:
+                results = iter(())
+            elif len(self.model_names) > 1:
+                results = self.generate_captions_multi(pending, todo, models)
+            else:
+                results = (
+                    (self.model_name, data)
+                    for data in self.generate_captions(pending, models[self.model_name])
+                )
+
+            for model_name, data in tqdm(results, total=total):
+                if data["caption"] is None:
+                    # Request failed even after retries; leave it for the next run
+                    tracer.count("caption.failed")
+                    continue
+                img_path = data["image_path"]
+                with tracer.span("caption.store_write"):
+                    store.add(img_path, hashes[img_path], model_name, data)
+                tracer.count("caption.captioned")
+
+            self.calls_saved = self.propagate_captions(store, copies, hashes)
+            if self.deduplicator:
+                logger.info(
+                    f"Copied {self.calls_saved} captions to near-duplicate images instead of captioning them"
+                )
+
+            # You can change this to unconditional if preferred.
+            if len(self.model_names) > 1:
+                captions = store.captions_by_image(self.model_names, hashes)
+            else:
+                captions = store.captions(self.model_name, hashes)
 
         time_taken = round(time.time() - start_time, 2)
         # convert to mins
@@ -75,12 +512,75 @@ class CaptioningPipeline:
 
         # Prepare metadata
         metadata = {
-            "model_name": self.model_name,
+            **self._model_metadata(),
             "time_taken": time_taken,
-            "total_no_of_images": total_images,
+            "total_no_of_images": len(captions),
+            "io_wait_seconds": round(self.io_wait_time, 2),
+            "compute_seconds": round(self.compute_time, 2),
         }
+        if self.deduplicator:
+            metadata["dedup_calls_saved"] = self.calls_saved
+        if self.ollama_client and len(self.ollama_client.hosts) > 1:
+            for host in self.ollama_client.stats():
+                logger.info(
+                    f"{host['host']}: {host['requests']} requests, {host['failures']} failed"
+                )
+        if self.ollama_client and self.ollama_client.limiter:
+            metadata["adaptive_limit"] = self.ollama_client.limiter.stats()
+            logger.info(f"Adaptive concurrency: {metadata['adaptive_limit']}")
+        logger.info(
+            f"Waited {self.io_wait_time:.1f}s on image loading and spent {self.compute_time:.1f}s in the model"
+        )
 
-        self.write_to_json(captions, metadata)
+        with tracer.span("caption.write_json"):
+            self.write_to_json(captions, metadata)
+        if self.columnar_path:
+            with tracer.span("caption.write_columnar"):
+                self.write_columnar(captions, metadata)
+
+        if tracer.enabled:
+            tracer.export(self.metrics_path)
+            logger.info(
+                f"Stage timings written to {self.metrics_path}:\n{tracer.summary()}"
+            )
+
+    def propagate_captions(self, store, copies, hashes):
+        """
+        Give every deduplicated image the caption of the image it was grouped with.
+        :param store: CaptionStore of the run.
+        :param copies: List of (image_path, model_name, source_image_path), see plan_deduplication.
+        :param hashes: Dictionary of image paths and content hashes.
+        :return: Number of captions copied (model calls saved).
+        """
+        copied = 0
+        for img_path, model_name, source in copies:
+            record = store.records.get(store.key(source, hashes[source], model_name))
+            if record is None:
+                # The source image failed; both are captioned on the next run
+                continue
+            data = {
+                key: value
+                for key, value in record.items()
+                if key not in ("content_hash", "model_name")
+            }
+            store.add(
+                img_path,
+                hashes[img_path],
+                model_name,
+                {**data, "image_path": img_path, "duplicate_of": source},
+            )
+            copied += 1
+        tracer.count("dedup.calls_saved", copied)
+        return copied
+
+    def _model_metadata(self):
+        """
+        Describe the model(s) in the output metadata. With several models the captions
+        are {image_path: {model_name: caption}} and "model_names" lists the models.
+        """
+        if len(self.model_names) > 1:
+            return {"model_names": self.model_names}
+        return {"model_name": self.model_name}
 
     def write_to_json(self, captions, metadata):
         """
@@ -97,11 +597,118 @@ class CaptioningPipeline:
             f"Finished processing {metadata['total_no_of_images']} images. Output saved to {self.output_path}."
         )
 
+    def write_columnar(self, captions, metadata):
+        """
+        Write the captions as a columnar store as well (see common/caption_columns.py).
+        :param captions: Captions as written to output.json.
+        :param metadata: Metadata dictionary of the output.
+        """
+        if len(self.model_names) > 1:
+            captions_by_model = {
+                model_name: {
+                    image_path: by_model[model_name]
+                    for image_path, by_model in captions.items()
+                    if model_name in by_model
+                }
+                for model_name in self.model_names
+            }
+        else:
+            captions_by_model = {self.model_name: captions}
+        write_columnar_captions(self.columnar_path, captions_by_model, metadata)
+        logger.info(f"Columnar captions written to {self.columnar_path}")
+
+    def shard_stores(self):
+        """
+        Find the caption stores of the latest sharded run. Stores of runs split into a
+        different number of shards are left out, so their captions cannot mix in.
+        :return: Tuple (shard count, sorted list of store paths).
+        """
+        base, ext = os.path.splitext(self.store_path)
+        pattern = re.compile(
+            re.escape(base) + r"\.shard-(\d+)-of-(\d+)" + re.escape(ext)
+        )
+        by_count = {}
+        for path in glob.glob(f"{glob.escape(base)}.shard-*-of-*{ext}"):
+            match = pattern.fullmatch(path)
+            if match:
+                by_count.setdefault(int(match.group(2)), []).append(path)
+        if not by_count:
+            return 0, []
+
+        count = max(
+            by_count,
+            key=lambda n: max(os.path.getmtime(path) for path in by_count[n]),
+        )
+        for other in sorted(set(by_count) - {count}):
+            logger.warning(f"Ignoring the stores of an older run with {other} shards")
+        store_paths = sorted(by_count[count])
+        missing = sorted(
+            set(range(count))
+            - {int(pattern.fullmatch(path).group(1)) for path in store_paths}
+        )
+        if missing:
+            logger.warning(f"No caption store for shards {missing} of {count}")
+        return count, store_paths
+
+    def merge_shards(self):
+        """
+        Merge the caption stores written by every shard into the unsharded output.json.
+        Only images still in the dataset are kept, with the caption of their current content.
+        """
+        count, store_paths = self.shard_stores()
+        logger.info(f"Merging {len(store_paths)} stores of {count} shards")
+        image_paths = self.get_all_images()
+        # The shards already hashed their images
+        for index in range(count):
+            self.manifest.adopt_hashes(
+                ImageManifest(
+                    self.dataset_path,
+                    shard_path(self.manifest_path, index, count),
+                    extensions=self.extensions,
+                )
+            )
+        hashes = self.get_hashes(image_paths)
+
+        if len(self.model_names) > 1:
+            captions = merged_captions_by_image(store_paths, self.model_names, hashes)
+        else:
+            captions = merged_captions(store_paths, self.model_name, hashes)
+        metadata = {
+            **self._model_metadata(),
+            "total_no_of_images": len(captions),
+            "shards": count,
+        }
+        self.output_path = self.merged_output_path
+        self.write_to_json(captions, metadata)
+        if self.merged_columnar_path:
+            self.columnar_path = self.merged_columnar_path
+            self.write_columnar(captions, metadata)
+
 
 # Main function to run the pipeline
 def main():
-    config_path = "config.toml"
-    pipeline = CaptioningPipeline(config_path)
+    parser = argparse.ArgumentParser(description="Caption every image in a dataset.")
+    parser.add_argument("--config", default="config.toml", help="TOML config file.")
+    parser.add_argument(
+        "--shard", help="Caption only shard i of N of the dataset, e.g. --shard 0/4."
+    )
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the outputs of all shards into outputpath instead of captioning.",
+    )
+    parser.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Ignore the cached dataset manifest and list every directory again.",
+    )
+    args = parser.parse_args()
+
+    if args.merge:
+        CaptioningPipeline(args.config, load_model=False).merge_shards()
+        return
+
+    pipeline = CaptioningPipeline(args.config, shard=args.shard, rescan=args.rescan)
     pipeline.process_images()
 
 
@@ -1,39 +1,132 @@
-from PIL import Image
-import ollama
+import os
+import sys
+
+from logzero import logger
+
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+from common.concurrency import ordered_map, retry_with_backoff  # noqa: E402
+from common.ollama_client import (  # noqa: E402
+    OllamaClientPool,
+    is_transient_error,
+    read_image,
+)
+from common.tracing import tracer  # noqa: E402
 
 
 class ImageCaptioningModel:
-    def __init__(self, model_name: str, device: str = "cuda"):
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cuda",
+        host: str = None,
+        timeout: float = None,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+        client: OllamaClientPool = None,
+    ):
         """
         Initialize the image captioning model and processor.
         :param model_name: The name of the model to use (e.g., "Salesforce/blip-image-captioning-base").
         :param device: The device to run the model on ("cuda" or "cpu").
+        :param host: Ollama server URL or list of URLs, defaults to $OLLAMA_HOST or the
+                     local server.
+        :param timeout: Per-request timeout in seconds (None waits forever).
+        :param max_retries: Retries for a request that failed with a transient error.
+        :param retry_backoff: Delay in seconds before the first retry, doubled on every retry.
+        :param client: OllamaClientPool shared with other models; host and timeout are
+                       ignored when given.
         """
         self.model_name = model_name
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
 
-    def generate_caption(self, image_path: str, content: str = "Describe this image:"):
+        # One client (and its HTTP connection pools) shared by every request and thread
+        self.client = client or OllamaClientPool(host, timeout=timeout)
+
+    def generate_caption(
+        self,
+        image_path: str,
+        content: str = "Describe this image:",
+        image: str = None,
+    ):
         """Generate a caption for the given image.
 
         Args:
             image_path (str): Image path.
             content (str): The content/message to send to the model for image description.
                            Defaults to "Describe this image:".
+            image (str): Base64-encoded image file content (see encode_image), if
+                         already read. Otherwise the file is read and encoded once,
+                         not again on every retry.
 
         Returns:
             dict: Caption data with image path and caption text.
         """
+        if image is None:
+            image = read_image(image_path)
+
         # Define the chat request structure with the dynamic content
-        message = {
-            "role": "user",
-            "content": content,
-            "images": [image_path],
-        }
+        message = {"role": "user", "content": content, "images": [image]}
+
+        def request():
+            with tracer.span("ollama.request"):
+                return self.client.chat(model=self.model_name, messages=[message])
 
         # Perform the request to the ollama API
-        res = ollama.chat(model=self.model_name, messages=[message])
+        with tracer.span("ollama.caption"):
+            res = retry_with_backoff(
+                request,
+                retries=self.max_retries,
+                backoff=self.retry_backoff,
+                retry_if=is_transient_error,
+            )
+        tracer.count("ollama.images")
 
         # Extract and return the caption along with the image path
         return {
             "image_path": image_path,
             "caption": res.get("message", {}).get("content", "No caption available"),
         }
+
+    def generate_captions(
+        self,
+        image_paths,
+        max_in_flight: int = 4,
+        content: str = "Describe this image:",
+    ):
+        """Generate captions for many images, keeping several requests in flight.
+
+        Args:
+            image_paths (Iterable[str]): Image paths.
+            max_in_flight (int): Number of concurrent requests sent to the server.
+            content (str): The content/message to send to the model for image description.
+
+        Yields:
+            dict: Caption data in the same order as `image_paths`. Images that still
+                  fail after all retries get a `None` caption and an `error` message.
+        """
+        yield from ordered_map(
+            lambda image_path: self.try_generate_caption(image_path, content),
+            image_paths,
+            max_in_flight=max_in_flight,
+        )
+
+    def try_generate_caption(
+        self,
+        image_path: str,
+        content: str = "Describe this image:",
+        image: str = None,
+    ):
+        """Like generate_caption, but failures after all retries are returned instead of raised.
+
+        Returns:
+            dict: Caption data; the caption is None and `error` holds the message on failure.
+        """
+        try:
+            return self.generate_caption(image_path, content, image=image)
+        except Exception as e:
+            logger.error(f"Failed to caption {image_path}: {e}")
+            tracer.count("ollama.failed")
+            return {"image_path": image_path, "caption": None, "error": str(e)}
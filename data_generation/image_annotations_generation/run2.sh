@@ -23,7 +23,7 @@ fi
 # Activate the specified conda environment
 echo "Activating conda environment: $conda_env_name"
 source ~/anaconda3/etc/profile.d/conda.sh  # Adjust this if your conda is located elsewhere
-conda activate "$conda_env_name" && python main.py
+conda activate "$conda_env_name" && python main.py --config "$config_file" "$@"
 
 # Deactivate the conda environment after running the script
 conda deactivate
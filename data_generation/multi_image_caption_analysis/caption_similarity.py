@@ -0,0 +1,117 @@
+import re
+from collections import Counter
+from itertools import combinations
+
+import numpy as np
+from scipy import sparse
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Words that say nothing about the image content and would inflate every similarity
+STOP_WORDS = frozenset("""
+    a an the and or of in on at to with by for from into onto over under near
+    is are was were be been being it its this that these those there here
+    as some any very while who which what appears appear seems seem image picture
+    photo photograph shows showing depicts depicting scene view possibly likely
+    """.split())
+
+
+def tokenize(text: str) -> list:
+    """Lowercase content words of a caption."""
+    return [
+        token
+        for token in TOKEN_PATTERN.findall(str(text).lower())
+        if token not in STOP_WORDS
+    ]
+
+
+def shared_terms(captions) -> list:
+    """Content words present in every caption, in the order of the first one."""
+    token_sets = [set(tokenize(caption)) for caption in captions]
+    common = set.intersection(*token_sets) if token_sets else set()
+    return list(dict.fromkeys(t for t in tokenize(captions[0]) if t in common))
+
+
+class CaptionAgreement:
+    """
+    Scores how much the captions several models gave the same image agree, as the lowest
+    TF-IDF cosine similarity between any two of them. Captions become L2-normalised
+    sparse TF-IDF rows (scipy.sparse), and the pairwise similarities of a whole batch of
+    images are row-wise dot products, so scoring needs no Python loop over images.
+    Document frequencies are fitted once over all captions, so an image's score does not
+    depend on the batch it is scored in.
+    """
+
+    def __init__(self):
+        self.vocabulary = {}
+        self.idf = np.zeros(0)
+
+    def fit(self, caption_rows):
+        """
+        Learn the vocabulary and inverse document frequencies.
+        :param caption_rows: Iterable of caption lists, one list (one caption per model)
+                             per image.
+        :return: self
+        """
+        document_frequency = Counter()
+        documents = 0
+        for captions in caption_rows:
+            for caption in captions:
+                document_frequency.update(set(tokenize(caption)))
+                documents += 1
+        self.vocabulary = {token: i for i, token in enumerate(document_frequency)}
+        counts = np.fromiter(
+            document_frequency.values(), dtype=np.float64, count=len(self.vocabulary)
+        )
+        # Smoothed idf, as in scikit-learn's TfidfTransformer
+        self.idf = np.log((1 + documents) / (1 + counts)) + 1
+        return self
+
+    def vectors(self, captions) -> sparse.csr_matrix:
+        """L2-normalised TF-IDF rows of captions; words not seen by fit are ignored."""
+        indices, indptr = [], [0]
+        for caption in captions:
+            indices.extend(
+                self.vocabulary[token]
+                for token in tokenize(caption)
+                if token in self.vocabulary
+            )
+            indptr.append(len(indices))
+        matrix = sparse.csr_matrix(
+            (
+                np.ones(len(indices)),
+                np.asarray(indices, dtype=np.int64),
+                np.asarray(indptr, dtype=np.int64),
+            ),
+            shape=(len(indptr) - 1, len(self.vocabulary)),
+        )
+        # Repeated words become counts
+        matrix.sum_duplicates()
+        matrix = matrix @ sparse.diags(self.idf)
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.diags(1 / norms) @ matrix
+
+    def scores(self, caption_rows) -> np.ndarray:
+        """
+        Agreement of every image's captions: the lowest cosine similarity between any two
+        models' captions, from 0 (nothing shared) to 1 (same content words). An empty
+        caption agrees with nothing, and a single model's caption has nothing to agree
+        with (0).
+        :param caption_rows: List of caption lists, one caption per model, all the same length.
+        :return: float array with one score per image.
+        """
+        if not caption_rows:
+            return np.zeros(0)
+        models = len(caption_rows[0])
+        if models < 2:
+            return np.zeros(len(caption_rows))
+        per_model = [
+            self.vectors([captions[m] for captions in caption_rows])
+            for m in range(models)
+        ]
+        scores = np.ones(len(caption_rows))
+        for a, b in combinations(range(models), 2):
+            similarity = per_model[a].multiply(per_model[b]).sum(axis=1)
+            np.minimum(scores, np.asarray(similarity).ravel(), out=scores)
+        return scores
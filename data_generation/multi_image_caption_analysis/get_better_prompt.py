@@ -1,10 +1,29 @@
 import json
 from typing import Dict, List
+import numpy as np
 from pydantic import BaseModel, ValidationError
-from ollama import chat
 import os
+import sys
 from tqdm import tqdm
 
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.caption_columns import (  # noqa: E402
+    ColumnarCaptions,
+    common_image_paths,
+    is_columnar,
+    read_output_json,
+)
+from common.concurrency import (  # noqa: E402
+    ordered_map,
+    retry_with_backoff,
+    shared_limiter,
+)
+from common.ollama_client import OllamaClientPool, is_transient_error  # noqa: E402
+from common.response_cache import ResponseCache  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+
 
 class ImageComparison(BaseModel):
     """
@@ -17,38 +36,101 @@ class ImageComparison(BaseModel):
     different: Dict[str, List[str]]
 
 
+class AgreedComparison(ImageComparison):
+    """
+    Comparison filled in without the LLM because every model's caption agreed
+    (see CaptionComparator's agreement_threshold). Not part of the LLM's schema.
+    """
+
+    agreement: float
+
+
 class CaptionComparator:
     """
     A flexible class to compare image captions across multiple models.
     """
 
-    def __init__(self, model_name: str, json_paths: List[str]):
+    def __init__(
+        self,
+        model_name: str,
+        json_paths: List[str],
+        max_in_flight: int = 1,
+        cache_dir: str = None,
+        max_validation_retries: int = 2,
+        host: str = None,
+        timeout: float = None,
+        metrics_path: str = None,
+        adaptive: bool = False,
+        agreement_threshold: float = None,
+        prefilter_batch_size: int = 4096,
+    ):
         """
         Initialize the comparator with model name and JSON file paths.
 
         :param model_name: Name of the LLM to use for comparison
-        :param json_paths: List of paths to JSON files containing captions
+        :param json_paths: List of paths to JSON files containing captions, either one
+                           output.json per model or a merged multi-model output.json,
+                           or columnar caption stores (memory-mapped, not loaded)
+        :param max_in_flight: Number of comparison requests sent to the LLM at once
+        :param cache_dir: Folder caching validated LLM responses (None disables caching)
+        :param max_validation_retries: Extra requests for a response that fails validation
+        :param host: Ollama server URL or list of URLs (requests are spread over them),
+                     defaults to $OLLAMA_HOST or the local server
+        :param timeout: Per-request timeout in seconds
+        :param metrics_path: File the per-stage timings are exported to after each run
+                             (.prom for Prometheus text, JSON otherwise); enables tracing
+        :param adaptive: Adapt the number of requests in flight (up to max_in_flight) to
+                         the server's latency and errors, with the limiter shared by
+                         every Ollama-bound stage of the process
+        :param agreement_threshold: Images whose captions all have a TF-IDF cosine
+                                    similarity of at least this (0-1) get a comparison
+                                    filled in without calling the LLM (None disables it;
+                                    needs captions of two or more models)
+        :param prefilter_batch_size: Images scored at once by the prefilter
         """
         self.model_name = model_name
         self.json_paths = json_paths
         self.captions_by_model = {}
-
-        # Automatically extract model names from file paths
-        self.model_names = [
-            os.path.basename(os.path.dirname(path)) for path in json_paths
-        ]
+        self.model_names = []
+        self.max_in_flight = max_in_flight
+        self.max_validation_retries = max_validation_retries
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.client = OllamaClientPool(
+            host,
+            timeout=timeout,
+            limiter=shared_limiter(max_limit=max_in_flight) if adaptive else None,
+        )
+        self.schema = ImageComparison.model_json_schema()
+        self.metrics_path = metrics_path
+        self.agreement_threshold = agreement_threshold
+        self.prefilter_batch_size = prefilter_batch_size
+        self.prefilter_stats = None
+        if metrics_path:
+            tracer.enable()
 
         # Load captions for each model
-        self._load_captions()
+        with tracer.span("compare.load_captions"):
+            self._load_captions()
 
     def _load_captions(self):
         """
         Load captions from JSON files and organize them by model.
+        Model names of single-model files are extracted from their folder name; a merged
+        file (metadata "model_names", captions {image: {model: caption}}) adds every model.
+        A columnar caption store adds every model it holds as a lazy mapping.
         """
-        for path, model_name in zip(self.json_paths, self.model_names):
-            with open(path, "r") as f:
-                data = json.load(f)
-                self.captions_by_model[model_name] = data.get("captions", {})
+        for path in self.json_paths:
+            if is_columnar(path):
+                store = ColumnarCaptions(path)
+                for model_name in store.model_names:
+                    self.model_names.append(model_name)
+                    self.captions_by_model[model_name] = store.column(model_name)
+                continue
+
+            # The same parsing as every other reader of output.json
+            for model_name, captions in read_output_json(path).items():
+                self.model_names.append(model_name)
+                self.captions_by_model[model_name] = captions
 
     def _prepare_input_for_llm(self, image_path: str, captions: Dict[str, str]) -> str:
         """
@@ -81,68 +163,242 @@ class CaptionComparator:
         """
         return prompt
 
-    def analyze_image_captions(self) -> List[ImageComparison]:
+    def _request_comparison(self, prompt: str) -> str:
         """
-        Analyze captions for all common images across models.
+        Send one comparison prompt to the LLM, retrying transient errors.
 
-        :return: List of ImageComparison results
+        :param prompt: Prompt from _prepare_input_for_llm
+        :return: Raw response content
         """
-        # Find common image paths across all models
-        common_images = list(
-            set.intersection(
-                *[set(captions.keys()) for captions in self.captions_by_model.values()]
-            )
-        )
-
-        results = []
-        # Use tqdm for progress tracking
-        for image_path in tqdm(
-            common_images, desc="Analyzing Image Captions", unit="image"
-        ):
-            # Collect captions for this image across all models
-            image_captions = {
-                model: self.captions_by_model[model].get(image_path, "")
-                for model in self.model_names
-            }
-
-            # Prepare prompt for LLM
-            prompt = self._prepare_input_for_llm(image_path, image_captions)
 
-            try:
-                # Get LLM response
-                response = chat(
+        def request():
+            with tracer.span("compare.request"):
+                return self.client.chat(
                     model=self.model_name,
                     messages=[{"role": "user", "content": prompt}],
-                    format=ImageComparison.model_json_schema(),
+                    format=self.schema,
                 )
 
+        response = retry_with_backoff(request, retry_if=is_transient_error)
+        return response["message"]["content"]
+
+    def compare_image(self, image_path: str) -> ImageComparison:
+        """
+        Compare the captions of one image, using the response cache when possible.
+        Responses that fail validation are requested again up to max_validation_retries
+        times; only validated responses are cached.
+
+        :param image_path: Path of the image (a key in every model's captions)
+        :return: ImageComparison, or None if no valid response was obtained
+        """
+        # Collect captions for this image across all models
+        image_captions = dict(zip(self.model_names, self._image_captions(image_path)))
+
+        # Prepare prompt for LLM
+        prompt = self._prepare_input_for_llm(image_path, image_captions)
+        key = ResponseCache.make_key(
+            prompt=prompt, model=self.model_name, schema=self.schema
+        )
+
+        with tracer.span("compare.cache_lookup"):
+            content = self.cache.get(key) if self.cache else None
+        from_cache = content is not None
+        if from_cache:
+            tracer.count("compare.cache_hits")
+        for attempt in range(self.max_validation_retries + 1):
+            try:
+                if content is None:
+                    content = self._request_comparison(prompt)
+
                 # Parse and validate the response
-                result = ImageComparison.model_validate_json(
-                    response["message"]["content"]
-                )
+                with tracer.span("compare.parse"):
+                    result = ImageComparison.model_validate_json(content)
                 result.image = image_path
-                results.append(result)
+                if self.cache and not from_cache:
+                    self.cache.set(key, content)
+                return result
 
             except (ValidationError, KeyError) as e:
+                print(
+                    f"Invalid response for image {image_path} (attempt {attempt + 1}): {e}"
+                )
+                tracer.count("compare.invalid_responses")
+                content, from_cache = None, False
+
+            except Exception as e:
                 print(f"Error processing image {image_path}: {e}")
+                tracer.count("compare.failed")
+                return None
+
+        tracer.count("compare.failed")
+        return None
+
+    def _image_captions(self, image_path: str) -> List[str]:
+        return [
+            self.captions_by_model[model].get(image_path, "")
+            for model in self.model_names
+        ]
 
+    def prefilter(self, image_paths: List[str]) -> Dict[str, float]:
+        """
+        Score the caption agreement of every image in batches and return the images
+        whose captions agree well enough to skip the LLM.
+
+        :param image_paths: Images captioned by every model
+        :return: Dictionary of image path to agreement score, for the images that pass
+                 agreement_threshold
+        """
+        # Imported here so scipy is only needed with the prefilter enabled
+        from caption_similarity import CaptionAgreement
+
+        scorer = CaptionAgreement().fit(
+            self._image_captions(image_path) for image_path in image_paths
+        )
+        agreed = {}
+        for start in range(0, len(image_paths), self.prefilter_batch_size):
+            batch = image_paths[start : start + self.prefilter_batch_size]
+            scores = scorer.scores([self._image_captions(path) for path in batch])
+            for index in np.flatnonzero(scores >= self.agreement_threshold):
+                agreed[batch[index]] = float(scores[index])
+        return agreed
+
+    def agreed_comparison(self, image_path: str, agreement: float) -> AgreedComparison:
+        """Comparison of an image whose captions agree: the shared words, no differences."""
+        from caption_similarity import shared_terms
+
+        captions = self._image_captions(image_path)
+        return AgreedComparison(
+            image=image_path,
+            common={"scene": [captions[0]], "details": shared_terms(captions)},
+            different={"details": []},
+            agreement=round(agreement, 4),
+        )
+
+    def iter_image_comparisons(self):
+        """
+        Compare captions for all common images, keeping max_in_flight requests in flight.
+        With agreement_threshold set, images whose captions agree are filled in by the
+        prefilter and only the divergent ones are sent to the LLM.
+
+        :return: Generator of ImageComparison results in sorted image order
+                 (images without a valid response are skipped)
+        """
+        # Find common image paths across all models (vectorised for a columnar store)
+        common_images = common_image_paths(self.captions_by_model.values())
+
+        agreed = {}
+        if self.agreement_threshold is not None and len(self.model_names) < 2:
+            # A single caption agrees with itself: every image would skip the LLM
+            print(
+                f"Prefilter disabled: it needs captions of at least two models, "
+                f"got {len(self.model_names)}"
+            )
+        elif self.agreement_threshold is not None and common_images:
+            with tracer.span("compare.prefilter"):
+                agreed = self.prefilter(common_images)
+            tracer.count("compare.prefiltered", len(agreed))
+            self.prefilter_stats = {
+                "threshold": self.agreement_threshold,
+                "images": len(common_images),
+                "llm_calls_skipped": len(agreed),
+                "skipped_share": round(len(agreed) / len(common_images), 4),
+            }
+            print(
+                f"Prefilter (agreement >= {self.agreement_threshold}): "
+                f"{len(agreed)} of {len(common_images)} LLM calls skipped "
+                f"({self.prefilter_stats['skipped_share']:.1%})"
+            )
+
+        def compare(image_path):
+            if image_path in agreed:
+                return self.agreed_comparison(image_path, agreed[image_path])
+            return self.compare_image(image_path)
+
+        # Use tqdm for progress tracking
+        for result in tqdm(
+            ordered_map(compare, common_images, max_in_flight=self.max_in_flight),
+            total=len(common_images),
+            desc="Analyzing Image Captions",
+            unit="image",
+        ):
+            if result is not None:
+                yield result
+
+    def analyze_image_captions(self, output_path: str = None) -> List[ImageComparison]:
+        """
+        Analyze captions for all common images across models.
+
+        :param output_path: Optional JSON file the results are streamed to as they complete
+        :return: List of ImageComparison results
+        """
+        results = []
+        writer = JsonListWriter(output_path) if output_path else None
+        try:
+            for result in self.iter_image_comparisons():
+                results.append(result)
+                if writer:
+                    with tracer.span("compare.write"):
+                        writer.write(result.model_dump())
+        finally:
+            if writer:
+                writer.close()
+
+        if self.cache:
+            print(f"Response cache: {self.cache.hits} hits, {self.cache.misses} misses")
+        if self.metrics_path:
+            tracer.export(self.metrics_path)
+            print(f"Stage timings written to {self.metrics_path}:\n{tracer.summary()}")
         return results
 
 
+class JsonListWriter:
+    """
+    Write a JSON list one item at a time, so results reach the disk as they are produced.
+    The file is a valid JSON list once closed.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "w")
+        self.file.write("[")
+        self.count = 0
+
+    def write(self, item):
+        separator = ",\n" if self.count else "\n"
+        self.file.write(separator + json.dumps(item, indent=2))
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]\n" if self.count else "]\n")
+        self.file.close()
+
+
 # Example usage
-def main(json_paths: List[str], json_output_path: str, model_name: str):
-    comparator = CaptionComparator(model_name=model_name, json_paths=json_paths)
+def main(
+    json_paths: List[str],
+    json_output_path: str,
+    model_name: str,
+    max_in_flight: int = 4,
+    cache_dir: str = ".comparison_cache",
+    metrics_path: str = None,
+    agreement_threshold: float = None,
+):
+    comparator = CaptionComparator(
+        model_name=model_name,
+        json_paths=json_paths,
+        max_in_flight=max_in_flight,
+        cache_dir=cache_dir,
+        metrics_path=metrics_path,
+        agreement_threshold=agreement_threshold,
+    )
 
-    results = comparator.analyze_image_captions()
+    # Results are written to json_output_path as they complete
+    results = comparator.analyze_image_captions(json_output_path)
 
     # Print or process results
     for result in results:
         print(result.model_dump_json(indent=2))
 
-    json_results = [result.dict() for result in results]
-    with open(json_output_path, "w") as f:
-        json.dump(json_results, f, indent=2)
-
 
 if __name__ == "__main__":
     json_paths = [
@@ -1,23 +1,169 @@
+import contextlib
+import hashlib
 import json
-from ollama import chat, ChatResponse
+import os
+import sys
+import threading
+import time
+
+from ollama import ChatResponse
+
+# Make the shared helpers in data_generation/common importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from common.caption_columns import (  # noqa: E402
+    CaptionColumn,
+    is_columnar,
+    load_captions,
+)
+from common.concurrency import (  # noqa: E402
+    ordered_map,
+    retry_with_backoff,
+    shared_limiter,
+)
+from common.ollama_client import OllamaClientPool, is_transient_error  # noqa: E402
+from common.response_cache import ResponseCache  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+
+INIT_PROMPT = """The task is to generate a concise 3-line summary of a video based on individual still frames. Each frame may include characters, settings, and visual cues that convey specific emotional tones, actions, or themes which should be considered in the summary. Your goal is to connect the key visual elements, including the character’s expressions, actions, attire, and the atmosphere of the environment, to create an engaging, cohesive summary that reflects the emotional or narrative progression of the video.
+
+                    The following frames represent moments from a video, which conveys a contemplative, emotionally intense atmosphere. These images suggest themes of introspection, spirituality, or ritual, possibly in a historical or ceremonial setting. The descriptions below provide key context that should help you understand the setting, character emotions, and the visual tone of the video.
+                    """
+
+# Map step: summarize one window of consecutive frames
+WINDOW_PROMPT = """The following frame descriptions are consecutive moments from one part of a video. Summarize what happens in this part in 3 to 5 sentences, keeping the order of events and the characters' emotions, actions, attire and the atmosphere. Do not mention frame numbers.
+
+"""
+
+# Reduce step: merge summaries of consecutive parts into one
+REDUCE_PROMPT = """The following are summaries of consecutive parts of a video, in order. Merge them into a single summary of 3 to 5 sentences that keeps the order of events and the emotional or narrative progression.
+
+"""
+
+FINAL_REDUCE_PROMPT = """The following are summaries of consecutive parts of a video, in order. They describe the setting, character emotions, and the visual tone of the video.
+
+"""
+
+# Default instruction appended after the frame context
+FINAL_PROMPT = """Provide a concise 6-line summary of the above context. The summary should capture the overall emotional or narrative arc of the video, connecting the themes, character emotions, and atmosphere across the frames. Do not mention any specific frame number or describe individual frames, just the overall essence of the sequence."""
+
+# Every fixed prompt a summary depends on, for the skip-if-current hashes
+SUMMARY_PROMPTS = (INIT_PROMPT, WINDOW_PROMPT, REDUCE_PROMPT, FINAL_REDUCE_PROMPT)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+def is_window_boundary(text: str) -> bool:
+    """Content-defined cut point: true for roughly one text in four."""
+    digest = hashlib.blake2b(text.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, "big") % 4 == 0
+
+
+def iter_windows(texts, token_budget: int):
+    """
+    Group consecutive texts into windows whose estimated size fits token_budget.
+    Once a window is half full it is closed after a content-defined boundary text, so
+    editing one text only moves the windows around it instead of shifting every later
+    window (which keeps cached window summaries valid). A text larger than the budget
+    gets a window of its own.
+    :param texts: Iterable of strings, in order; consumed lazily.
+    :param token_budget: Maximum estimated tokens per window.
+    :return: Generator of windows (lists of strings), each yielded as soon as it closes.
+    """
+    window, size = [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if window and size + tokens > token_budget:
+            yield window
+            window, size = [], 0
+        window.append(text)
+        size += tokens
+        if size >= token_budget // 2 and is_window_boundary(text):
+            yield window
+            window, size = [], 0
+    if window:
+        yield window
+
+
+def split_into_windows(texts, token_budget: int):
+    """List of the windows of iter_windows."""
+    return list(iter_windows(texts, token_budget))
+
+
+def context_lines(frames):
+    """
+    Yields one context line per frame. Consecutive frames with the same caption (e.g.
+    near-identical frames deduplicated while captioning) share one "Frames first-last"
+    line instead of repeating it.
+    :param frames: Iterable of (frame name, caption), in order; consumed lazily.
+    """
+    run = None
+    for frame, caption in frames:
+        if run and run[2] == caption:
+            run[1] = frame
+            continue
+        if run:
+            yield _context_line(*run)
+        run = [frame, frame, caption]
+    if run:
+        yield _context_line(*run)
+
+
+def _context_line(first, last, caption):
+    if first == last:
+        return f"Frame {first} context: {caption}\n"
+    return f"Frames {first}-{last} context: {caption}\n"
+
+
+def format_parts(summaries):
+    """Lists partial summaries in order, one per line."""
+    return "".join(
+        f"Part {i + 1}: {summary.strip()}\n" for i, summary in enumerate(summaries)
+    )
 
 
 class VideoSummaryGenerator:
-    def __init__(self, json_file_path, final_prompt, model_name="llama3.2"):
+    def __init__(
+        self,
+        json_file_path,
+        final_prompt,
+        model_name="llama3.2",
+        token_budget=None,
+        max_in_flight=4,
+        cache_dir=None,
+        host=None,
+        timeout=None,
+        client=None,
+        request_slots=None,
+        caption_model=None,
+    ):
         # Initialize with the input file path, final prompt, and model name
         self.json_file_path = json_file_path
         self.final_prompt = final_prompt
         self.model_name = model_name
+        # Captioning model to read from a columnar store holding several (default: first)
+        self.caption_model = caption_model
         self.captions = {}
         self.sorted_captions = {}
         self.llm_prompt = ""
 
+        # Prompts larger than token_budget are summarized hierarchically (None disables it)
+        self.token_budget = token_budget
+        self.max_in_flight = max_in_flight
+        self.cache = ResponseCache(cache_dir) if cache_dir else None
+        self.client = client or OllamaClientPool(host, timeout=timeout)
+
+        # Optional semaphore shared by several generators to bound requests in flight
+        self.request_slots = request_slots
+
     def read_json(self):
-        """Reads and parses the JSON file."""
+        """Reads and parses the JSON file, or memory-maps a columnar caption store."""
         try:
-            with open(self.json_file_path, "r") as file:
-                data = json.load(file)
-            self.captions = data.get("captions", {})
+            with tracer.span("summary.read_json"):
+                self.captions = load_captions(self.json_file_path, self.caption_model)
         except FileNotFoundError:
             print(f"Error: File not found at {self.json_file_path}")
         except json.JSONDecodeError:
@@ -25,48 +171,299 @@ class VideoSummaryGenerator:
 
     def sort_captions(self):
         """Sorts the captions by image names."""
-        self.sorted_captions = {k: v for k, v in sorted(self.captions.items())}
+        if isinstance(self.captions, CaptionColumn):
+            # Already sorted; read lazily while the context is built
+            self.sorted_captions = self.captions
+        else:
+            self.sorted_captions = {k: v for k, v in sorted(self.captions.items())}
+
+    def frame_contexts(self):
+        """Returns one context line per frame (see context_lines), in sorted order."""
+        return list(
+            context_lines(
+                (image_name.split("/")[-1].split(".")[0], caption)
+                for image_name, caption in self.sorted_captions.items()
+            )
+        )
 
     def generate_context(self):
         """Generates the context for each image."""
-        prompt = ""
-        for image_name, caption in self.sorted_captions.items():
-            prompt += (
-                f"Frame {image_name.split('/')[-1].split('.')[0]} context: {caption}\n"
-            )
-        return prompt
+        return "".join(self.frame_contexts())
 
     def create_llm_prompt(self):
         """Creates the full prompt for the LLM."""
-        init_prompt = """The task is to generate a concise 3-line summary of a video based on individual still frames. Each frame may include characters, settings, and visual cues that convey specific emotional tones, actions, or themes which should be considered in the summary. Your goal is to connect the key visual elements, including the character’s expressions, actions, attire, and the atmosphere of the environment, to create an engaging, cohesive summary that reflects the emotional or narrative progression of the video.
-
-                    The following frames represent moments from a video, which conveys a contemplative, emotionally intense atmosphere. These images suggest themes of introspection, spirituality, or ritual, possibly in a historical or ceremonial setting. The descriptions below provide key context that should help you understand the setting, character emotions, and the visual tone of the video.
-                    """
         context = self.generate_context()
-        llm_prompt = init_prompt + context + self.final_prompt
+        llm_prompt = INIT_PROMPT + context + self.final_prompt
         self.llm_prompt = llm_prompt
 
+    def chat(self, prompt):
+        """Sends one prompt to the LLM, using the response cache when enabled."""
+        key = ResponseCache.make_key(prompt=prompt, model=self.model_name)
+        if self.cache:
+            cached = self.cache.get(key)
+            if cached is not None:
+                tracer.count("summary.cache_hits")
+                return cached
+
+        def request():
+            with self.request_slots or contextlib.nullcontext():
+                with tracer.span("summary.request"):
+                    return self.client.chat(
+                        model=self.model_name,
+                        messages=[
+                            {"role": "user", "content": prompt},
+                        ],
+                    )
+
+        response: ChatResponse = retry_with_backoff(
+            request, retry_if=is_transient_error
+        )
+        content = response["message"]["content"]
+
+        if self.cache:
+            self.cache.set(key, content)
+        return content
+
     def get_video_summary(self):
         """Interacts with the LLM to get the summary."""
         if not self.llm_prompt:
             self.create_llm_prompt()
 
-        response: ChatResponse = chat(
-            model=self.model_name,
-            messages=[
-                {"role": "user", "content": self.llm_prompt},
-            ],
+        if self.token_budget and estimate_tokens(self.llm_prompt) > self.token_budget:
+            tracer.count("summary.hierarchical")
+            return self.get_hierarchical_summary()
+
+        return self.chat(self.llm_prompt)
+
+    def get_hierarchical_summary(self):
+        """
+        Summarizes long videos whose prompt does not fit the token budget.
+        Map: sorted frames are split into windows that fit the budget and each window is
+        summarized (max_in_flight windows at a time). Reduce: the partial summaries are
+        merged the same way, level by level, until they fit one final prompt.
+        With a cache_dir every intermediate summary is cached by its prompt, so when one
+        caption changes only its window and the reduce steps above it are recomputed.
+        """
+        budget = self.token_budget
+        windows = split_into_windows(
+            self.frame_contexts(), budget - estimate_tokens(WINDOW_PROMPT)
+        )
+        summaries = self._summarize(
+            [WINDOW_PROMPT + "".join(window) for window in windows]
+        )
+        return self.reduce_summaries(summaries)
+
+    def reduce_summaries(self, summaries):
+        """
+        Reduce step of get_hierarchical_summary: merges the summaries of consecutive
+        windows level by level until they fit one final prompt, and returns its summary.
+        :param summaries: Window summaries, in order.
+        """
+        budget = self.token_budget
+        overhead = estimate_tokens(
+            INIT_PROMPT + FINAL_REDUCE_PROMPT + self.final_prompt
+        )
+        while len(summaries) > 1 and (
+            sum(estimate_tokens(summary) for summary in summaries) + overhead > budget
+        ):
+            groups = split_into_windows(
+                summaries, budget - estimate_tokens(REDUCE_PROMPT)
+            )
+            if len(groups) == len(summaries):
+                # Every summary fills the budget on its own: merge pairs to make progress
+                groups = [summaries[i : i + 2] for i in range(0, len(summaries), 2)]
+            summaries = self._summarize(
+                [REDUCE_PROMPT + format_parts(group) for group in groups]
+            )
+
+        return self.chat(
+            INIT_PROMPT
+            + FINAL_REDUCE_PROMPT
+            + format_parts(summaries)
+            + self.final_prompt
         )
 
-        return response["message"]["content"]
+    def _summarize(self, prompts):
+        """Sends the prompts concurrently (max_in_flight at a time), keeping their order."""
+        return list(ordered_map(self.chat, prompts, max_in_flight=self.max_in_flight))
 
     def get_sorted_captions(self):
         """Returns the sorted captions as a dictionary."""
         return self.sorted_captions
 
+    def input_hash(self):
+        """
+        Hashes everything the summary depends on: caption file, prompts (including the
+        hierarchical window and reduce prompts), model and budget.
+        """
+        digest = hashlib.sha256()
+        if os.path.isdir(self.json_file_path):
+            # Columnar caption store: hash every file of it
+            paths = [
+                os.path.join(self.json_file_path, name)
+                for name in sorted(os.listdir(self.json_file_path))
+            ]
+        else:
+            paths = [self.json_file_path]
+        for path in paths:
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(1 << 20), b""):
+                    digest.update(chunk)
+        if self.caption_model:
+            digest.update(self.caption_model.encode())
+        for part in (*SUMMARY_PROMPTS, self.final_prompt, self.model_name):
+            digest.update(part.encode())
+        digest.update(str(self.token_budget).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def summarize_batch(
+        cls,
+        caption_files,
+        final_prompt,
+        output_path,
+        model_name="llama3.2",
+        max_in_flight=8,
+        token_budget=2048,
+        cache_dir=None,
+        host=None,
+        timeout=None,
+        metrics_path=None,
+        adaptive=False,
+    ):
+        """
+        Summarizes many videos, one caption file each, into a single indexed JSONL output.
+        Up to max_in_flight LLM requests run at once across all videos. Videos whose
+        output entry has the same input hash are skipped, and each summary is appended
+        to the output as soon as it is done, so an interrupted batch resumes.
+        :param caption_files: Caption JSON files (see find_caption_files).
+        :param output_path: JSONL index with one {"video", "input_hash", "summary", ...} per line.
+        :param host: Ollama server URL or list of URLs; requests of all videos are spread
+                     over them (least loaded first).
+        :param metrics_path: File the per-stage timings are exported to at the end
+                             (.prom for Prometheus text, JSON otherwise); enables tracing.
+        :param adaptive: Adapt the number of requests in flight (up to max_in_flight) to
+                         the server's latency and errors, with the limiter shared by
+                         every Ollama-bound stage of the process.
+        :return: Dictionary with the number of videos summarized, skipped and failed.
+        """
+        if metrics_path:
+            tracer.enable()
+        index = load_summary_index(output_path)
+        client = OllamaClientPool(
+            host,
+            timeout=timeout,
+            limiter=shared_limiter(max_limit=max_in_flight) if adaptive else None,
+        )
+        request_slots = threading.BoundedSemaphore(max_in_flight)
+
+        pending = []
+        for caption_file in caption_files:
+            generator = cls(
+                caption_file,
+                final_prompt,
+                model_name=model_name,
+                token_budget=token_budget,
+                max_in_flight=max_in_flight,
+                cache_dir=cache_dir,
+                client=client,
+                request_slots=request_slots,
+            )
+            input_hash = generator.input_hash()
+            entry = index.get(caption_file)
+            if entry is None or entry["input_hash"] != input_hash:
+                pending.append((generator, input_hash))
+        stats = {
+            "summarized": 0,
+            "skipped": len(caption_files) - len(pending),
+            "failed": 0,
+        }
+        print(f"{stats['skipped']} videos up to date, {len(pending)} to summarize")
+        tracer.count("summary.skipped", stats["skipped"])
 
-def main(json_file_path, final_prompt):
-    video_summary_generator = VideoSummaryGenerator(json_file_path, final_prompt)
+        def summarize(job):
+            generator, input_hash = job
+            start_time = time.time()
+            try:
+                with tracer.span("summary.video"):
+                    generator.read_json()
+                    generator.sort_captions()
+                    summary = generator.get_video_summary()
+            except Exception as e:
+                print(f"Error summarizing {generator.json_file_path}: {e}")
+                return None
+            return {
+                "video": generator.json_file_path,
+                "input_hash": input_hash,
+                "model_name": model_name,
+                "frames": len(generator.sorted_captions),
+                "summary": summary,
+                "time_taken": round(time.time() - start_time, 2),
+            }
+
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "a") as output:
+            for entry in ordered_map(summarize, pending, max_in_flight=max_in_flight):
+                if entry is None:
+                    stats["failed"] += 1
+                    tracer.count("summary.failed")
+                    continue
+                with tracer.span("summary.write"):
+                    output.write(json.dumps(entry) + "\n")
+                    output.flush()
+                stats["summarized"] += 1
+                tracer.count("summary.summarized")
+
+        if metrics_path:
+            tracer.export(metrics_path)
+            print(f"Stage timings written to {metrics_path}:\n{tracer.summary()}")
+        return stats
+
+
+def find_caption_files(source):
+    """
+    Lists the caption files of a batch.
+    :param source: A directory (searched recursively for output.json files and columnar
+                   caption stores) or a manifest file with one caption file path per line.
+    :return: Sorted list of caption file paths.
+    """
+    if os.path.isdir(source):
+        caption_files = []
+        for root, dirs, files in os.walk(source):
+            if "meta.json" in files and is_columnar(root):
+                caption_files.append(root)
+                dirs.clear()
+                continue
+            caption_files.extend(
+                os.path.join(root, name) for name in files if name == "output.json"
+            )
+        return sorted(caption_files)
+    with open(source, "r") as file:
+        return sorted(line.strip() for line in file if line.strip())
+
+
+def load_summary_index(path):
+    """Reads a JSONL summary index into {video: entry}; later lines win."""
+    index = {}
+    if not os.path.exists(path):
+        return index
+    with open(path, "r") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line from an interrupted run
+                continue
+            index[entry["video"]] = entry
+    return index
+
+
+def main(json_file_path, final_prompt, token_budget=2048, cache_dir=".summary_cache"):
+    # Videos whose prompt exceeds token_budget are summarized hierarchically
+    video_summary_generator = VideoSummaryGenerator(
+        json_file_path, final_prompt, token_budget=token_budget, cache_dir=cache_dir
+    )
 
     # Read and process the JSON file
     video_summary_generator.read_json()
@@ -82,8 +479,50 @@ def main(json_file_path, final_prompt):
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Summarize videos from frame captions."
+    )
+    parser.add_argument(
+        "--batch",
+        help="Directory of caption files (output.json) or a manifest listing them.",
+    )
+    parser.add_argument(
+        "--output", default="video_summaries.jsonl", help="Summary index for --batch."
+    )
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    parser.add_argument(
+        "--host",
+        nargs="+",
+        help="Ollama server URL(s) for --batch; requests are spread over them.",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt the requests in flight (up to --max-in-flight) to the server's latency.",
+    )
+    parser.add_argument(
+        "--metrics",
+        help="Export per-stage timings of --batch to this file (.prom or .json).",
+    )
+    args = parser.parse_args()
 
     # Example usage:
     json_file_path = "/media/hp/c587a0ea-5c63-499c-a609-e5e5362a9766/data/ImmersoAIWorks/data_generation/image_annotations_generation/generated_captions/llava/output.json"
-    final_prompt = """Provide a concise 6-line summary of the above context. The summary should capture the overall emotional or narrative arc of the video, connecting the themes, character emotions, and atmosphere across the frames. Do not mention any specific frame number or describe individual frames, just the overall essence of the sequence."""
-    main(json_file_path, final_prompt)
+    final_prompt = FINAL_PROMPT
+
+    if args.batch:
+        stats = VideoSummaryGenerator.summarize_batch(
+            find_caption_files(args.batch),
+            final_prompt,
+            args.output,
+            max_in_flight=args.max_in_flight,
+            cache_dir=".summary_cache",
+            host=args.host,
+            adaptive=args.adaptive,
+            metrics_path=args.metrics,
+        )
+        print(f"Summaries written to {args.output}: {stats}")
+    else:
+        main(json_file_path, final_prompt)
@@ -0,0 +1,549 @@
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from PIL import Image
+
+# Make the shared helpers in data_generation/common and the captioning models importable
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "image_annotations_generation"
+    )
+)
+
+from common.concurrency import ordered_map, shared_limiter  # noqa: E402
+from common.model_registry import shared_registry  # noqa: E402
+from common.ollama_client import OllamaClientPool, encode_image  # noqa: E402
+from common.tracing import tracer  # noqa: E402
+from frame_dedup import difference_hashes, hamming_distances  # noqa: E402
+from video_caption import (  # noqa: E402
+    FINAL_PROMPT,
+    INIT_PROMPT,
+    SUMMARY_PROMPTS,
+    WINDOW_PROMPT,
+    VideoSummaryGenerator,
+    context_lines,
+    estimate_tokens,
+    iter_windows,
+    load_summary_index,
+)
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm")
+
+
+def sample_frames(
+    video_path: str,
+    interval: float = 1.0,
+    scene_threshold: int = None,
+    max_interval: float = None,
+    hash_size: int = 8,
+):
+    """
+    Decode a video and yield the sampled frames one at a time, so only the current frame
+    is held in memory. Frames in between are grabbed but never converted.
+    :param video_path: Video file readable by OpenCV.
+    :param interval: Seconds of video between sampled frames.
+    :param scene_threshold: If set, a sampled frame is only kept when its difference hash
+                            differs from the last kept frame's in more than this many bits
+                            (out of hash_size**2), i.e. on a scene change.
+    :param max_interval: With scene_threshold, keep a frame at least this often anyway.
+    :param hash_size: Rows of the difference hash thumbnail.
+    :return: Generator of (frame index, seconds, RGB PIL image).
+    """
+    # Imported on first use; OpenCV is only needed to decode videos
+    import cv2
+
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise FileNotFoundError(f"Cannot open video {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    step = max(1, round(interval * fps))
+    last_hash, last_kept = None, None
+    try:
+        for index in itertools.count():
+            if index % step:
+                if not capture.grab():
+                    break
+                continue
+            with tracer.span("stream.decode"):
+                ok, frame = capture.read()
+            if not ok:
+                break
+            seconds = index / fps
+            if scene_threshold is not None:
+                thumbnail = cv2.resize(
+                    cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY),
+                    (hash_size + 1, hash_size),
+                    interpolation=cv2.INTER_AREA,
+                )
+                hash_ = difference_hashes(thumbnail[None])
+                changed = (
+                    last_hash is None
+                    or hamming_distances(hash_[0], last_hash)[0] > scene_threshold
+                )
+                overdue = (
+                    max_interval is not None
+                    and last_kept is not None
+                    and seconds - last_kept >= max_interval
+                )
+                if not (changed or overdue):
+                    tracer.count("stream.frames_skipped")
+                    continue
+                last_hash, last_kept = hash_, seconds
+            tracer.count("stream.frames")
+            yield index, seconds, Image.fromarray(
+                cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            )
+    finally:
+        capture.release()
+
+
+class StreamingVideoSummarizer:
+    """
+    Summarizes a video in a single streaming pass: frames are decoded and sampled, passed
+    in memory to the captioning model, and the captions are grouped into windows as they
+    arrive. Each window is summarized as soon as it is complete, while later frames are
+    still being captioned, and the window summaries are merged at the end.
+    Memory stays bounded whatever the video length: only the frames of requests in flight
+    (or of one BLIP batch), one open window and the window summaries are held.
+    Window prompts are the same as VideoSummaryGenerator's, so both share cached summaries.
+    """
+
+    def __init__(
+        self,
+        caption_model_name: str = "llava:7b",
+        final_prompt: str = FINAL_PROMPT,
+        model_name: str = "llama3.2",
+        token_budget: int = 2048,
+        max_in_flight: int = 4,
+        cache_dir: str = None,
+        host=None,
+        timeout: float = None,
+        client: OllamaClientPool = None,
+        interval: float = 1.0,
+        scene_threshold: int = None,
+        max_interval: float = None,
+        caption_backend: str = None,
+        device: str = None,
+        batch_size: int = 8,
+        jpeg_quality: int = 90,
+    ):
+        """
+        :param caption_model_name: Ollama vision model or BLIP model captioning the frames.
+        :param final_prompt: Instruction appended after the frame context.
+        :param model_name: Ollama model writing the summaries.
+        :param token_budget: Maximum estimated tokens of a prompt; longer videos are
+                             summarized window by window.
+        :param max_in_flight: Caption requests, and window summaries, sent at once.
+        :param cache_dir: Optional folder caching LLM responses.
+        :param host: Ollama server URL or list of URLs.
+        :param timeout: Per-request timeout in seconds.
+        :param client: OllamaClientPool shared with other stages; host and timeout are
+                       ignored when given.
+        :param interval: Seconds of video between sampled frames.
+        :param scene_threshold: Keep only frames that differ from the last kept one in more
+                                than this many difference hash bits (see sample_frames).
+        :param max_interval: With scene_threshold, keep a frame at least this often anyway.
+        :param caption_backend: "blip" or "ollama"; defaults to blip for BLIP model names.
+        :param device: Device of a BLIP model.
+        :param batch_size: Frames per BLIP forward pass.
+        :param jpeg_quality: Quality frames are encoded with for Ollama.
+        """
+        self.caption_model_name = caption_model_name
+        self.token_budget = token_budget
+        self.max_in_flight = max_in_flight
+        self.interval = interval
+        self.scene_threshold = scene_threshold
+        self.max_interval = max_interval
+        self.batch_size = batch_size
+        self.jpeg_quality = jpeg_quality
+        self.client = client or OllamaClientPool(host, timeout=timeout)
+        self.summarizer = VideoSummaryGenerator(
+            None,
+            final_prompt,
+            model_name=model_name,
+            token_budget=token_budget,
+            max_in_flight=max_in_flight,
+            cache_dir=cache_dir,
+            client=self.client,
+        )
+
+        if caption_backend is None:
+            caption_backend = (
+                "blip" if "blip" in caption_model_name.lower() else "ollama"
+            )
+        self.caption_backend = caption_backend
+        if caption_backend == "blip":
+            # Loaded on first use, within the memory budget of the process (see model_registry)
+            self.caption_model_key = f"blip:{caption_model_name}:{device or 'auto'}"
+            shared_registry().register(
+                self.caption_model_key,
+                lambda: self._load_blip(caption_model_name, device),
+                device=device,
+            )
+        else:
+            from ollama_caption.ollama_caption import ImageCaptioningModel
+
+            self.caption_model = ImageCaptioningModel(
+                caption_model_name, client=self.client
+            )
+
+    @staticmethod
+    def _load_blip(model_name, device):
+        from blip_caption.blip_caption import ImageCaptioningModel
+
+        return ImageCaptioningModel(model_name, device=device)
+
+    def _caption_ollama(self, frame):
+        index, seconds, image = frame
+        with tracer.span("stream.encode"):
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=self.jpeg_quality)
+        data = self.caption_model.try_generate_caption(
+            f"{index:06d}", image=encode_image(buffer.getvalue())
+        )
+        return index, seconds, data["caption"]
+
+    def caption_frames(self, frames):
+        """
+        Caption frames in memory, in order.
+        :param frames: Iterable of (frame index, seconds, RGB PIL image); consumed lazily.
+        :return: Generator of (frame index, seconds, caption); the caption is None when
+                 it failed after all retries.
+        """
+        if self.caption_backend != "blip":
+            yield from ordered_map(
+                self._caption_ollama, frames, max_in_flight=self.max_in_flight
+            )
+            return
+
+        registry = shared_registry()
+        with registry.pinned(self.caption_model_key):
+            frames = iter(frames)
+            for batch in iter(
+                lambda: list(itertools.islice(frames, self.batch_size)), []
+            ):
+                model = registry.get(self.caption_model_key)
+                pixels = [model.preprocess_image(image) for _, _, image in batch]
+                results = model.generate_captions_from_pixels(
+                    [f"{index:06d}" for index, _, _ in batch], pixels
+                )
+                del model
+                for (index, seconds, _), data in zip(batch, results):
+                    yield index, seconds, data["caption"]
+
+    def summarize_frames(self, frames, captions_file=None) -> dict:
+        """
+        Caption and summarize a stream of frames.
+        :param frames: Iterable of (frame index, seconds, RGB PIL image), e.g. sample_frames.
+        :param captions_file: Optional open text file every caption is appended to as a
+                              JSON line {"frame", "seconds", "caption"}.
+        :return: Dictionary with the summary, the number of frames, captions and windows,
+                 the seconds until the first window summary and in total.
+        """
+        start_time = time.perf_counter()
+        stats = {"frames": 0, "captions": 0, "windows": 0}
+
+        def captions():
+            for index, seconds, caption in self.caption_frames(frames):
+                stats["frames"] += 1
+                if caption is None:
+                    tracer.count("stream.caption_failed")
+                    continue
+                stats["captions"] += 1
+                if captions_file:
+                    captions_file.write(
+                        json.dumps(
+                            {"frame": index, "seconds": seconds, "caption": caption}
+                        )
+                        + "\n"
+                    )
+                yield f"{index:06d}", caption
+
+        windows = iter_windows(
+            context_lines(captions()),
+            self.token_budget - estimate_tokens(WINDOW_PROMPT),
+        )
+        # A video whose whole context fits one prompt is summarized like a short caption
+        # file (see get_video_summary): windows are held back until they outgrow it
+        buffered, prompt = [], None
+        for window in windows:
+            buffered.append(window)
+            prompt = (
+                INIT_PROMPT
+                + "".join(itertools.chain.from_iterable(buffered))
+                + self.summarizer.final_prompt
+            )
+            if estimate_tokens(prompt) > self.token_budget:
+                break
+        if not buffered:
+            summary, first_summary_seconds = None, None
+        elif estimate_tokens(prompt) <= self.token_budget:
+            stats["windows"] = 1
+            summary = self.summarizer.chat(prompt)
+            first_summary_seconds = time.perf_counter() - start_time
+        else:
+            done = []
+
+            def summarize_window(window):
+                window_summary = self.summarizer.chat(WINDOW_PROMPT + "".join(window))
+                done.append(time.perf_counter() - start_time)
+                return window_summary
+
+            # Window summaries are requested as windows close, while captioning goes on
+            summaries = list(
+                ordered_map(
+                    summarize_window,
+                    itertools.chain(buffered, windows),
+                    max_in_flight=self.max_in_flight,
+                )
+            )
+            first_summary_seconds = min(done)
+            stats["windows"] = len(summaries)
+            summary = self.summarizer.reduce_summaries(summaries)
+
+        return {
+            **stats,
+            "summary": summary,
+            "first_summary_seconds": first_summary_seconds,
+            "seconds": time.perf_counter() - start_time,
+        }
+
+    def input_hash(self, video_path: str) -> str:
+        """Hashes the video file's identity (size, mtime) and every setting of the summary."""
+        stat = os.stat(video_path)
+        digest = hashlib.sha256()
+        for part in (
+            os.path.abspath(video_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            self.caption_model_name,
+            self.summarizer.model_name,
+            self.interval,
+            self.scene_threshold,
+            self.max_interval,
+            self.token_budget,
+            *SUMMARY_PROMPTS,
+            self.summarizer.final_prompt,
+        ):
+            digest.update(str(part).encode())
+        return digest.hexdigest()
+
+    def summarize(self, video_path: str, captions_path: str = None) -> dict:
+        """
+        Decode, caption and summarize one video file (see summarize_frames).
+        :param captions_path: Optional JSONL file the frame captions are written to.
+        """
+        frames = sample_frames(
+            video_path, self.interval, self.scene_threshold, self.max_interval
+        )
+        with tracer.span("stream.video"):
+            if not captions_path:
+                return self.summarize_frames(frames)
+            if os.path.dirname(captions_path):
+                os.makedirs(os.path.dirname(captions_path), exist_ok=True)
+            with open(captions_path, "w") as captions_file:
+                return self.summarize_frames(frames, captions_file)
+
+    def summarize_videos(self, video_paths, output_path: str, captions_dir=None):
+        """
+        Summarize videos one after the other into a JSONL index like summarize_batch.
+        Videos whose entry has the same input hash are skipped.
+        :param video_paths: Video files.
+        :param output_path: JSONL index with one {"video", "input_hash", "summary", ...} per line.
+        :param captions_dir: Optional folder the frame captions of every video are written to.
+        :return: Dictionary with the number of videos summarized, skipped and failed.
+        """
+        index = load_summary_index(output_path)
+        stats = {"summarized": 0, "skipped": 0, "failed": 0}
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "a") as output:
+            for video_path in video_paths:
+                input_hash = self.input_hash(video_path)
+                entry = index.get(video_path)
+                if entry is not None and entry["input_hash"] == input_hash:
+                    stats["skipped"] += 1
+                    continue
+                captions_path = None
+                if captions_dir:
+                    name = os.path.splitext(os.path.basename(video_path))[0]
+                    captions_path = os.path.join(captions_dir, f"{name}.jsonl")
+                try:
+                    result = self.summarize(video_path, captions_path)
+                except Exception as e:
+                    print(f"Error summarizing {video_path}: {e}")
+                    stats["failed"] += 1
+                    tracer.count("summary.failed")
+                    continue
+                print(
+                    f"{video_path}: {result['frames']} frames, {result['windows']} windows, "
+                    f"first window summary after {result['first_summary_seconds'] or 0:.1f}s, "
+                    f"done in {result['seconds']:.1f}s"
+                )
+                output.write(
+                    json.dumps(
+                        {
+                            "video": video_path,
+                            "input_hash": input_hash,
+                            "model_name": self.summarizer.model_name,
+                            "caption_model_name": self.caption_model_name,
+                            "frames": result["frames"],
+                            "summary": result["summary"],
+                            "time_taken": round(result["seconds"], 2),
+                        }
+                    )
+                    + "\n"
+                )
+                output.flush()
+                stats["summarized"] += 1
+        return stats
+
+
+def find_videos(source):
+    """
+    Lists the video files of a batch.
+    :param source: A video file, a directory searched recursively for videos, or a
+                   manifest file with one video path per line.
+    :return: Sorted list of video paths.
+    """
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(root, name)
+            for root, _, files in os.walk(source)
+            for name in files
+            if name.lower().endswith(VIDEO_EXTENSIONS)
+        )
+    if source.lower().endswith(VIDEO_EXTENSIONS):
+        return [source]
+    with open(source, "r") as file:
+        return sorted(line.strip() for line in file if line.strip())
+
+
+def stream_videos(
+    source,
+    output_path: str,
+    caption_model_name: str = "llava:7b",
+    model_name: str = "llama3.2",
+    token_budget: int = 2048,
+    max_in_flight: int = 4,
+    cache_dir: str = None,
+    captions_dir: str = None,
+    interval: float = 1.0,
+    scene_threshold: int = None,
+    max_interval: float = None,
+    host=None,
+    timeout: float = None,
+    adaptive: bool = False,
+    metrics_path: str = None,
+) -> dict:
+    """
+    Decode, caption and summarize a batch of videos in one streaming pass each (see
+    StreamingVideoSummarizer.summarize_videos). Used by this script and `immerso stream`.
+    :param source: Video file, directory of videos or manifest listing them (see find_videos).
+    :param adaptive: Adapt the number of requests in flight (up to twice max_in_flight,
+                     captions and window summaries together) to the server's latency and
+                     errors, with the limiter shared by every Ollama-bound stage.
+    :param metrics_path: File the per-stage timings are exported to at the end
+                         (.prom for Prometheus text, JSON otherwise); enables tracing.
+    Other parameters are those of StreamingVideoSummarizer.
+    :return: Dictionary with the number of videos summarized, skipped and failed.
+    """
+    if metrics_path:
+        tracer.enable()
+    client = OllamaClientPool(
+        host,
+        timeout=timeout,
+        limiter=shared_limiter(max_limit=2 * max_in_flight) if adaptive else None,
+    )
+    summarizer = StreamingVideoSummarizer(
+        caption_model_name,
+        model_name=model_name,
+        token_budget=token_budget,
+        max_in_flight=max_in_flight,
+        cache_dir=cache_dir,
+        client=client,
+        interval=interval,
+        scene_threshold=scene_threshold,
+        max_interval=max_interval,
+    )
+    stats = summarizer.summarize_videos(find_videos(source), output_path, captions_dir)
+    if metrics_path:
+        tracer.export(metrics_path)
+        print(f"Stage timings written to {metrics_path}:\n{tracer.summary()}")
+    return stats
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Decode, caption and summarize videos in one streaming pass."
+    )
+    parser.add_argument(
+        "source", help="Video file, directory of videos or manifest listing them."
+    )
+    parser.add_argument(
+        "--output", default="video_summaries.jsonl", help="Summary index."
+    )
+    parser.add_argument(
+        "--caption-model", default="llava:7b", help="Ollama vision model or BLIP model."
+    )
+    parser.add_argument("--model", default="llama3.2", help="Summary model.")
+    parser.add_argument(
+        "--interval", type=float, default=1.0, help="Seconds between sampled frames."
+    )
+    parser.add_argument(
+        "--scene-threshold",
+        type=int,
+        help="Keep only frames differing from the last kept one in more than this many of 64 hash bits.",
+    )
+    parser.add_argument(
+        "--max-interval",
+        type=float,
+        help="With --scene-threshold, keep a frame at least this often (seconds).",
+    )
+    parser.add_argument("--token-budget", type=int, default=2048)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--cache-dir", default=".summary_cache")
+    parser.add_argument(
+        "--captions-dir", help="Also write the frame captions of every video here."
+    )
+    parser.add_argument("--host", nargs="+", help="Ollama server URL(s).")
+    parser.add_argument("--timeout", type=float, help="Per-request timeout in seconds.")
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt the requests in flight (up to twice --max-in-flight, captions and "
+        "summaries together) to the server's latency.",
+    )
+    parser.add_argument("--metrics", help="Export per-stage timings to this file.")
+    args = parser.parse_args()
+
+    stats = stream_videos(
+        args.source,
+        args.output,
+        caption_model_name=args.caption_model,
+        model_name=args.model,
+        token_budget=args.token_budget,
+        max_in_flight=args.max_in_flight,
+        cache_dir=args.cache_dir,
+        captions_dir=args.captions_dir,
+        interval=args.interval,
+        scene_threshold=args.scene_threshold,
+        max_interval=args.max_interval,
+        host=args.host,
+        timeout=args.timeout,
+        adaptive=args.adaptive,
+        metrics_path=args.metrics,
+    )
+    print(f"Summaries written to {args.output}: {stats}")
+
+
+if __name__ == "__main__":
+    main()
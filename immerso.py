@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""
+Single entry point for the pipelines: caption, compare, summarize, stream and generate.
+
+Only argparse is imported up front. Each subcommand imports its pipeline (and with it
+torch, transformers, diffusers, ollama or OpenCV) when it runs, so `--help` and argument errors
+return immediately. benchmarks/bench_import_time.py keeps this in check.
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _use(*parts):
+    """Make the scripts of a pipeline folder importable."""
+    path = os.path.join(ROOT, *parts)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+def caption(args):
+    _use("data_generation", "image_annotations_generation")
+    from main import CaptioningPipeline
+
+    if args.merge:
+        CaptioningPipeline(args.config, load_model=False).merge_shards()
+        return
+    CaptioningPipeline(
+        args.config, shard=args.shard, rescan=args.rescan
+    ).process_images()
+
+
+def compare(args):
+    _use("data_generation", "multi_image_caption_analysis")
+    from get_better_prompt import CaptionComparator
+
+    comparator = CaptionComparator(
+        model_name=args.model,
+        json_paths=args.json_paths,
+        max_in_flight=args.max_in_flight,
+        cache_dir=args.cache_dir,
+        host=args.host,
+        timeout=args.timeout,
+        metrics_path=args.metrics,
+        adaptive=args.adaptive,
+        agreement_threshold=args.agreement_threshold,
+    )
+    results = comparator.analyze_image_captions(args.output)
+    print(f"{len(results)} comparisons written to {args.output}")
+
+
+def summarize(args):
+    _use("data_generation", "video_annotation_generation")
+    from video_caption import FINAL_PROMPT, VideoSummaryGenerator, find_caption_files
+
+    stats = VideoSummaryGenerator.summarize_batch(
+        find_caption_files(args.source),
+        FINAL_PROMPT,
+        args.output,
+        model_name=args.model,
+        max_in_flight=args.max_in_flight,
+        token_budget=args.token_budget,
+        cache_dir=args.cache_dir,
+        host=args.host,
+        timeout=args.timeout,
+        metrics_path=args.metrics,
+        adaptive=args.adaptive,
+    )
+    print(f"Summaries written to {args.output}: {stats}")
+
+
+def stream(args):
+    _use("data_generation", "video_annotation_generation")
+    from video_stream import stream_videos
+
+    stats = stream_videos(
+        args.source,
+        args.output,
+        caption_model_name=args.caption_model,
+        model_name=args.model,
+        token_budget=args.token_budget,
+        max_in_flight=args.max_in_flight,
+        cache_dir=args.cache_dir,
+        captions_dir=args.captions_dir,
+        interval=args.interval,
+        scene_threshold=args.scene_threshold,
+        max_interval=args.max_interval,
+        host=args.host,
+        timeout=args.timeout,
+        adaptive=args.adaptive,
+        metrics_path=args.metrics,
+    )
+    print(f"Summaries written to {args.output}: {stats}")
+
+
+def generate(args):
+    _use("Image_generation", "Inference")
+    from runner import run_from_config
+
+    run_from_config(args.config, args.backend, args.json_paths)
+
+
+def _add_ollama_arguments(
+    parser, max_in_flight: int, adaptive_bound: str = "--max-in-flight"
+):
+    parser.add_argument(
+        "--model", default="llama3.2", help="Ollama model (default: %(default)s)."
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=max_in_flight,
+        help="Requests sent at once (default: %(default)s).",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help=f"Adapt the requests in flight (up to {adaptive_bound}) to the server's latency.",
+    )
+    parser.add_argument(
+        "--host", nargs="+", help="Ollama server URL(s); requests are spread over them."
+    )
+    parser.add_argument("--timeout", type=float, help="Per-request timeout in seconds.")
+    parser.add_argument(
+        "--metrics", help="Export per-stage timings to this file (.prom or .json)."
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="immerso",
+        description="Caption datasets, compare captions, summarize videos and generate images.",
+    )
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    parser_caption = subcommands.add_parser(
+        "caption", help="Caption every image of a dataset (BLIP or Ollama models)."
+    )
+    parser_caption.add_argument(
+        "--config",
+        default=os.path.join(
+            ROOT, "data_generation", "image_annotations_generation", "config.toml"
+        ),
+        help="TOML config file (default: data_generation/image_annotations_generation/config.toml).",
+    )
+    parser_caption.add_argument(
+        "--shard", help="Caption only shard i of N of the dataset, e.g. --shard 0/4."
+    )
+    parser_caption.add_argument(
+        "--merge",
+        action="store_true",
+        help="Merge the outputs of all shards into outputpath instead of captioning.",
+    )
+    parser_caption.add_argument(
+        "--rescan",
+        action="store_true",
+        help="Ignore the cached dataset manifest and list every directory again.",
+    )
+    parser_caption.set_defaults(run=caption)
+
+    parser_compare = subcommands.add_parser(
+        "compare", help="Compare the captions several models gave the same images."
+    )
+    parser_compare.add_argument(
+        "json_paths",
+        nargs="+",
+        help="output.json per model, merged multi-model output.json or columnar stores.",
+    )
+    parser_compare.add_argument(
+        "--output",
+        default="image_caption_comparision.json",
+        help="JSON list the comparisons are written to (default: %(default)s).",
+    )
+    parser_compare.add_argument(
+        "--cache-dir",
+        default=".comparison_cache",
+        help="Folder caching validated LLM responses (default: %(default)s).",
+    )
+    parser_compare.add_argument(
+        "--agreement-threshold",
+        type=float,
+        help="Skip the LLM for images whose captions agree at least this much (0-1); "
+        "needs captions of two or more models.",
+    )
+    _add_ollama_arguments(parser_compare, max_in_flight=4)
+    parser_compare.set_defaults(run=compare)
+
+    parser_summarize = subcommands.add_parser(
+        "summarize", help="Summarize videos from their frame captions."
+    )
+    parser_summarize.add_argument(
+        "source",
+        help="Directory of caption files (output.json or stores) or a manifest listing them.",
+    )
+    parser_summarize.add_argument(
+        "--output",
+        default="video_summaries.jsonl",
+        help="Summary index (default: %(default)s).",
+    )
+    parser_summarize.add_argument(
+        "--token-budget",
+        type=int,
+        default=2048,
+        help="Prompts longer than this are summarized hierarchically (default: %(default)s).",
+    )
+    parser_summarize.add_argument(
+        "--cache-dir",
+        default=".summary_cache",
+        help="Folder caching LLM responses (default: %(default)s).",
+    )
+    _add_ollama_arguments(parser_summarize, max_in_flight=8)
+    parser_summarize.set_defaults(run=summarize)
+
+    parser_stream = subcommands.add_parser(
+        "stream",
+        help="Decode, caption and summarize videos in one pass, without frames on disk.",
+    )
+    parser_stream.add_argument(
+        "source", help="Video file, directory of videos or a manifest listing them."
+    )
+    parser_stream.add_argument(
+        "--output",
+        default="video_summaries.jsonl",
+        help="Summary index (default: %(default)s).",
+    )
+    parser_stream.add_argument(
+        "--caption-model",
+        default="llava:7b",
+        help="Ollama vision model or BLIP model captioning the frames (default: %(default)s).",
+    )
+    parser_stream.add_argument(
+        "--interval",
+        type=float,
+        default=1.0,
+        help="Seconds of video between sampled frames (default: %(default)s).",
+    )
+    parser_stream.add_argument(
+        "--scene-threshold",
+        type=int,
+        help="Keep only frames differing from the last kept one in more than this many of 64 hash bits.",
+    )
+    parser_stream.add_argument(
+        "--max-interval",
+        type=float,
+        help="With --scene-threshold, keep a frame at least this often (seconds).",
+    )
+    parser_stream.add_argument(
+        "--token-budget",
+        type=int,
+        default=2048,
+        help="Frame captions are summarized in windows of this size (default: %(default)s).",
+    )
+    parser_stream.add_argument(
+        "--cache-dir",
+        default=".summary_cache",
+        help="Folder caching LLM responses (default: %(default)s).",
+    )
+    parser_stream.add_argument(
+        "--captions-dir", help="Also write the frame captions of every video here."
+    )
+    _add_ollama_arguments(
+        parser_stream,
+        max_in_flight=4,
+        adaptive_bound="twice --max-in-flight, captions and summaries together",
+    )
+    parser_stream.set_defaults(run=stream)
+
+    parser_generate = subcommands.add_parser(
+        "generate", help="Generate images from caption files (SD2, SDXL or FLUX)."
+    )
+    parser_generate.add_argument(
+        "--config",
+        default=os.path.join(ROOT, "Image_generation", "Inference", "config.toml"),
+        help="TOML config file (default: Image_generation/Inference/config.toml).",
+    )
+    parser_generate.add_argument(
+        "--backend", help="Override the backend (sd2, sdxl, flux)."
+    )
+    parser_generate.add_argument(
+        "json_paths", nargs="*", help="Caption files, instead of the config's list."
+    )
+    parser_generate.set_defaults(run=generate)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()